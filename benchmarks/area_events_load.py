@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+    Load generator for the DungeonAreaSync event pipeline
+
+    Producers move actors at random through EventBatchers and a single
+    thread, standing in for an ordered IceStorm topic, hands the frames to
+    the FrameReceiver of one area. Latency is measured per frame, from its
+    oldest event to the moment it was applied.
+'''
+
+import os
+import sys
+import time
+import queue
+import random
+import argparse
+import threading
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT_DIR, 'src'))
+
+# pylint: disable=C0413
+import area_events
+import dungeon_engine
+
+AREA_SIDE = 64
+
+
+def build_area(actor_count):
+    '''Returns an empty area with actor_count actors'''
+    grid = dungeon_engine.TileGrid(
+        AREA_SIDE, AREA_SIDE, bytearray([dungeon_engine.FLOOR_TILE] * AREA_SIDE * AREA_SIDE))
+    template = dungeon_engine.AreaTemplate.from_grid('load', grid)
+    dungeon = dungeon_engine.DungeonRun('load', ['load'])
+    area = dungeon_engine.Area('load', dungeon, 0, template)
+    for index in range(actor_count):
+        area.put_actor(dungeon_engine.ActorRecord('actor{}'.format(index), '', 0, 0))
+    return area
+
+
+def produce(batcher, actor_ids, rate, deadline):
+    '''Sends rate random moves per second until deadline'''
+    pause = 1.0 / rate
+    next_event = time.perf_counter()
+    while next_event < deadline:
+        batcher.add(area_events.move_actor(
+            random.choice(actor_ids), random.randrange(AREA_SIDE), random.randrange(AREA_SIDE)))
+        next_event += pause
+        delay = next_event - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+
+
+def percentile(values, fraction):
+    '''Returns the value at fraction of the sorted values'''
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def main():
+    '''Runs the load generator'''
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--producers', type=int, default=8)
+    parser.add_argument('--actors', type=int, default=50, help='actors per producer')
+    parser.add_argument('--rate', type=int, default=2000, help='events/s per producer')
+    parser.add_argument('--seconds', type=float, default=5.0)
+    parser.add_argument('--flush-interval', type=float, default=area_events.FLUSH_INTERVAL)
+    args = parser.parse_args()
+
+    area = build_area(args.producers * args.actors)
+    channel = queue.Queue()
+    latencies = []
+    applied = [0]
+
+    def apply(events, oldest):
+        area_events.apply_events(area, events)
+        applied[0] += len(events)
+        latencies.append(time.time() - oldest)
+
+    receiver = area_events.FrameReceiver(apply)
+
+    def deliver():
+        while True:
+            frame = channel.get()
+            if frame is None:
+                return
+            receiver.receive(*frame)
+
+    consumer = threading.Thread(target=deliver)
+    consumer.start()
+
+    batchers = [area_events.EventBatcher(lambda frame, sender_id: channel.put((frame, sender_id)),
+                                         flush_interval=args.flush_interval)
+                for _ in range(args.producers)]
+    start = time.perf_counter()
+    deadline = start + args.seconds
+    producers = []
+    for number, batcher in enumerate(batchers):
+        actor_ids = ['actor{}'.format(number * args.actors + index) for index in range(args.actors)]
+        batcher.start()
+        producers.append(threading.Thread(
+            target=produce, args=(batcher, actor_ids, args.rate, deadline)))
+    for producer in producers:
+        producer.start()
+    for producer in producers:
+        producer.join()
+    for batcher in batchers:
+        batcher.stop()
+    channel.put(None)
+    consumer.join()
+    elapsed = time.perf_counter() - start
+
+    added = sum(batcher.events_added for batcher in batchers)
+    frames = sum(batcher.frames_sent for batcher in batchers)
+    latencies.sort()
+    print('events added:   {:10d} ({:.0f}/s)'.format(added, added / elapsed))
+    print('events applied: {:10d} ({:.1f}% coalesced)'.format(
+        applied[0], 100.0 * (added - applied[0]) / max(added, 1)))
+    print('frames:         {:10d} ({:.1f} events/frame, {} gaps, {} duplicates)'.format(
+        frames, applied[0] / max(frames, 1), receiver.gaps, receiver.duplicates))
+    print('frame latency:  p50 {:.1f} ms, p99 {:.1f} ms'.format(
+        percentile(latencies, 0.50) * 1000, percentile(latencies, 0.99) * 1000))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
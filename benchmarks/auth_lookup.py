@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+    Benchmark of AuthenticationI.getOwner with large user bases
+'''
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT_DIR, 'src'))
+os.chdir(ROOT_DIR)
+
+# pylint: disable=C0413
+import auth_server
+
+
+def build_users(user_count):
+    '''Returns a synthetic users database'''
+    return {
+        'user{}'.format(index): {
+            auth_server.CURRENT_TOKEN: auth_server._build_token_(),
+            auth_server.PASSWORD_HASH: 'hash{}'.format(index)
+        } for index in range(user_count)
+    }
+
+
+def linear_owner(users, token):
+    '''Owner lookup as it was done before the token index'''
+    for user_name in users:
+        if users[user_name][auth_server.CURRENT_TOKEN] == token:
+            return user_name
+    return None
+
+
+def measure(lookup, tokens):
+    '''Returns the mean latency of lookup in microseconds'''
+    start = time.perf_counter()
+    for token in tokens:
+        lookup(token)
+    return (time.perf_counter() - start) / len(tokens) * 1e6
+
+
+def main():
+    '''Runs the benchmark'''
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, nargs='+', default=[10000, 100000])
+    parser.add_argument('--lookups', type=int, default=10000)
+    parser.add_argument('--linear-lookups', type=int, default=100)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        print('{:>8} {:>14} {:>14}'.format('users', 'indexed (us)', 'linear (us)'))
+        for user_count in args.users:
+            users = build_users(user_count)
+            # A users database per size, it is only imported when created
+            auth_server.USERS_FILE = os.path.join(workdir, 'users{}.json'.format(user_count))
+            with open(auth_server.USERS_FILE, 'w') as contents:
+                json.dump(users, contents)
+            servant = auth_server.AuthenticationI()
+            tokens = [user[auth_server.CURRENT_TOKEN] for user in users.values()]
+            indexed = measure(servant.getOwner, random.choices(tokens, k=args.lookups))
+            linear = measure(lambda token, users=users: linear_owner(users, token),
+                             random.choices(tokens, k=args.linear_lookups))
+            print('{:>8} {:>14.3f} {:>14.3f}'.format(user_count, indexed, linear))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
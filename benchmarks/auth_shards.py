@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+    Benchmark of getNewToken with the user base split in shards
+
+    Every shard updates one row of its own users database per token. The
+    shards run one after another here, the total column is the throughput
+    of one server per shard.
+'''
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT_DIR, 'src'))
+os.chdir(ROOT_DIR)
+
+# pylint: disable=C0413
+import auth_server
+
+
+def build_users(user_count):
+    '''Returns a synthetic users database'''
+    return {
+        'user{}'.format(index): {
+            auth_server.CURRENT_TOKEN: auth_server._build_token_(),
+            auth_server.PASSWORD_HASH: 'hash{}'.format(index)
+        } for index in range(user_count)
+    }
+
+
+def main():
+    '''Runs the benchmark'''
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=20000)
+    parser.add_argument('--shards', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--tokens', type=int, default=200)
+    args = parser.parse_args()
+
+    users = build_users(args.users)
+    requests = random.choices(list(users), k=args.tokens)
+    print('{:>7} {:>16} {:>18}'.format('shards', 'tokens/s/shard', 'tokens/s (total)'))
+    for shard_count in args.shards:
+        with tempfile.TemporaryDirectory() as workdir:
+            auth_server.USERS_FILE = os.path.join(workdir, 'users.json')
+            with open(auth_server.USERS_FILE, 'w') as contents:
+                json.dump(users, contents)
+            ring = auth_server.HashRing(['shard{}'.format(index) for index in range(shard_count)])
+            servants = {
+                shard: auth_server.AuthenticationI(
+                    users_file=os.path.join(workdir, '{}.json'.format(shard)),
+                    owns=lambda user, shard=shard: ring.shard(user) == shard)
+                for shard in ring.shards
+            }
+            start = time.perf_counter()
+            for user in requests:
+                servants[ring.shard(user)].getNewToken(user, users[user][auth_server.PASSWORD_HASH])
+            per_shard = args.tokens / (time.perf_counter() - start)
+            print('{:>7} {:>16.0f} {:>18.0f}'.format(
+                shard_count, per_shard, per_shard * shard_count))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+    Benchmark of the client-side room cache
+
+    Starts the services as e2e_load.py does, then reads --reads random rooms
+    of the preloaded ones with getRoom and through a room_cache.RoomCache
+    subscribed to RoomManagerSyncChannel. Afterwards rooms read through the
+    cache are replaced and removed on the other replica, one by one and
+    with publishMany, to measure how long the cache keeps serving the old
+    content. Needs at least two --managers for that part.
+'''
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCHMARKS_DIR)
+
+# pylint: disable=C0413
+import Ice
+import IceStorm
+import e2e_load
+# pylint: disable=E0401
+import IceGauntlet
+import ice_standins
+import room_cache
+
+CHANGE_TIMEOUT = 5.0
+
+
+def changed_room(templates, room_name, variant):
+    '''Returns the JSON of room_name with the shape of the template variant'''
+    room = dict(templates[variant % len(templates)])
+    room['room'] = room_name
+    return json.dumps(room)
+
+
+def timed_reads(read, room_names):
+    '''Returns the seconds of read(room_name) for each room'''
+    latencies = []
+    for room_name in room_names:
+        start = time.perf_counter()
+        read(room_name)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def wait_until(condition):
+    '''Returns the seconds until condition() holds, None after CHANGE_TIMEOUT'''
+    start = time.perf_counter()
+    deadline = time.monotonic() + CHANGE_TIMEOUT
+    while time.monotonic() < deadline:
+        if condition():
+            return time.perf_counter() - start
+        time.sleep(e2e_load.POLL_INTERVAL)
+    return None
+
+
+def served_by_cache(cache, room_name, data):
+    '''Returns if the cache serves data as room_name, or knows it is removed if None'''
+    try:
+        served = cache.get_room(room_name)
+    except IceGauntlet.RoomNotExists:
+        return data is None
+    return data is not None and json.loads(served) == json.loads(data)
+
+
+def measure_invalidation(harness, cache, samples):
+    '''Returns how long the cache serves rooms changed on the other replica'''
+    token = harness.tokens[harness.users[0]]
+    other = harness.managers[1]
+    latencies = {'publish': [], 'publishMany': [], 'remove': []}
+    timeouts = 0
+    for sample in range(samples):
+        room_names = ['cached{}-{}'.format(sample, index) for index in range(4)]
+        other.publishMany(token, [changed_room(harness.templates, room_name, 0)
+                                  for room_name in room_names])
+        wait_until(lambda: all(served_by_cache(cache, room_name, changed_room(
+            harness.templates, room_name, 0)) for room_name in room_names))
+
+        new_data = changed_room(harness.templates, room_names[0], 1)
+        other.publish(token, new_data)
+        changes = [('publish', room_names[0], new_data)]
+        new_rooms = [changed_room(harness.templates, room_name, 2)
+                     for room_name in room_names[1:3]]
+        other.publishMany(token, new_rooms)
+        changes += [('publishMany', room_name, data)
+                    for room_name, data in zip(room_names[1:3], new_rooms)]
+        other.remove(token, room_names[3])
+        changes.append(('remove', room_names[3], None))
+        for operation, room_name, data in changes:
+            seconds = wait_until(lambda: served_by_cache(cache, room_name, data))
+            if seconds is None:
+                timeouts += 1
+            else:
+                latencies[operation].append(seconds)
+    results = {operation: e2e_load.summarize(values) for operation, values in latencies.items()}
+    results['timeouts'] = timeouts
+    return results
+
+
+def topic_manager_proxy(harness):
+    '''Returns a proxy to the stand-in TopicManager of the harness'''
+    return IceStorm.TopicManagerPrx.uncheckedCast(harness.topic_manager.adapter.createProxy(
+        Ice.stringToIdentity(ice_standins.TOPIC_MANAGER_IDENTITY)))
+
+
+def main():
+    '''Runs the benchmark'''
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--managers', type=int, default=2, help='map_server.py replicas')
+    parser.add_argument('--rooms', type=int, default=500, help='rooms preloaded')
+    parser.add_argument('--reads', type=int, default=5000, help='rooms read per variant')
+    parser.add_argument('--samples', type=int, default=20, help='invalidation samples')
+    parser.add_argument('--output', help='file for the JSON results, stdout if not given')
+    args = parser.parse_args()
+    # Options of e2e_load.Harness that this benchmark leaves as they are
+    harness_args = argparse.Namespace(
+        managers=args.managers, users=1, rooms=args.rooms, mix='getRoom=1', token_key='',
+        server_threads=4, flush_interval=0.5, fsync='never', topic_manager='',
+        metrics=False, keep=False)
+
+    cache_dir = tempfile.mkdtemp(prefix='icegauntlet-cache-')
+    with Ice.initialize(sys.argv) as communicator:
+        harness = e2e_load.Harness(harness_args, communicator)
+        try:
+            harness.start()
+            harness.preload()
+            room_names = random.Random(0).choices(harness.room_names, k=args.reads)
+            manager = harness.managers[0]
+            results = {'revision': e2e_load.git_revision(), 'config': vars(args)}
+            results['getRoom'] = e2e_load.summarize(timed_reads(manager.getRoom, room_names))
+
+            cache = room_cache.RoomCache(manager, directory=cache_dir)
+            adapter = communicator.createObjectAdapterWithEndpoints(
+                'RoomCacheAdapter', 'tcp -h 127.0.0.1')
+            adapter.activate()
+            cache.subscribe(topic_manager_proxy(harness), adapter)
+            results['cache'] = e2e_load.summarize(timed_reads(cache.get_room, room_names))
+            results['cache_stats'] = dict(cache.stats)
+
+            # A new process: same files, nothing in memory
+            cold_cache = room_cache.RoomCache(manager, directory=cache_dir)
+            cold_cache.subscribe(topic_manager_proxy(harness), adapter)
+            results['disk_cache'] = e2e_load.summarize(
+                timed_reads(cold_cache.get_room, room_names))
+            results['disk_cache_stats'] = dict(cold_cache.stats)
+            cold_cache.unsubscribe()
+
+            if args.managers > 1:
+                results['invalidation'] = measure_invalidation(harness, cache, args.samples)
+                results['invalidation_stats'] = dict(cache.stats)
+            cache.unsubscribe()
+        finally:
+            harness.stop()
+            shutil.rmtree(cache_dir)
+
+    for name in ('getRoom', 'cache', 'disk_cache'):
+        print('{:12} {:9.3f} ms mean {:9.3f} ms p99'.format(
+            name, results[name]['mean_ms'], results[name]['p99_ms']), file=sys.stderr)
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=4)
+    else:
+        print(json.dumps(results, indent=4))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+    Benchmark of the client startup paths
+
+    Compares loading the Slice definitions with loadSlice against the
+    generated stubs, and reading a room with one map_client.py process per
+    operation against client_command.py talking to a warm client_daemon.py.
+    The RoomManager is a stand-in servant that returns a fixed room.
+'''
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT_DIR, 'src'))
+os.chdir(ROOT_DIR)
+
+# pylint: disable=C0413
+import Ice
+import slice_stubs
+slice_stubs.load_slice()
+# pylint: disable=E0401
+import IceGauntlet
+
+ROOM = '{"room": "bench", "data": [[1]]}'
+ROOM_HASH = 'bench'
+IMPORT_SLICE = 'import sys; sys.path.insert(0, "src"); import slice_stubs; ' \
+               'slice_stubs.load_slice(stubs_dir={!r}); import IceGauntlet'
+
+
+class FixedRoomManager(IceGauntlet.RoomManager):
+    '''RoomManager that always returns the same room'''
+    def getRoom(self, roomName, current=None):
+        return ROOM
+
+    def getRoomIfChanged(self, roomName, knownHash, current=None):
+        if knownHash == ROOM_HASH:
+            return Ice.Unset
+        return IceGauntlet.HashedRoom(ROOM, ROOM_HASH)
+
+    def sessionToken(self, current=None):
+        return ''
+
+
+def timed_runs(command, runs):
+    '''Returns the mean seconds of running command runs times'''
+    start = time.perf_counter()
+    for _ in range(runs):
+        subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+    return (time.perf_counter() - start) / runs
+
+
+def main():
+    '''Runs the benchmark'''
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=20)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    try:
+        stubs_dir = os.path.join(workdir, 'generated')
+        os.mkdir(stubs_dir)
+        subprocess.run(['slice2py', '--ice', '--output-dir', stubs_dir,
+                        slice_stubs.SLICE_FILE], check=True)
+        missing_dir = os.path.join(workdir, 'missing')
+        load_slice = timed_runs([sys.executable, '-c', IMPORT_SLICE.format(missing_dir)], args.runs)
+        stubs = timed_runs([sys.executable, '-c', IMPORT_SLICE.format(stubs_dir)], args.runs)
+        print('import, loadSlice:      {:7.1f} ms'.format(load_slice * 1000))
+        print('import, stubs:          {:7.1f} ms'.format(stubs * 1000))
+
+        with Ice.initialize(sys.argv) as communicator:
+            adapter = communicator.createObjectAdapterWithEndpoints(
+                'BenchAdapter', 'tcp -h 127.0.0.1')
+            proxy = str(adapter.add(FixedRoomManager(), Ice.stringToIdentity('bench')))
+            adapter.activate()
+
+            per_process = timed_runs([
+                sys.executable, 'src/map_client.py', proxy, 'token', '-g', 'bench'], args.runs)
+            print('map_client.py -g:       {:7.1f} ms/op (stubs {})'.format(
+                per_process * 1000, 'used' if slice_stubs.stubs_current() else 'not generated'))
+
+            socket_file = os.path.join(workdir, 'daemon.sock')
+            daemon = subprocess.Popen([
+                sys.executable, 'src/client_daemon.py', '--socket', socket_file],
+                stdout=subprocess.PIPE)
+            daemon.stdout.readline()
+            command = [sys.executable, 'src/client_command.py', '--socket', socket_file,
+                       'get', proxy, 'bench']
+            first = timed_runs(command, 1)
+            warm = timed_runs(command, args.runs)
+            print('client_command.py get:  {:7.1f} ms/op (first {:.1f} ms)'.format(
+                warm * 1000, first * 1000))
+            subprocess.run([sys.executable, 'src/client_command.py', '--socket', socket_file,
+                            'stop'], check=True)
+            daemon.wait()
+    finally:
+        shutil.rmtree(workdir)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+    Benchmark of DungeonEngine memory per area and getMap latency
+'''
+
+import os
+import sys
+import json
+import time
+import argparse
+import tracemalloc
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT_DIR, 'src'))
+
+# pylint: disable=C0413
+import room_codec
+import dungeon_engine
+
+GIGABYTE = 1024 ** 3
+
+
+def build_rooms(room_count):
+    '''Returns room name -> binary for room_count copies of the rooms in rooms.json'''
+    with open(os.path.join(ROOT_DIR, 'rooms.json')) as roomsfile:
+        templates = [list(owner.values())[0] for owner in json.load(roomsfile).values()]
+    rooms = {}
+    for index in range(room_count):
+        room = dict(templates[index % len(templates)])
+        room['room'] = 'room{}'.format(index)
+        rooms[room['room']] = room_codec.encode_room(room)
+    return rooms
+
+
+def measure_areas(engine, area_count, modify):
+    '''Returns the bytes allocated per live area'''
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    areas = []
+    area = engine.new_dungeon()
+    while len(areas) < area_count:
+        if modify:
+            # Worst case: every area owns its grid and items
+            area.set_tile(0, 0, dungeon_engine.FLOOR_TILE)
+            area.take_item('item0')
+        areas.append(area)
+        area = engine.next_area(area) or engine.new_dungeon()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    allocated = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+    return allocated / area_count, areas
+
+
+def main():
+    '''Runs the benchmark'''
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rooms', type=int, default=200)
+    parser.add_argument('--areas', type=int, default=20000)
+    parser.add_argument('--lookups', type=int, default=100000)
+    args = parser.parse_args()
+
+    rooms = build_rooms(args.rooms)
+    for modify in (False, True):
+        engine = dungeon_engine.DungeonEngine(
+            lambda: list(rooms.keys()), rooms.__getitem__, max_areas=args.areas + 1)
+        per_area, areas = measure_areas(engine, args.areas, modify)
+        start = time.perf_counter()
+        for index in range(args.lookups):
+            engine.get_area(areas[index % len(areas)].area_id).get_map()
+        latency = (time.perf_counter() - start) / args.lookups * 1e6
+        print('{:>10}: {:8.0f} bytes/area, {:10.0f} areas/GB, getMap {:.3f} us'.format(
+            'modified' if modify else 'pristine', per_area, GIGABYTE / per_area, latency))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
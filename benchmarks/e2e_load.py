@@ -0,0 +1,482 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+    End-to-end load benchmark of the IceGauntlet services
+
+    Starts auth_server.py and --managers map_server.py processes, each in a
+    working directory of its own, with the in-process locator and IceStorm
+    of ice_standins (or the IceStorm given by --topic-manager). Synthetic
+    users and rooms, copies of the shapes in rooms.json, are loaded first;
+    then --clients threads run a weighted mix of operations for --seconds.
+    Finally rooms are published on the first replica and polled on the
+    others to measure RoomManagerSync convergence.
+
+    The results are printed, or written to --output, as JSON so that runs
+    of different versions can be compared.
+'''
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import signal
+import socket
+import hashlib
+import argparse
+import tempfile
+import threading
+import subprocess
+import collections
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCHMARKS_DIR)
+sys.path.insert(0, os.path.join(ROOT_DIR, 'src'))
+os.chdir(ROOT_DIR)
+
+# pylint: disable=C0413
+import Ice
+import slice_stubs
+slice_stubs.load_slice()
+# pylint: disable=E0401
+import IceGauntlet
+import instrumentation
+import ice_standins
+
+OPERATIONS = ('getNewToken', 'getOwner', 'publish', 'remove', 'getRoom', 'availableRooms')
+DEFAULT_MIX = 'getNewToken=2,getOwner=10,publish=10,remove=5,getRoom=50,availableRooms=23'
+AUTH_IDENTITY = 'default_1'
+START_TIMEOUT = 30.0
+POLL_INTERVAL = 0.001
+
+
+def hash_pass_str(password):
+    '''Hashes a password as the authentication client does'''
+    password_hasher = hashlib.sha256()
+    password_hasher.update(password.encode())
+    return str(password_hasher.digest())
+
+
+def parse_mix(text):
+    '''Returns the operation -> weight of a "op=weight,..." string'''
+    mix = {}
+    for item in text.split(','):
+        operation, _, weight = item.partition('=')
+        if operation not in OPERATIONS:
+            raise ValueError('Unknown operation: {}'.format(operation))
+        mix[operation] = float(weight)
+    return mix
+
+
+def load_templates():
+    '''Returns the rooms of rooms.json'''
+    with open(os.path.join(ROOT_DIR, 'rooms.json')) as roomsfile:
+        return [list(owner.values())[0] for owner in json.load(roomsfile).values()]
+
+
+def make_room(templates, room_name):
+    '''Returns the JSON of a room named room_name with the shape of a template'''
+    room = dict(templates[hash(room_name) % len(templates)])
+    room['room'] = room_name
+    return json.dumps(room)
+
+
+def percentile(values, fraction):
+    '''Returns the value at fraction of the sorted values'''
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def summarize(latencies, elapsed=None):
+    '''Returns count, throughput and latency percentiles in ms of a list of seconds'''
+    latencies = sorted(latencies)
+    summary = {
+        'count': len(latencies),
+        'mean_ms': 1000 * sum(latencies) / len(latencies) if latencies else 0.0,
+        'p50_ms': 1000 * percentile(latencies, 0.50),
+        'p99_ms': 1000 * percentile(latencies, 0.99),
+        'max_ms': 1000 * latencies[-1] if latencies else 0.0,
+    }
+    if elapsed:
+        summary['throughput'] = len(latencies) / elapsed
+    return summary
+
+
+def free_port():
+    '''Returns a TCP port of 127.0.0.1 that is free right now'''
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+
+def git_revision():
+    '''Returns the commit of the working tree, None outside git'''
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], check=True,
+                              capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Service:
+    '''Server process running in a working directory of its own'''
+    def __init__(self, name, workdir, script, properties, metrics=False):
+        self.name = name
+        self.admin = None
+        if metrics:
+            port = free_port()
+            properties = dict(properties, **{
+                'Metrics.Enabled': 1,
+                'Ice.Admin.InstanceName': name,
+                'Ice.Admin.Endpoints': 'tcp -h 127.0.0.1 -p {}'.format(port),
+            })
+            self.admin = '{}/admin -f {}:tcp -h 127.0.0.1 -p {}'.format(
+                name, instrumentation.FACET, port)
+        self.workdir = os.path.join(workdir, name)
+        os.makedirs(self.workdir)
+        shutil.copy(os.path.join(ROOT_DIR, 'icegauntlet.ice'), self.workdir)
+        self.config = os.path.join(self.workdir, 'config')
+        with open(self.config, 'w') as config:
+            for key, value in properties.items():
+                config.write('{}={}\n'.format(key, value))
+        self.stdout = os.path.join(self.workdir, 'out.txt')
+        self.stderr = os.path.join(self.workdir, 'err.txt')
+        self.script = os.path.join(ROOT_DIR, 'src', script)
+        self.process = None
+
+    def start(self):
+        '''Starts the server and returns the proxy it prints once ready'''
+        with open(self.stdout, 'w') as stdout, open(self.stderr, 'w') as stderr:
+            self.process = subprocess.Popen(
+                [sys.executable, self.script, '--Ice.Config={}'.format(self.config)],
+                cwd=self.workdir, stdout=stdout, stderr=stderr,
+                env=dict(os.environ, PYTHONUNBUFFERED='1'))
+        deadline = time.monotonic() + START_TIMEOUT
+        while time.monotonic() < deadline:
+            with open(self.stdout) as stdout:
+                for line in stdout:
+                    if line.startswith('"'):
+                        return line.strip().strip('"')
+            if self.process.poll() is not None:
+                break
+            time.sleep(0.05)
+        with open(self.stderr) as stderr:
+            raise RuntimeError('{} did not start:\n{}'.format(self.name, stderr.read()[-2000:]))
+
+    def stop(self):
+        '''Interrupts the server, killing it if it does not end'''
+        if self.process is None or self.process.poll() is not None:
+            return
+        self.process.send_signal(signal.SIGINT)
+        try:
+            self.process.wait(10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+
+
+class Worker(threading.Thread):
+    '''Client thread running the operation mix with users of its own'''
+    # pylint: disable=R0902
+    def __init__(self, number, harness, users, deadline):
+        super().__init__(daemon=True)
+        self.number = number
+        self.harness = harness
+        self.users = users
+        self.deadline = deadline
+        self.latencies = collections.defaultdict(list)
+        # operation -> exception name -> count
+        self.errors = collections.defaultdict(collections.Counter)
+        self.random = random.Random(number)
+        self.published = set()
+        self.next_room = 0
+
+    def run(self):
+        operations = list(self.harness.mix)
+        weights = [self.harness.mix[operation] for operation in operations]
+        while time.monotonic() < self.deadline:
+            operation = self.random.choices(operations, weights)[0]
+            start = time.perf_counter()
+            try:
+                getattr(self, operation)()
+            except Ice.Exception as error:
+                self.errors[operation][type(error).__name__] += 1
+                continue
+            self.latencies[operation].append(time.perf_counter() - start)
+
+    def manager(self):
+        '''Returns a random RoomManager replica'''
+        return self.random.choice(self.harness.managers)
+
+    def getNewToken(self):
+        '''Replaces the token of one of the users'''
+        user = self.random.choice(self.users)
+        self.harness.tokens[user] = self.harness.auth.getNewToken(
+            user, self.harness.passwords[user])
+
+    def getOwner(self):
+        '''Asks the owner of the token of one of the users'''
+        self.harness.auth.getOwner(self.harness.tokens[self.random.choice(self.users)])
+
+    def publish(self):
+        '''Publishes a new room or replaces one already published'''
+        if self.published and self.random.random() < 0.5:
+            room_name = self.random.choice(sorted(self.published))
+        else:
+            room_name = 'w{}-room{}'.format(self.number, self.next_room)
+            self.next_room += 1
+        self.manager().publish(self.harness.tokens[self.users[0]],
+                               make_room(self.harness.templates, room_name))
+        self.published.add(room_name)
+
+    def remove(self):
+        '''Removes a room published by this worker
+
+        RoomNotExists is expected when the replica has not received the room yet.
+        '''
+        if not self.published:
+            return
+        room_name = self.published.pop()
+        self.manager().remove(self.harness.tokens[self.users[0]], room_name)
+
+    def getRoom(self):
+        '''Reads one of the preloaded rooms'''
+        self.manager().getRoom(self.random.choice(self.harness.room_names))
+
+    def availableRooms(self):
+        '''Lists the rooms'''
+        self.manager().availableRooms()
+
+
+class Harness:
+    '''Servers, clients and results of one run'''
+    # pylint: disable=R0902
+    def __init__(self, args, communicator):
+        self.args = args
+        self.communicator = communicator
+        self.mix = parse_mix(args.mix)
+        self.templates = load_templates()
+        self.workdir = tempfile.mkdtemp(prefix='icegauntlet-e2e-')
+        self.services = []
+        self.users = ['user{}'.format(index) for index in range(args.users)]
+        self.passwords = {user: hash_pass_str('password-{}'.format(user)) for user in self.users}
+        self.tokens = {}
+        self.room_names = []
+        self.auth = None
+        self.managers = []
+        self.locator = None
+        self.topic_manager = None
+
+    def start(self):
+        '''Starts the stand-ins, the Authentication server and the RoomManagers'''
+        self.locator, self.topic_manager, adapter = ice_standins.serve(self.communicator)
+        endpoint = adapter.getEndpoints()[0]
+        locator_proxy = '{}:{}'.format(ice_standins.LOCATOR_IDENTITY, endpoint)
+        topic_manager_proxy = self.args.topic_manager or '{}:{}'.format(
+            ice_standins.TOPIC_MANAGER_IDENTITY, endpoint)
+        common = {
+            'IceStorm.TopicManager.Proxy': topic_manager_proxy,
+            'SignedTokens.Key': self.args.token_key,
+            'Ice.ThreadPool.Server.Size': self.args.server_threads,
+            'Ice.ThreadPool.Server.SizeMax': self.args.server_threads,
+        }
+
+        with open(os.path.join(self.workdir, 'users.json'), 'w') as usersfile:
+            json.dump({user: {'password_hash': password_hash}
+                       for user, password_hash in self.passwords.items()}, usersfile)
+        auth = Service('auth', self.workdir, 'auth_server.py', dict(common, **{
+            'AuthenticationAdapter.Endpoints': 'tcp -h 127.0.0.1',
+            'Auth.UsersFile': os.path.join(self.workdir, 'users.json'),
+        }), self.args.metrics)
+        self.services.append(auth)
+        auth_proxy = self.communicator.stringToProxy(auth.start())
+        self.locator.add_object(AUTH_IDENTITY, auth_proxy.ice_identity(
+            Ice.stringToIdentity(AUTH_IDENTITY)))
+        self.auth = IceGauntlet.AuthenticationPrx.uncheckedCast(auth_proxy)
+
+        for index in range(self.args.managers):
+            manager = Service('manager{}'.format(index), self.workdir, 'map_server.py',
+                              dict(common, **{
+                                  'Ice.Default.Locator': locator_proxy,
+                                  'Identity': 'room_manager',
+                                  'RoomManagerAdapter.Endpoints': 'tcp -h 127.0.0.1',
+                                  'EventAdapter.Endpoints': 'tcp -h 127.0.0.1',
+                                  'MapStorage.FlushInterval': self.args.flush_interval,
+                                  'MapStorage.Fsync': self.args.fsync,
+                              }), self.args.metrics)
+            self.services.append(manager)
+            self.managers.append(IceGauntlet.RoomManagerPrx.uncheckedCast(
+                self.communicator.stringToProxy(manager.start())))
+
+    def collect_metrics(self):
+        '''Returns the metrics snapshot of every server, None without --metrics'''
+        if not self.args.metrics:
+            return None
+        return {
+            service.name: json.loads(IceGauntlet.ServerMetricsPrx.uncheckedCast(
+                self.communicator.stringToProxy(service.admin)).getMetrics())
+            for service in self.services
+        }
+
+    def stop(self):
+        '''Stops the servers and removes their files unless --keep'''
+        for service in reversed(self.services):
+            service.stop()
+        if self.topic_manager is not None:
+            self.topic_manager.destroy()
+        if self.args.keep:
+            print('Server files kept in {}'.format(self.workdir), file=sys.stderr)
+        else:
+            shutil.rmtree(self.workdir)
+
+    def preload(self):
+        '''Gets a token per user and publishes the preloaded rooms
+
+        Returns the getNewToken latencies and the seconds until every replica had the rooms.
+        '''
+        latencies = []
+        for user in self.users:
+            start = time.perf_counter()
+            self.tokens[user] = self.auth.getNewToken(user, self.passwords[user])
+            latencies.append(time.perf_counter() - start)
+        self.room_names = ['room{}'.format(index) for index in range(self.args.rooms)]
+        for first in range(0, len(self.room_names), 100):
+            batch = self.room_names[first:first + 100]
+            owner = self.users[first // 100 % len(self.users)]
+            self.managers[0].publishMany(self.tokens[owner], [
+                make_room(self.templates, room_name) for room_name in batch])
+        start = time.perf_counter()
+        deadline = time.monotonic() + START_TIMEOUT
+        for manager in self.managers[1:]:
+            while len(manager.availableRooms()) < len(self.room_names):
+                if time.monotonic() > deadline:
+                    raise RuntimeError('Replicas did not receive the preloaded rooms')
+                time.sleep(0.05)
+        return latencies, time.perf_counter() - start
+
+    def run_mix(self):
+        '''Runs the operation mix, returns the summary of every operation'''
+        deadline = time.monotonic() + self.args.seconds
+        # Every worker gets users of its own, so tokens are not replaced under it
+        workers = [Worker(number, self, self.users[number::self.args.clients], deadline)
+                   for number in range(self.args.clients)]
+        start = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - start
+        results = {}
+        for operation in self.mix:
+            latencies = [latency for worker in workers for latency in worker.latencies[operation]]
+            results[operation] = summarize(latencies, elapsed)
+            errors = collections.Counter()
+            for worker in workers:
+                errors.update(worker.errors[operation])
+            results[operation]['errors'] = sum(errors.values())
+            results[operation]['error_types'] = dict(errors)
+        return results
+
+    def measure_convergence(self):
+        '''Returns the time until every replica serves a room published on the first one'''
+        if len(self.managers) < 2:
+            return None
+        token = self.tokens[self.users[0]]
+        latencies = []
+        timeouts = 0
+        for sample in range(self.args.convergence_samples):
+            room_name = 'converge{}'.format(sample)
+            start = time.perf_counter()
+            self.managers[0].publish(token, make_room(self.templates, room_name))
+            deadline = time.monotonic() + self.args.convergence_timeout
+            pending = list(self.managers[1:])
+            while pending and time.monotonic() < deadline:
+                try:
+                    pending[0].getRoom(room_name)
+                    pending.pop(0)
+                except IceGauntlet.RoomNotExists:
+                    time.sleep(POLL_INTERVAL)
+            if pending:
+                timeouts += 1
+            else:
+                latencies.append(time.perf_counter() - start)
+        summary = summarize(latencies)
+        summary['timeouts'] = timeouts
+        return summary
+
+
+def print_results(results):
+    '''Prints the results as a table on stderr'''
+    print('{:16} {:>8} {:>10} {:>9} {:>9} {:>7}'.format(
+        'operation', 'count', 'ops/s', 'p50 ms', 'p99 ms', 'errors'), file=sys.stderr)
+    for operation, summary in results['operations'].items():
+        print('{:16} {:8d} {:10.1f} {:9.2f} {:9.2f} {:7d}'.format(
+            operation, summary['count'], summary['throughput'], summary['p50_ms'],
+            summary['p99_ms'], summary['errors']), file=sys.stderr)
+    convergence = results['convergence']
+    if convergence:
+        print('convergence      {:8d} {:>10} {:9.2f} {:9.2f} {:7d}'.format(
+            convergence['count'], '', convergence['p50_ms'], convergence['p99_ms'],
+            convergence['timeouts']), file=sys.stderr)
+
+
+def main():
+    '''Runs the benchmark'''
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--managers', type=int, default=2, help='map_server.py replicas')
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--rooms', type=int, default=1000, help='rooms preloaded')
+    parser.add_argument('--clients', type=int, default=8, help='client threads')
+    parser.add_argument('--seconds', type=float, default=10.0)
+    parser.add_argument('--mix', default=DEFAULT_MIX, help='operation weights')
+    parser.add_argument('--convergence-samples', type=int, default=50)
+    parser.add_argument('--convergence-timeout', type=float, default=5.0)
+    parser.add_argument('--token-key', default='', help='SignedTokens.Key of the servers')
+    parser.add_argument('--server-threads', type=int, default=4)
+    parser.add_argument('--flush-interval', type=float, default=0.5)
+    parser.add_argument('--fsync', default='never', help='MapStorage.Fsync of the replicas')
+    parser.add_argument('--topic-manager', default='',
+                        help='proxy of a running IceStorm instead of the stand-in')
+    parser.add_argument('--output', help='file for the JSON results, stdout if not given')
+    parser.add_argument('--keep', action='store_true', help='keep the server files')
+    parser.add_argument('--metrics', action='store_true',
+                        help='enable the server metrics and add them to the results')
+    args = parser.parse_args()
+    if args.clients > args.users:
+        parser.error('--users must be at least --clients')
+
+    init_data = Ice.InitializationData()
+    init_data.properties = Ice.createProperties()
+    init_data.properties.setProperty('Ice.ThreadPool.Server.Size', '4')
+    init_data.properties.setProperty('Ice.ThreadPool.Client.Size', '4')
+    with Ice.initialize(init_data) as communicator:
+        harness = Harness(args, communicator)
+        try:
+            harness.start()
+            token_latencies, sync_seconds = harness.preload()
+            results = {
+                'revision': git_revision(),
+                'config': vars(args),
+                'preload': {'getNewToken': summarize(token_latencies),
+                            'sync_seconds': sync_seconds},
+                'operations': harness.run_mix(),
+                'convergence': harness.measure_convergence(),
+                'metrics': harness.collect_metrics(),
+            }
+        finally:
+            harness.stop()
+
+    print_results(results)
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=4)
+    else:
+        print(json.dumps(results, indent=4))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+    In-process stand-ins for the IceGrid locator and IceStorm
+
+    Enough of both services for the servers to run outside an IceGrid
+    deployment: the locator resolves the well-known objects registered
+    with add_object, and every topic forwards what its publisher receives
+    to each subscriber, in order, from a queue of its own.
+'''
+
+import queue
+import logging
+import threading
+
+import Ice
+import IceStorm
+
+LOCATOR_IDENTITY = 'IceGrid/Locator'
+TOPIC_MANAGER_IDENTITY = 'IceStorm/TopicManager'
+
+
+class StandInLocator(Ice.Locator):
+    '''Locator of well-known objects, without adapter ids nor registry'''
+    def __init__(self):
+        self._objects_ = {}
+        self._lock_ = threading.Lock()
+
+    def add_object(self, identity, proxy):
+        '''Makes identity resolve to proxy'''
+        with self._lock_:
+            self._objects_[identity] = proxy
+
+    def findObjectById(self, identity, current=None):
+        with self._lock_:
+            proxy = self._objects_.get(Ice.identityToString(identity))
+        if proxy is None:
+            raise Ice.ObjectNotFoundException()
+        return proxy
+
+    def findAdapterById(self, adapter_id, current=None):
+        raise Ice.AdapterNotFoundException()
+
+    def getRegistry(self, current=None):
+        return None
+
+
+class Subscriber:
+    '''Delivers the events of a topic to one subscriber, in publishing order
+
+    As IceStorm does, a subscriber that cannot be reached is dropped: on_failure
+    is called with it and its pending events are discarded.
+    '''
+    def __init__(self, proxy, on_failure):
+        self.proxy = proxy
+        self.on_failure = on_failure
+        self.delivered = 0
+        self._stopped_ = False
+        self._queue_ = queue.Queue()
+        self._thread_ = threading.Thread(target=self._deliver_, daemon=True)
+        self._thread_.start()
+
+    def put(self, event):
+        '''Queues (operation, mode, params, context) for delivery'''
+        self._queue_.put(event)
+
+    def stop(self):
+        '''Discards the queued events and ends the delivery thread'''
+        self._stopped_ = True
+        self._queue_.put(None)
+        if threading.current_thread() is not self._thread_:
+            self._thread_.join()
+
+    def _deliver_(self):
+        while True:
+            event = self._queue_.get()
+            if event is None or self._stopped_:
+                return
+            operation, mode, params, context = event
+            try:
+                self.proxy.ice_invoke(operation, mode, params, context)
+                self.delivered += 1
+            except Ice.LocalException as error:
+                logging.warning('Dropping subscriber %s: %s', self.proxy, error)
+                self.on_failure(self)
+                return
+
+
+class TopicPublisher(Ice.Blobject):
+    '''Publisher object of a topic, forwards every request to the subscribers'''
+    def __init__(self, topic):
+        self.topic = topic
+
+    def ice_invoke(self, in_params, current):
+        self.topic.publish((current.operation, current.mode, in_params, current.ctx))
+        return True, bytes()
+
+
+class StandInTopic(IceStorm.Topic):
+    '''Topic without links nor persistence'''
+    def __init__(self, name, adapter):
+        self.name = name
+        self.adapter = adapter
+        self.publisher = adapter.addWithUUID(TopicPublisher(self))
+        self.proxy = None
+        # identity of the subscriber -> Subscriber
+        self._subscribers_ = {}
+        self._lock_ = threading.Lock()
+
+    def publish(self, event):
+        '''Queues an event for every subscriber'''
+        with self._lock_:
+            subscribers = list(self._subscribers_.values())
+        for subscriber in subscribers:
+            subscriber.put(event)
+
+    def getName(self, current=None):
+        return self.name
+
+    def getPublisher(self, current=None):
+        return self.publisher
+
+    def getNonReplicatedPublisher(self, current=None):
+        return self.publisher
+
+    def subscribeAndGetPublisher(self, theQoS, subscriber, current=None):
+        key = Ice.identityToString(subscriber.ice_getIdentity())
+        with self._lock_:
+            if key in self._subscribers_:
+                raise IceStorm.AlreadySubscribed()
+            self._subscribers_[key] = Subscriber(subscriber, self._drop_)
+        return subscriber
+
+    def unsubscribe(self, subscriber, current=None):
+        if subscriber is None:
+            return
+        with self._lock_:
+            removed = self._subscribers_.pop(
+                Ice.identityToString(subscriber.ice_getIdentity()), None)
+        if removed is not None:
+            removed.stop()
+
+    def _drop_(self, subscriber):
+        '''Removes a subscriber that could not be reached'''
+        with self._lock_:
+            key = Ice.identityToString(subscriber.proxy.ice_getIdentity())
+            if self._subscribers_.get(key) is subscriber:
+                del self._subscribers_[key]
+        subscriber.stop()
+
+    def link(self, linkTo, cost, current=None):
+        raise IceStorm.LinkExists(linkTo.getName())
+
+    def unlink(self, linkTo, current=None):
+        raise IceStorm.NoSuchLink(linkTo.getName())
+
+    def getLinkInfoSeq(self, current=None):
+        return []
+
+    def getSubscribers(self, current=None):
+        with self._lock_:
+            return [subscriber.proxy for subscriber in self._subscribers_.values()]
+
+    def destroy(self, current=None):
+        with self._lock_:
+            subscribers = list(self._subscribers_.values())
+            self._subscribers_.clear()
+        for subscriber in subscribers:
+            subscriber.stop()
+
+
+class StandInTopicManager(IceStorm.TopicManager):
+    '''TopicManager of StandInTopics'''
+    def __init__(self, adapter):
+        self.adapter = adapter
+        self._topics_ = {}
+        self._lock_ = threading.Lock()
+
+    def create(self, name, current=None):
+        with self._lock_:
+            if name in self._topics_:
+                raise IceStorm.TopicExists(name)
+            topic = StandInTopic(name, self.adapter)
+            topic.proxy = IceStorm.TopicPrx.uncheckedCast(self.adapter.addWithUUID(topic))
+            self._topics_[name] = topic
+        return topic.proxy
+
+    def retrieve(self, name, current=None):
+        with self._lock_:
+            topic = self._topics_.get(name)
+        if topic is None:
+            raise IceStorm.NoSuchTopic(name)
+        return topic.proxy
+
+    def retrieveAll(self, current=None):
+        with self._lock_:
+            return {name: topic.proxy for name, topic in self._topics_.items()}
+
+    def getSliceChecksums(self, current=None):
+        return {}
+
+    def destroy(self):
+        '''Stops the delivery threads of every topic'''
+        with self._lock_:
+            topics = list(self._topics_.values())
+        for topic in topics:
+            topic.destroy()
+
+
+def serve(communicator, endpoints='tcp -h 127.0.0.1'):
+    '''Serves a locator and a topic manager, returns (locator, topic manager, adapter)'''
+    adapter = communicator.createObjectAdapterWithEndpoints('StandInAdapter', endpoints)
+    locator = StandInLocator()
+    adapter.add(locator, Ice.stringToIdentity(LOCATOR_IDENTITY))
+    topic_manager = StandInTopicManager(adapter)
+    adapter.add(topic_manager, Ice.stringToIdentity(TOPIC_MANAGER_IDENTITY))
+    adapter.activate()
+    return locator, topic_manager, adapter
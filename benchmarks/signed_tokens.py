@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+    Benchmark of the local owner check of signed tokens in a RoomManager
+
+    Compares TokenVerifier.owner with a TokenCache hit and with the remote
+    getOwner call it replaces (an in-process Ice call, the best case).
+'''
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT_DIR, 'src'))
+os.chdir(ROOT_DIR)
+
+# pylint: disable=C0413
+import Ice
+import auth_server
+import map_server
+import signed_tokens
+import IceGauntlet
+
+KEY = b'benchmark key'
+
+
+def measure(lookup, tokens):
+    '''Returns the mean latency of lookup in microseconds'''
+    start = time.perf_counter()
+    for token in tokens:
+        lookup(token)
+    return (time.perf_counter() - start) / len(tokens) * 1e6
+
+
+def main():
+    '''Runs the benchmark'''
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--lookups', type=int, default=20000)
+    args = parser.parse_args()
+
+    tokens = [
+        signed_tokens.build_token(KEY, 'user{}'.format(index), 1) for index in range(args.users)
+    ]
+    lookups = [tokens[index % len(tokens)] for index in range(args.lookups)]
+
+    verifier = signed_tokens.TokenVerifier(KEY)
+    cache = map_server.TokenCache(size=args.users)
+    for index, token in enumerate(tokens):
+        cache.put(token, 'user{}'.format(index))
+
+    with tempfile.TemporaryDirectory() as workdir:
+        auth_server.USERS_FILE = os.path.join(workdir, 'users.json')
+        servant = auth_server.AuthenticationI(signing_key=KEY)
+        servant._token_owners_ = {token: 'user' for token in tokens}
+        server = Ice.initialize(['--Ice.Default.Host=127.0.0.1'])
+        # A second communicator, collocated calls would skip the network
+        client = Ice.initialize()
+        try:
+            adapter = server.createObjectAdapterWithEndpoints('Bench', 'tcp')
+            proxy = adapter.add(servant, Ice.stringToIdentity('auth'))
+            adapter.activate()
+            auth = IceGauntlet.AuthenticationPrx.uncheckedCast(
+                client.stringToProxy(server.proxyToString(proxy)))
+            remote = measure(auth.getOwner, lookups[:args.lookups // 10])
+        finally:
+            client.destroy()
+            server.destroy()
+
+    print('signed token verify: {:8.2f} us'.format(measure(verifier.owner, lookups)))
+    print('token cache hit:     {:8.2f} us'.format(measure(cache.get, lookups)))
+    print('remote getOwner:     {:8.2f} us'.format(remote))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+    Stress test of MapStorage under concurrent writers
+
+    Threads share one MapStorage and processes share its files. Every
+    worker publishes, removes and reads the same rooms at random. Each
+    change takes a number from a counter shared by every process and is
+    flushed before the next number is given, so the journal follows that
+    order: once all of them finish the files are loaded again and every
+    room must hold the last change made to it.
+'''
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import threading
+import multiprocessing
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT_DIR, 'src'))
+os.chdir(ROOT_DIR)
+
+# pylint: disable=C0413
+import map_server
+
+SHARED_ROOMS = 50
+USER_NAME = 'stress'
+
+
+def build_storage(workdir, compact_records):
+    '''Returns a loaded MapStorage on the files of workdir'''
+    storage = map_server.MapStorage(
+        rooms_file=os.path.join(workdir, 'rooms.json'),
+        managers_file=os.path.join(workdir, 'managers.json'),
+        journal_file=os.path.join(workdir, 'rooms.journal'),
+        flush_interval=0.01,
+        fsync_policy='never',
+        compact_records=compact_records
+    )
+    storage.load()
+    return storage
+
+
+def load_template():
+    '''Returns the first room of rooms.json'''
+    with open(os.path.join(ROOT_DIR, 'rooms.json')) as roomsfile:
+        return list(list(json.load(roomsfile).values())[0].values())[0]
+
+
+def run_worker(storage, worker, operations, template, sequence):
+    '''Runs random operations on the shared rooms
+
+    Returns room -> (sequence number, writer or None if removed) of the
+    last change of the worker that took effect on each room.
+    '''
+    room_names = ['room{}'.format(index) for index in range(SHARED_ROOMS)]
+    changes = {}
+    room = dict(template)
+    for _ in range(operations):
+        room_name = random.choice(room_names)
+        choice = random.random()
+        if choice >= 0.8:
+            try:
+                storage.get_room_data(room_name)
+            except KeyError:
+                pass
+            continue
+        with sequence.get_lock():
+            sequence.value += 1
+            if choice < 0.5:
+                room['room'] = room_name
+                room['writer'] = [worker, sequence.value]
+                storage.commit_room(USER_NAME, json.dumps(room))
+                changes[room_name] = (sequence.value, room['writer'])
+            else:
+                try:
+                    storage.uncommit_room(USER_NAME, room_name)
+                    changes[room_name] = (sequence.value, None)
+                except map_server.IceGauntlet.RoomNotExists:
+                    # Not stored as far as this process knows, nothing is journaled
+                    pass
+            storage.flush()
+    storage.commit_manager('manager-{}'.format(worker))
+    return changes
+
+
+def merge_changes(expected, changes):
+    '''Keeps in expected the latest change of every room'''
+    for room_name, change in changes.items():
+        if room_name not in expected or expected[room_name][0] < change[0]:
+            expected[room_name] = change
+
+
+def run_process(workdir, compact_records, first_worker, threads, operations, sequence, results):
+    '''Runs threads workers on a MapStorage of its own over the shared files'''
+    storage = build_storage(workdir, compact_records)
+    changes = run_threads(storage, first_worker, threads, operations, sequence)
+    storage.close()
+    results.put(changes)
+
+
+def run_threads(storage, first_worker, threads, operations, sequence):
+    '''Runs threads workers on storage, returns the latest change of every room'''
+    template = load_template()
+    expected = {}
+    lock = threading.Lock()
+
+    def work(worker):
+        changes = run_worker(storage, worker, operations, template, sequence)
+        with lock:
+            merge_changes(expected, changes)
+
+    workers = [threading.Thread(target=work, args=(first_worker + index,))
+               for index in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return expected
+
+
+def check(workdir, expected, workers):
+    '''Reloads the files and returns the differences with the expected rooms'''
+    storage = build_storage(workdir, map_server.COMPACT_RECORDS)
+    stored = {room_name: json.loads(storage.get_room_data(room_name))['writer']
+              for room_name in storage.get_rooms()}
+    managers = set(storage.get_managers())
+    storage.close()
+    errors = []
+    for room_name in sorted(set(expected) | set(stored)):
+        writer = expected[room_name][1] if room_name in expected else None
+        if writer != stored.get(room_name):
+            errors.append('{}: expected {}, stored {}'.format(
+                room_name, writer, stored.get(room_name)))
+    for worker in range(workers):
+        if 'manager-{}'.format(worker) not in managers:
+            errors.append('manager-{} lost'.format(worker))
+    return errors
+
+
+def main():
+    '''Runs the stress test'''
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--threads', type=int, default=8, help='threads per process')
+    parser.add_argument('--operations', type=int, default=500, help='operations per thread')
+    parser.add_argument('--compact-records', type=int, default=10)
+    args = parser.parse_args()
+
+    failed = False
+    with tempfile.TemporaryDirectory() as workdir:
+        storage = build_storage(workdir, args.compact_records)
+        start = time.perf_counter()
+        expected = run_threads(storage, 0, args.threads, args.operations,
+                               multiprocessing.Value('q', 0))
+        storage.close()
+        elapsed = time.perf_counter() - start
+        errors = check(workdir, expected, args.threads)
+        print('threads:   {} x {} ops in {:.2f} s ({:.0f} ops/s), {} errors'.format(
+            args.threads, args.operations, elapsed,
+            args.threads * args.operations / elapsed, len(errors)))
+        failed |= bool(errors)
+        for error in errors[:10]:
+            print('  ' + error)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        results = multiprocessing.Queue()
+        sequence = multiprocessing.Value('q', 0)
+        start = time.perf_counter()
+        processes = [multiprocessing.Process(target=run_process, args=(
+            workdir, args.compact_records, number * args.threads, args.threads,
+            args.operations, sequence, results)) for number in range(args.processes)]
+        for process in processes:
+            process.start()
+        expected = {}
+        for _ in processes:
+            merge_changes(expected, results.get())
+        for process in processes:
+            process.join()
+        elapsed = time.perf_counter() - start
+        workers = args.processes * args.threads
+        errors = check(workdir, expected, workers)
+        print('processes: {} x {} x {} ops in {:.2f} s ({:.0f} ops/s), {} errors'.format(
+            args.processes, args.threads, args.operations, elapsed,
+            workers * args.operations / elapsed, len(errors)))
+        failed |= bool(errors)
+        for error in errors[:10]:
+            print('  ' + error)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+    Benchmark of a fresh RoomManager catching up with a large catalogue
+'''
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT_DIR, 'src'))
+os.chdir(ROOT_DIR)
+
+# pylint: disable=C0413
+import Ice
+import map_server
+
+
+def build_storage(workdir, name, room_count=0):
+    '''Returns a loaded MapStorage with room_count synthetic rooms'''
+    storage = map_server.MapStorage(
+        rooms_file=os.path.join(workdir, '{}.json'.format(name)),
+        managers_file=os.path.join(workdir, '{}-managers.json'.format(name)),
+        journal_file=os.path.join(workdir, '{}.journal'.format(name)),
+        fsync_policy='never'
+    )
+    storage.load()
+    with open(os.path.join(ROOT_DIR, 'rooms.json')) as roomsfile:
+        template = list(list(json.load(roomsfile).values())[0].values())[0]
+    for index in range(room_count):
+        template['room'] = 'room{}'.format(index)
+        storage.commit_room('user{}'.format(index % 10), json.dumps(template))
+    return storage
+
+
+def serial_bootstrap(remote_manager, storage):
+    '''Catch-up as it was done before getRooms: one getRoom and commit per room'''
+    for room in remote_manager.availableRooms():
+        aux_dict = json.loads(room)
+        room_name = list(aux_dict.keys())[0]
+        storage.commit_room_event(aux_dict[room_name], remote_manager.getRoom(room_name))
+
+
+def main():
+    '''Runs the benchmark'''
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rooms', type=int, default=1000)
+    parser.add_argument('--batch-size', type=int, default=map_server.FETCH_BATCH_SIZE)
+    parser.add_argument('--parallelism', type=int, default=map_server.FETCH_PARALLELISM)
+    args = parser.parse_args()
+
+    init_data = Ice.InitializationData()
+    init_data.properties = Ice.createProperties()
+    init_data.properties.setProperty('BenchAdapter.Endpoints', 'tcp -h 127.0.0.1')
+    init_data.properties.setProperty('Ice.ThreadPool.Server.Size', '4')
+    init_data.properties.setProperty('RoomManagerSync.FetchBatchSize', str(args.batch_size))
+    init_data.properties.setProperty('RoomManagerSync.FetchParallelism', str(args.parallelism))
+
+    with Ice.initialize(init_data) as broker, tempfile.TemporaryDirectory() as workdir:
+        adapter = broker.createObjectAdapter('BenchAdapter')
+        adapter.activate()
+        source = build_storage(workdir, 'source', args.rooms)
+        manager = map_server.RoomManager(broker, None, source, map_server.TokenCache(), '')
+        remote_manager = map_server.IceGauntlet.RoomManagerPrx.uncheckedCast(
+            adapter.addWithUUID(manager))
+
+        serial_target = build_storage(workdir, 'serial')
+        start = time.perf_counter()
+        serial_bootstrap(remote_manager, serial_target)
+        serial = time.perf_counter() - start
+
+        batched_target = build_storage(workdir, 'batched')
+        sync = map_server.IceGauntlet.RoomManagerSyncPrx.uncheckedCast(
+            adapter.addWithUUID(map_server.RoomManagerSync(None, broker, batched_target)))
+        start = time.perf_counter()
+        # newRoom is dispatched asynchronously and only returns once the catch-up is done
+        sync.newRoom('', str(remote_manager))
+        batched = time.perf_counter() - start
+
+        assert len(batched_target.get_rooms()) == args.rooms
+        print('rooms: {}, batch size: {}, parallelism: {}'.format(
+            args.rooms, args.batch_size, args.parallelism))
+        print('serial getRoom:  {:8.3f} s'.format(serial))
+        print('batched getRooms: {:7.3f} s'.format(batched))
+        for storage in (source, serial_target, batched_target):
+            storage.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,331 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+    Binary event frames for DungeonAreaSync.fireEvent
+
+    Publishers queue events in an EventBatcher, which coalesces position
+    updates of the same entity and sends the pending events once per flush
+    interval, split in frames that fit the event count field and stay below
+    Ice.MessageSizeMax. Subscribers hand the frames to a FrameReceiver,
+    which drops duplicates, reports sequence gaps and applies the events.
+
+    Frame layout (big endian):
+        magic (4s) | format version (B) | sequence (Q) | oldest event time (d)
+        | event count (H) | events
+
+    Every event starts with its kind (B); strings are a length (H) plus
+    utf-8 bytes and positions are two signed ints (i).
+'''
+
+import time
+import uuid
+import logging
+import struct
+import threading
+import collections
+
+import dungeon_engine
+
+MAGIC = b'IGEV'
+FORMAT_VERSION = 1
+
+FRAME_HEADER = struct.Struct('>4sBQdH')
+STRING_SIZE = struct.Struct('>H')
+POSITION = struct.Struct('>ii')
+INTEGER = struct.Struct('>i')
+KIND = struct.Struct('>B')
+
+MOVE_ACTOR = 1
+SPAWN_ACTOR = 2
+REMOVE_ACTOR = 3
+MOVE_ITEM = 4
+PUT_ITEM = 5
+TAKE_ITEM = 6
+SET_TILE = 7
+
+# Kinds whose last event replaces the previous ones of the same entity
+COALESCED_KINDS = frozenset((MOVE_ACTOR, MOVE_ITEM))
+
+# Seconds between flushes, largest number of events and bytes in a frame
+FLUSH_INTERVAL = 0.05
+MAX_FRAME_EVENTS = 0xFFFF
+MAX_FRAME_BYTES = 512 * 1024
+
+# value is the attributes of SPAWN_ACTOR, the item type of PUT_ITEM and the
+# tile of SET_TILE (whose entity_id is empty)
+Event = collections.namedtuple('Event', ['kind', 'entity_id', 'pos_x', 'pos_y', 'value'])
+
+
+class InvalidFrame(Exception):
+    '''The bytes are not an event frame'''
+
+
+def move_actor(actor_id, pos_x, pos_y):
+    '''Returns a MOVE_ACTOR event'''
+    return Event(MOVE_ACTOR, actor_id, pos_x, pos_y, None)
+
+
+def spawn_actor(actor_id, pos_x, pos_y, attributes=''):
+    '''Returns a SPAWN_ACTOR event'''
+    return Event(SPAWN_ACTOR, actor_id, pos_x, pos_y, attributes)
+
+
+def remove_actor(actor_id):
+    '''Returns a REMOVE_ACTOR event'''
+    return Event(REMOVE_ACTOR, actor_id, 0, 0, None)
+
+
+def move_item(item_id, pos_x, pos_y):
+    '''Returns a MOVE_ITEM event'''
+    return Event(MOVE_ITEM, item_id, pos_x, pos_y, None)
+
+
+def put_item(item_id, item_type, pos_x, pos_y):
+    '''Returns a PUT_ITEM event'''
+    return Event(PUT_ITEM, item_id, pos_x, pos_y, item_type)
+
+
+def take_item(item_id):
+    '''Returns a TAKE_ITEM event'''
+    return Event(TAKE_ITEM, item_id, 0, 0, None)
+
+
+def set_tile(pos_x, pos_y, tile):
+    '''Returns a SET_TILE event'''
+    return Event(SET_TILE, '', pos_x, pos_y, tile)
+
+
+def _pack_string_(chunks, text):
+    data = text.encode('utf-8')
+    chunks.append(STRING_SIZE.pack(len(data)))
+    chunks.append(data)
+
+
+def encode_event(event):
+    '''Returns the bytes of an event inside a frame'''
+    chunks = [KIND.pack(event.kind)]
+    if event.kind != SET_TILE:
+        _pack_string_(chunks, event.entity_id)
+    if event.kind not in (REMOVE_ACTOR, TAKE_ITEM):
+        chunks.append(POSITION.pack(event.pos_x, event.pos_y))
+        if event.kind == SPAWN_ACTOR:
+            _pack_string_(chunks, event.value)
+        elif event.kind in (PUT_ITEM, SET_TILE):
+            chunks.append(INTEGER.pack(event.value))
+    return b''.join(chunks)
+
+
+def _frame_from_encoded_(sequence, timestamp, encoded_events):
+    header = FRAME_HEADER.pack(MAGIC, FORMAT_VERSION, sequence, timestamp, len(encoded_events))
+    return header + b''.join(encoded_events)
+
+
+def encode_frame(sequence, timestamp, events):
+    '''Returns the frame carrying events'''
+    return _frame_from_encoded_(sequence, timestamp, [encode_event(event) for event in events])
+
+
+def split_events(encoded_events, max_events=MAX_FRAME_EVENTS, max_bytes=MAX_FRAME_BYTES):
+    '''Groups encoded events in runs that fit in one frame each'''
+    batch = []
+    size = FRAME_HEADER.size
+    for encoded in encoded_events:
+        if batch and (len(batch) >= max_events or size + len(encoded) > max_bytes):
+            yield batch
+            batch = []
+            size = FRAME_HEADER.size
+        batch.append(encoded)
+        size += len(encoded)
+    if batch:
+        yield batch
+
+
+def decode_frame(frame):
+    '''Returns (sequence, oldest event time, events) of a frame'''
+    frame = bytes(frame)
+    try:
+        magic, version, sequence, timestamp, count = FRAME_HEADER.unpack_from(frame)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise InvalidFrame('Unknown format')
+        offset = FRAME_HEADER.size
+        events = []
+        for _ in range(count):
+            kind, = KIND.unpack_from(frame, offset)
+            offset += KIND.size
+            entity_id = ''
+            if kind != SET_TILE:
+                entity_id, offset = _unpack_string_(frame, offset)
+            pos_x = pos_y = 0
+            value = None
+            if kind not in (REMOVE_ACTOR, TAKE_ITEM):
+                pos_x, pos_y = POSITION.unpack_from(frame, offset)
+                offset += POSITION.size
+                if kind == SPAWN_ACTOR:
+                    value, offset = _unpack_string_(frame, offset)
+                elif kind in (PUT_ITEM, SET_TILE):
+                    value, = INTEGER.unpack_from(frame, offset)
+                    offset += INTEGER.size
+            events.append(Event(kind, entity_id, pos_x, pos_y, value))
+    except (struct.error, UnicodeDecodeError) as error:
+        raise InvalidFrame(str(error))
+    return sequence, timestamp, events
+
+
+def _unpack_string_(frame, offset):
+    size, = STRING_SIZE.unpack_from(frame, offset)
+    offset += STRING_SIZE.size
+    if offset + size > len(frame):
+        raise InvalidFrame('Truncated string')
+    return frame[offset:offset + size].decode('utf-8'), offset + size
+
+
+def apply_events(area, events):
+    '''Applies decoded events to a dungeon_engine.Area'''
+    # A frame is applied as a whole, readers never see half of it
+    with area.lock:
+        for event in events:
+            if event.kind == MOVE_ACTOR:
+                area.move_actor(event.entity_id, event.pos_x, event.pos_y)
+            elif event.kind == SPAWN_ACTOR:
+                area.put_actor(dungeon_engine.ActorRecord(
+                    event.entity_id, event.value, event.pos_x, event.pos_y))
+            elif event.kind == REMOVE_ACTOR:
+                area.remove_actor(event.entity_id)
+            elif event.kind == MOVE_ITEM:
+                area.move_item(event.entity_id, event.pos_x, event.pos_y)
+            elif event.kind == PUT_ITEM:
+                area.put_item(dungeon_engine.ItemRecord(
+                    event.entity_id, event.value, event.pos_x, event.pos_y))
+            elif event.kind == TAKE_ITEM:
+                area.take_item(event.entity_id)
+            elif event.kind == SET_TILE and area.grid.contains(event.pos_x, event.pos_y):
+                area.set_tile(event.pos_x, event.pos_y, event.value)
+
+
+class EventBatcher:
+    '''Coalesces events and publishes them once per flush interval'''
+    def __init__(self, publish, sender_id=None, flush_interval=FLUSH_INTERVAL,
+                 max_events=MAX_FRAME_EVENTS, max_bytes=MAX_FRAME_BYTES):
+        '''publish(frame, sender_id) sends a frame, usually DungeonAreaSyncPrx.fireEvent'''
+        self.publish = publish
+        # Receivers track sequences by sender, so every batcher needs its own
+        self.sender_id = sender_id or uuid.uuid4().hex
+        self.flush_interval = flush_interval
+        # The event count of a frame is an unsigned short
+        self.max_events = min(max_events, MAX_FRAME_EVENTS)
+        self.max_bytes = max_bytes
+        self.sequence = 0
+        self.events_added = 0
+        self.events_sent = 0
+        self.frames_sent = 0
+        self._pending_ = []
+        # (kind, entity id) -> index in _pending_ of its coalesced event
+        self._coalesced_ = {}
+        self._oldest_ = None
+        self._lock_ = threading.Lock()
+        self._publish_lock_ = threading.Lock()
+        self._wakeup_ = threading.Condition(self._lock_)
+        self._closed_ = False
+        self._flusher_ = None
+
+    def start(self):
+        '''Starts the background flusher'''
+        self._closed_ = False
+        self._flusher_ = threading.Thread(target=self._flush_loop_, daemon=True)
+        self._flusher_.start()
+
+    def stop(self):
+        '''Stops the flusher and sends the pending events'''
+        with self._lock_:
+            self._closed_ = True
+            self._wakeup_.notify()
+        if self._flusher_ is not None:
+            self._flusher_.join()
+            self._flusher_ = None
+        self.flush()
+
+    def add(self, event):
+        '''Queues an event for the next frame'''
+        with self._lock_:
+            self.events_added += 1
+            if self._oldest_ is None:
+                self._oldest_ = time.time()
+            if event.kind in COALESCED_KINDS:
+                key = (event.kind, event.entity_id)
+                index = self._coalesced_.get(key)
+                if index is not None:
+                    self._pending_[index] = event
+                    return
+                self._coalesced_[key] = len(self._pending_)
+            else:
+                # Later moves must not jump before this event
+                self._coalesced_.pop((MOVE_ACTOR, event.entity_id), None)
+                self._coalesced_.pop((MOVE_ITEM, event.entity_id), None)
+            self._pending_.append(event)
+            if len(self._pending_) >= self.max_events:
+                self._wakeup_.notify()
+
+    def flush(self):
+        '''Publishes the pending events, in as many frames as they need'''
+        with self._publish_lock_:
+            with self._lock_:
+                if not self._pending_:
+                    return
+                events = self._pending_
+                oldest = self._oldest_
+                self._pending_ = []
+                self._coalesced_ = {}
+                self._oldest_ = None
+            encoded_events = [encode_event(event) for event in events]
+            # Sequences must reach the channel in order, so publish holding _publish_lock_
+            for batch in split_events(encoded_events, self.max_events, self.max_bytes):
+                with self._lock_:
+                    sequence = self.sequence
+                    self.sequence += 1
+                    self.events_sent += len(batch)
+                    self.frames_sent += 1
+                self.publish(_frame_from_encoded_(sequence, oldest, batch), self.sender_id)
+
+    def _flush_loop_(self):
+        while True:
+            with self._lock_:
+                if self._closed_:
+                    return
+                self._wakeup_.wait(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as error:  # pylint: disable=broad-except
+                # Receivers report the lost frames as a gap, later frames must still go out
+                logging.error('Cannot publish area events: %s', error)
+
+
+class FrameReceiver:
+    '''Applies the frames of every sender in sequence order'''
+    def __init__(self, apply, on_gap=None):
+        '''apply(events, oldest event time) applies a frame, on_gap(sender, expected, got)'''
+        self.apply = apply
+        self.on_gap = on_gap
+        self.frames = 0
+        self.gaps = 0
+        self.duplicates = 0
+        # sender id -> next expected sequence
+        self._expected_ = {}
+        self._lock_ = threading.Lock()
+
+    def receive(self, frame, sender_id):
+        '''Decodes and applies a frame, returns False if it was a duplicate'''
+        sequence, timestamp, events = decode_frame(frame)
+        with self._lock_:
+            expected = self._expected_.get(sender_id)
+            if expected is not None and sequence < expected:
+                self.duplicates += 1
+                return False
+            self._expected_[sender_id] = sequence + 1
+            self.frames += 1
+            if expected is not None and sequence > expected:
+                self.gaps += 1
+                if self.on_gap is not None:
+                    self.on_gap(sender_id, expected, sequence)
+            self.apply(events, timestamp)
+        return True
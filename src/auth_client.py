@@ -13,7 +13,8 @@ import getpass
 import hashlib
 
 import Ice
-Ice.loadSlice('icegauntlet.ice')
+import slice_stubs
+slice_stubs.load_slice()
 # pylint: disable=E0401
 # pylint: disable=C0413
 import IceGauntlet
@@ -9,104 +9,403 @@
 
 import sys
 import json
+import base64
+import bisect
 import random
 import signal
 import string
+import sqlite3
+import hashlib
 import logging
 import os.path
+import threading
 
 import Ice
+import IceStorm
 Ice.loadSlice('icegauntlet.ice')
 # pylint: disable=E0401
 # pylint: disable=C0413
 import IceGauntlet
+import signed_tokens
+import instrumentation
 
 
 USERS_FILE = 'users.json'
 PASSWORD_HASH = 'password_hash'
 CURRENT_TOKEN = 'current_token'
+# Number of signed tokens issued to the user, older generations are revoked
+GENERATION = 'generation'
 TOKEN_SIZE = 40
+REVOCATION_TOPIC = 'TokenRevocationChannel'
 
+# Separates the random part of a token from its encoded owner
+TOKEN_SEPARATOR = '.'
+# Points of every shard in the hash ring
+SHARD_VNODES = 128
+DEFAULT_SHARD = 'auth_shard'
 
-def _build_token_():
+
+def _build_token_(user=None):
     valid_chars = string.digits + string.ascii_letters
-    return ''.join([random.choice(valid_chars) for _ in range(TOKEN_SIZE)])
+    token = ''.join([random.choice(valid_chars) for _ in range(TOKEN_SIZE)])
+    if user is None:
+        return token
+    encoded_user = base64.urlsafe_b64encode(user.encode('utf-8')).decode('ascii').rstrip('=')
+    return '{}{}{}'.format(token, TOKEN_SEPARATOR, encoded_user)
+
+
+def token_owner(token):
+    '''Returns the user encoded in a token, None for tokens without owner'''
+    if signed_tokens.is_signed(token):
+        fields = signed_tokens.parse_token(token)
+        return fields[0] if fields else None
+    _, separator, encoded_user = token.partition(TOKEN_SEPARATOR)
+    if not separator:
+        return None
+    try:
+        return base64.urlsafe_b64decode(
+            encoded_user + '=' * (-len(encoded_user) % 4)).decode('utf-8')
+    except (ValueError, UnicodeDecodeError):
+        return None
+
+
+class HashRing:
+    '''Consistent hashing of user names over shard names'''
+    def __init__(self, shards, vnodes=SHARD_VNODES):
+        self.shards = list(shards)
+        # Sorted (point, shard), every shard owns the arc ending at its points
+        self._points_ = sorted(
+            (self._hash_('{}#{}'.format(shard, vnode)), shard)
+            for shard in self.shards for vnode in range(vnodes)
+        )
+        self._keys_ = [point for point, _ in self._points_]
+
+    @staticmethod
+    def _hash_(key):
+        return int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:8], 'big')
+
+    def shard(self, user):
+        '''Returns the shard owning a user'''
+        index = bisect.bisect(self._keys_, self._hash_(user)) % len(self._keys_)
+        return self._points_[index][1]
+
+
+class UserStore:
+    '''SQLite table of users where every write gets a new version
+
+    Triggers stamp the versions, so rows changed by other processes (for
+    example with the sqlite3 shell) are found by changes_since too.
+    '''
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS users (
+            name TEXT PRIMARY KEY, data TEXT NOT NULL, version INTEGER NOT NULL DEFAULT 0);
+        CREATE TABLE IF NOT EXISTS deleted_users (name TEXT, version INTEGER NOT NULL);
+        CREATE TABLE IF NOT EXISTS store_version (version INTEGER NOT NULL);
+        CREATE TABLE IF NOT EXISTS imported_users (name TEXT PRIMARY KEY, data TEXT NOT NULL);
+        INSERT INTO store_version SELECT 0 WHERE NOT EXISTS (SELECT * FROM store_version);
+        CREATE TRIGGER IF NOT EXISTS user_inserted AFTER INSERT ON users BEGIN
+            UPDATE store_version SET version = version + 1;
+            UPDATE users SET version = (SELECT version FROM store_version) WHERE name = NEW.name;
+        END;
+        CREATE TRIGGER IF NOT EXISTS user_updated AFTER UPDATE OF data ON users BEGIN
+            UPDATE store_version SET version = version + 1;
+            UPDATE users SET version = (SELECT version FROM store_version) WHERE name = NEW.name;
+        END;
+        CREATE TRIGGER IF NOT EXISTS user_deleted AFTER DELETE ON users BEGIN
+            UPDATE store_version SET version = version + 1;
+            INSERT INTO deleted_users SELECT OLD.name, version FROM store_version;
+        END;
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self._connection_ = sqlite3.connect(path, check_same_thread=False)
+        self._connection_.execute('PRAGMA journal_mode=WAL')
+        self._connection_.execute('PRAGMA synchronous=NORMAL')
+        self._connection_.executescript(self.SCHEMA)
+        self._lock_ = threading.Lock()
+
+    def put(self, user_name, user):
+        '''Inserts or replaces a user, returns the version of the write'''
+        with self._lock_, self._connection_:
+            self._connection_.execute(
+                'INSERT INTO users (name, data) VALUES (?, ?) '
+                'ON CONFLICT (name) DO UPDATE SET data = excluded.data',
+                (user_name, json.dumps(user, sort_keys=True)))
+            return self._connection_.execute('SELECT version FROM store_version').fetchone()[0]
+
+    def import_users(self, users):
+        '''Stores the users of a file that are new or changed since their last import
+
+        Only the fields edited in the file replace the stored ones, so tokens
+        and passwords changed through the servant survive edits of other users.
+        Users stored before imports were recorded take the file as it is now.
+        Returns (added, updated).
+        '''
+        added = []
+        updated = []
+        with self._lock_, self._connection_:
+            stored = dict(self._connection_.execute('SELECT name, data FROM users'))
+            imported = dict(self._connection_.execute('SELECT name, data FROM imported_users'))
+            for user_name, user in users.items():
+                user_json = json.dumps(user, sort_keys=True)
+                if user_name not in stored:
+                    added.append((user_name, user_json))
+                elif user_name in imported and imported[user_name] != user_json:
+                    data = _merge_edits_(
+                        json.loads(stored[user_name]), json.loads(imported[user_name]), user)
+                    updated.append((json.dumps(data, sort_keys=True), user_name))
+            self._connection_.executemany(
+                'INSERT INTO users (name, data) VALUES (?, ?)', added)
+            self._connection_.executemany(
+                'UPDATE users SET data = ? WHERE name = ? AND data != ?',
+                [(data, user_name, data) for data, user_name in updated])
+            self._connection_.executemany(
+                'INSERT INTO imported_users (name, data) VALUES (?, ?) '
+                'ON CONFLICT (name) DO UPDATE SET data = excluded.data',
+                [(user_name, json.dumps(user, sort_keys=True))
+                 for user_name, user in users.items()])
+        return len(added), len(updated)
+
+    def changes_since(self, version):
+        '''Returns (last version, {user: data} changed, names deleted) after version'''
+        with self._lock_:
+            last_version = self._connection_.execute(
+                'SELECT version FROM store_version').fetchone()[0]
+            if last_version == version:
+                return version, {}, []
+            changed = {
+                user_name: json.loads(data) for user_name, data in self._connection_.execute(
+                    'SELECT name, data FROM users WHERE version > ?', (version,))
+            }
+            deleted = [
+                user_name for user_name, in self._connection_.execute(
+                    'SELECT name FROM deleted_users WHERE version > ?', (version,))
+                if user_name not in changed
+            ]
+        return last_version, changed, deleted
+
+    def close(self):
+        '''Closes the database'''
+        with self._lock_:
+            self._connection_.close()
+
+
+def _merge_edits_(stored, imported, user):
+    '''Returns stored with the fields that changed from imported to user'''
+    generation = stored.get(GENERATION, 0)
+    for key in imported:
+        if key not in user:
+            stored.pop(key, None)
+    for key, value in user.items():
+        if imported.get(key) != value:
+            stored[key] = value
+    if generation:
+        # A lower generation would make revoked signed tokens valid again
+        stored[GENERATION] = max(stored.get(GENERATION, 0), generation)
+    return stored
+
+
+def load_users_file(users_file, owns=None):
+    '''Returns the users of a users.json file, only those owned if owns is given'''
+    with open(users_file, 'r') as contents:
+        users = json.load(contents)
+    if owns is None:
+        return users
+    return {user_name: user for user_name, user in users.items() if owns(user_name)}
 
 
 class AuthenticationI(IceGauntlet.Authentication):
-    '''Authentication servant'''
-    def __init__(self):
+    '''Authentication servant of the users of one shard'''
+    # pylint: disable=R0913
+    def __init__(self, revocation_publisher=None, users_file=None, owns=None, signing_key=None,
+                 max_age=signed_tokens.MAX_AGE):
+        '''owns(user) tells the users of the shard, users_file keeps only those
+
+        With a signing_key the tokens are signed_tokens that servers sharing the
+        key verify without asking, and getOwner rejects them after max_age
+        seconds as the servers do.
+        '''
+        self._revocation_publisher_ = revocation_publisher
+        self.signing_key = signing_key
+        self.max_age = max_age
+        self.owns = owns
+        # JSON file the users are imported from, the database is the one updated
+        self.users_file = users_file or USERS_FILE
+        if not os.path.exists(self.users_file):
+            self.users_file = USERS_FILE
+        self._store_ = UserStore(os.path.splitext(users_file or USERS_FILE)[0] + '.db')
+        self._users_file_mtime_ = None
+        self._version_ = 0
         self._users_ = {}
-        self._active_tokens_ = set()
-        if os.path.exists(USERS_FILE):
-            self.refresh()
-        else:
-            self.__commit__()
+        # current_token -> user_name
+        self._token_owners_ = {}
+        self._lock_ = threading.RLock()
+        self.refresh()
 
     def refresh(self, *args, **kwargs):
-        '''Reload user DB to RAM'''
+        '''Applies to RAM the users changed in the database since the last refresh
+
+        Users added to or edited in the JSON file since it was last read are
+        imported first.
+        '''
         logging.debug('Reloading user database')
-        with open(USERS_FILE, 'r') as contents:
-            self._users_ = json.load(contents)
-        self._active_tokens_ = set([
-            user.get(CURRENT_TOKEN, None) for user in self._users_.values()
-        ])
+        with self._lock_:
+            self._import_users_file_()
+            self._version_, changed, deleted = self._store_.changes_since(self._version_)
+            for user_name, user in changed.items():
+                self._apply_user_(user_name, user)
+            for user_name in deleted:
+                self._apply_user_(user_name, None)
+        logging.debug('%s users changed, %s removed', len(changed), len(deleted))
+
+    def _import_users_file_(self):
+        '''Stores the users of the JSON file that are new or edited since the last import'''
+        if not os.path.exists(self.users_file):
+            return
+        mtime = os.stat(self.users_file).st_mtime_ns
+        if mtime == self._users_file_mtime_:
+            return
+        self._users_file_mtime_ = mtime
+        added, updated = self._store_.import_users(load_users_file(self.users_file, self.owns))
+        logging.debug('%s users imported and %s updated from %s', added, updated, self.users_file)
 
-    def __commit__(self):
+    def _apply_user_(self, user_name, user):
+        '''Replaces a user in RAM keeping the token index, user None removes it'''
+        old_token = self._users_.get(user_name, {}).get(CURRENT_TOKEN, None)
+        new_token = user.get(CURRENT_TOKEN, None) if user else None
+        if old_token and old_token != new_token:
+            self._token_owners_.pop(old_token, None)
+            self._revoke_(old_token)
+        if user is None:
+            self._users_.pop(user_name, None)
+            return
+        self._users_[user_name] = user
+        if new_token:
+            self._token_owners_[new_token] = user_name
+
+    def __commit__(self, user):
+        version = self._store_.put(user, self._users_[user])
+        if version == self._version_ + 1:
+            # Nobody else wrote in between, refresh has nothing to read back
+            self._version_ = version
         logging.debug('User database updated!')
-        with open(USERS_FILE, 'w') as contents:
-            json.dump(self._users_, contents, indent=4, sort_keys=True)
 
     def changePassword(self, user, currentPassHash, newPassHash, current=None):
         '''Set/Change user password'''
         logging.debug(f'Change password requested by {user}')
-        if user not in self._users_:
-            raise IceGauntlet.Unauthorized()
-        current_hash = self._users_[user].get(PASSWORD_HASH, None)
-        if current_hash is None:
-            # User auth is empty
-            self._users_[user][CURRENT_TOKEN] = _build_token_()
-        else:
-            if current_hash != currentPassHash:
+        with self._lock_:
+            if user not in self._users_:
                 raise IceGauntlet.Unauthorized()
-        self._users_[user][PASSWORD_HASH] = newPassHash
-        self.__commit__()
+            current_hash = self._users_[user].get(PASSWORD_HASH, None)
+            if current_hash is None:
+                # User auth is empty
+                self._set_token_(user, self._new_token_(user))
+            else:
+                if current_hash != currentPassHash:
+                    raise IceGauntlet.Unauthorized()
+            self._users_[user][PASSWORD_HASH] = newPassHash
+            self.__commit__(user)
 
     def getNewToken(self, user, passwordHash, current=None):
         '''Create new auth token'''
         logging.debug(f'New token requested by {user}')
-        if user not in self._users_:
-            raise IceGauntlet.Unauthorized()
-        current_hash = self._users_[user].get(PASSWORD_HASH, None)
-        if not current_hash:
-            # User auth is empty
-            raise IceGauntlet.Unauthorized()
-        if current_hash != passwordHash:
+        with self._lock_:
+            if user not in self._users_:
+                raise IceGauntlet.Unauthorized()
+            current_hash = self._users_[user].get(PASSWORD_HASH, None)
+            if not current_hash:
+                # User auth is empty
+                raise IceGauntlet.Unauthorized()
+            if current_hash != passwordHash:
+                raise IceGauntlet.Unauthorized()
+
+            new_token = self._new_token_(user)
+            self._set_token_(user, new_token)
+            self.__commit__(user)
+        return new_token
+
+    def getOwner(self, token, current=None):
+        '''Return if token is active'''
+        try:
+            user = self._token_owners_[token]
+        except KeyError:
             raise IceGauntlet.Unauthorized()
+        if self.signing_key is not None and signed_tokens.is_signed(token):
+            fields = signed_tokens.parse_token(token)
+            if fields is None or signed_tokens.is_expired(fields[1], self.max_age):
+                raise IceGauntlet.Unauthorized()
+        return user
+
+    def _new_token_(self, user):
+        '''Returns a new token of user, bumping its generation if signed'''
+        if self.signing_key is None:
+            return _build_token_(user)
+        generation = self._users_[user].get(GENERATION, 0) + 1
+        self._users_[user][GENERATION] = generation
+        return signed_tokens.build_token(self.signing_key, user, generation)
 
+    def _set_token_(self, user, new_token):
+        '''Replaces the user token keeping the token index up to date'''
         current_token = self._users_[user].get(CURRENT_TOKEN, None)
         if current_token:
-            # pylint: disable=W0702
-            try:
-                self._active_tokens_.remove(current_token)
-            except:
-                # Token is already inactive!
-                pass
-            # pylint: enable=W0702
-        new_token = _build_token_()
+            # Token may be already inactive
+            self._token_owners_.pop(current_token, None)
+            self._revoke_(current_token)
         self._users_[user][CURRENT_TOKEN] = new_token
-        self.__commit__()
-        self._active_tokens_.add(new_token)
-        return new_token
+        self._token_owners_[new_token] = user
 
-    def getOwner(self, token, current=None):
-        '''Return if token is active'''
-        if token not in self._active_tokens_:
-            raise IceGauntlet.Unauthorized
+    def _revoke_(self, token):
+        '''Tells the RoomManagers to forget a token'''
+        if self._revocation_publisher_ is None:
+            return
+        try:
+            self._revocation_publisher_.revoked(token)
+        except Ice.Exception as error:
+            logging.warning('Cannot publish token revocation: %s', error)
+
+class AuthenticationRouter(IceGauntlet.Authentication):
+    '''Sends every request to the shard that owns its user'''
+    def __init__(self, ring, shards, local_shard, local_servant):
+        '''shards maps the name of every remote shard to its AuthenticationPrx'''
+        self.ring = ring
+        self.shards = shards
+        self.local_shard = local_shard
+        self.local_servant = local_servant
+
+    async def changePassword(self, user, currentPassHash, newPassHash, current=None):
+        '''Set/Change user password in the shard of user'''
+        shard = self.ring.shard(user)
+        if shard == self.local_shard:
+            return self.local_servant.changePassword(user, currentPassHash, newPassHash)
+        return await self.shards[shard].changePasswordAsync(user, currentPassHash, newPassHash)
 
-        for user_name in self._users_:
-            if self._users_[user_name][CURRENT_TOKEN] == token:
-                return user_name
+    async def getNewToken(self, user, passwordHash, current=None):
+        '''Create new auth token in the shard of user'''
+        shard = self.ring.shard(user)
+        if shard == self.local_shard:
+            return self.local_servant.getNewToken(user, passwordHash)
+        return await self.shards[shard].getNewTokenAsync(user, passwordHash)
+
+    async def getOwner(self, token, current=None):
+        '''Asks the shard of the user encoded in the token'''
+        user = token_owner(token)
+        if user is not None:
+            shard = self.ring.shard(user)
+            if shard == self.local_shard:
+                return self.local_servant.getOwner(token)
+            return await self.shards[shard].getOwnerAsync(token)
+        # Tokens issued before sharding do not carry their owner
+        try:
+            return self.local_servant.getOwner(token)
+        except IceGauntlet.Unauthorized:
+            pass
+        for shard in self.shards.values():
+            try:
+                return await shard.getOwnerAsync(token)
+            except IceGauntlet.Unauthorized:
+                pass
+        raise IceGauntlet.Unauthorized()
 
 class Server(Ice.Application):
     '''
@@ -117,12 +416,37 @@ class Server(Ice.Application):
         Server loop
         '''
         logging.debug('Initializing server...')
-        servant = AuthenticationI()
+        broker = self.communicator()
+        properties = broker.getProperties()
+        local_shard = properties.getPropertyWithDefault('Auth.ShardId', DEFAULT_SHARD)
+        ring = HashRing(properties.getPropertyAsListWithDefault('Auth.Shards', [local_shard]))
+        if local_shard not in ring.shards:
+            raise RuntimeError('Auth.Shards does not include {}'.format(local_shard))
+        users_file = properties.getPropertyWithDefault(
+            'Auth.UsersFile',
+            USERS_FILE if len(ring.shards) == 1 else 'users-{}.json'.format(local_shard))
+        servant = AuthenticationI(
+            self.get_revocation_publisher(broker), users_file,
+            owns=lambda user: ring.shard(user) == local_shard,
+            signing_key=signed_tokens.load_key(properties.getProperty('SignedTokens.Key')),
+            max_age=properties.getPropertyAsIntWithDefault(
+                'SignedTokens.MaxAge', signed_tokens.MAX_AGE))
+        metrics = instrumentation.from_properties(properties)
+        metrics.instrument(servant, 'AuthenticationI', instrumentation.slice_operations(
+            IceGauntlet.Authentication) + ['refresh', '__commit__', '_revoke_'])
         signal.signal(signal.SIGUSR1, servant.refresh)
 
-        adapter = self.communicator().createObjectAdapter('AuthenticationAdapter')
-        proxy = adapter.add(servant, self.communicator().stringToIdentity('default'))
-        adapter.addDefaultServant(servant, '')
+        shards = self.prepare_shard(broker, servant, ring, local_shard)
+        router = AuthenticationRouter(ring, shards, local_shard, servant)
+        metrics.instrument(router, 'Authentication',
+                           instrumentation.slice_operations(IceGauntlet.Authentication))
+        admin_proxy = instrumentation.serve(broker, metrics)
+        if admin_proxy is not None:
+            logging.info('Metrics: %s', admin_proxy)
+
+        adapter = broker.createObjectAdapter('AuthenticationAdapter')
+        proxy = adapter.add(router, broker.stringToIdentity('default'))
+        adapter.addDefaultServant(router, '')
         adapter.activate()
         logging.debug('Adapter ready, servant proxy: {}'.format(proxy))
         print('"{}"'.format(proxy), flush=True)
@@ -133,6 +457,39 @@ class Server(Ice.Application):
 
         return 0
 
+    @staticmethod
+    def prepare_shard(broker, servant, ring, local_shard):
+        '''Serves the local shard to the other routers, returns the remote shards'''
+        if len(ring.shards) == 1:
+            return {}
+        shard_adapter = broker.createObjectAdapter('AuthShardAdapter')
+        shard_adapter.add(servant, broker.stringToIdentity(local_shard))
+        shard_adapter.activate()
+        return {
+            shard: IceGauntlet.AuthenticationPrx.uncheckedCast(broker.stringToProxy(shard))
+            for shard in ring.shards if shard != local_shard
+        }
+
+    @staticmethod
+    def get_revocation_publisher(broker):
+        '''Returns the TokenRevocation publisher, or None if IceStorm is not configured'''
+        proxy = broker.propertyToProxy('IceStorm.TopicManager.Proxy')
+        if proxy is None:
+            logging.debug('IceStorm not configured, token revocations disabled')
+            return None
+        try:
+            # pylint: disable=E1101
+            topic_mgr = IceStorm.TopicManagerPrx.checkedCast(proxy)
+            try:
+                topic = topic_mgr.retrieve(REVOCATION_TOPIC)
+            except IceStorm.NoSuchTopic:
+                topic = topic_mgr.create(REVOCATION_TOPIC)
+        except Ice.Exception as error:
+            logging.warning('IceStorm not available, token revocations disabled: %s', error)
+            return None
+        publisher = topic.getPublisher().ice_oneway()
+        return IceGauntlet.TokenRevocationPrx.uncheckedCast(publisher)
+
 
 if __name__ == '__main__':
     app = Server()
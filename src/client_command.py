@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+    Command line of the ICE Gauntlet client daemon
+
+    Sends one operation to client_daemon.py through its local socket and
+    prints the answer. It does not import Ice, so it starts as fast as
+    the interpreter does.
+'''
+
+import os
+import sys
+import json
+import socket
+import getpass
+import hashlib
+import argparse
+import tempfile
+
+SOCKET_FILE = os.path.join(tempfile.gettempdir(), 'icegauntlet-client-{}.sock'.format(os.getuid()))
+# Exit code when the daemon is not running
+NO_DAEMON = 10
+# Exit codes of a room rejected by the RoomManager (as map_client.py) and of
+# a request the daemon cannot read
+WRONG_ROOM_FORMAT = 11
+BAD_REQUEST = 12
+
+
+def send_command(command, args, socket_file=SOCKET_FILE):
+    '''Returns the (exit code, output) of running a command in the daemon'''
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        connection.connect(socket_file)
+        connection.sendall(json.dumps({'command': command, 'args': args}).encode('utf-8') + b'\n')
+        with connection.makefile('rb') as answer:
+            reply = json.loads(answer.readline())
+    return reply['code'], reply['output']
+
+
+def hash_pass_str(password):
+    '''Hashes a password as the authentication client does'''
+    password_hasher = hashlib.sha256()
+    password_hasher.update(password.encode())
+    return str(password_hasher.digest())
+
+
+def parse_args():
+    '''Parse the arguments'''
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--socket", default=SOCKET_FILE, help="Socket del demonio")
+    commands = parser.add_subparsers(dest="command", required=True)
+    token = commands.add_parser("token", help="Pedir un nuevo token")
+    token.add_argument("Proxy")
+    token.add_argument("User")
+    token.add_argument("Password", nargs="?", help="Si no se indica se pide por teclado")
+    publish = commands.add_parser("publish", help="Publicar mapa")
+    publish.add_argument("Proxy")
+    publish.add_argument("Token")
+    publish.add_argument("MapFile")
+    remove = commands.add_parser("remove", help="Borrar mapa")
+    remove.add_argument("Proxy")
+    remove.add_argument("Token")
+    remove.add_argument("RoomName")
+    get_room = commands.add_parser("get", help="Leer un mapa")
+    get_room.add_argument("Proxy")
+    get_room.add_argument("RoomName")
+    get_room.add_argument("Session", nargs="?", default="")
+    commands.add_parser("stop", help="Parar el demonio")
+    return parser.parse_args()
+
+
+def main():
+    '''Runs a command in the daemon'''
+    args = parse_args()
+    if args.command == "token":
+        password = args.Password if args.Password is not None else getpass.getpass('Password:')
+        command_args = [args.Proxy, args.User, hash_pass_str(password)]
+    elif args.command == "publish":
+        if args.MapFile[-4:] != "json":
+            print("El archivo seleccionado no es un archivo JSON")
+            return 5
+        with open(args.MapFile) as map_file:
+            command_args = [args.Proxy, args.Token, json.dumps(json.load(map_file))]
+    elif args.command == "remove":
+        command_args = [args.Proxy, args.Token, args.RoomName]
+    elif args.command == "get":
+        command_args = [args.Proxy, args.RoomName, args.Session]
+    else:
+        command_args = []
+
+    try:
+        code, output = send_command(args.command, command_args, args.socket)
+    except (FileNotFoundError, ConnectionRefusedError):
+        print("El demonio no esta en marcha: src/client_daemon.py --Ice.Config=<config>")
+        return NO_DAEMON
+    if output:
+        print(output)
+    if args.command == "token" and code == 0:
+        with open("token.txt", "w") as token_txt:
+            token_txt.write(output)
+        print("También se ha guardado en el archivo token.txt")
+    return code
+
+
+if __name__ == '__main__':
+    sys.exit(main())
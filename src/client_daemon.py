@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# pylint: disable=W0613
+
+'''
+    ICE Gauntlet client daemon
+
+    Keeps the communicator, its connections and the checked proxies alive
+    and runs the operations that client_command.py sends through a local
+    socket, so a script pays the Ice startup once instead of per operation.
+    Answers carry the same messages and exit codes as the clients.
+    Rooms are read through a room_cache.RoomCache per RoomManager, which
+    is subscribed to RoomManagerSyncChannel if IceStorm.TopicManager.Proxy
+    is set.
+'''
+
+import os
+import sys
+import json
+import logging
+import argparse
+import threading
+import socketserver
+
+import Ice
+import slice_stubs
+slice_stubs.load_slice()
+# pylint: disable=E0401
+# pylint: disable=C0413
+import IceGauntlet
+import client_command
+import room_cache
+
+
+class CommandHandler(socketserver.StreamRequestHandler):
+    '''Runs the command of one connection'''
+    def handle(self):
+        # Every request gets an answer, or client_command.py would wait forever
+        try:
+            request = json.loads(self.rfile.readline())
+            command, args = request['command'], request['args']
+        except (ValueError, KeyError, TypeError):
+            code, output = client_command.BAD_REQUEST, "Peticion no valida"
+        else:
+            try:
+                code, output = self.server.daemon.run_command(command, args)
+            except Exception as error:  # pylint: disable=broad-except
+                logging.exception('Command %s failed', command)
+                code, output = client_command.BAD_REQUEST, "Error en el demonio: {}".format(error)
+        self.wfile.write(json.dumps({'code': code, 'output': output}).encode('utf-8') + b'\n')
+
+
+class ClientDaemon(Ice.Application):
+    '''Client daemon'''
+    def __init__(self):
+        super().__init__()
+        # (proxy string, proxy class) -> checked proxy
+        self._proxies_ = {}
+        # RoomManager proxy string -> RoomCache
+        self._caches_ = {}
+        self._cache_adapter_ = None
+        self._lock_ = threading.Lock()
+        self._caches_lock_ = threading.Lock()
+
+    def run(self, argv):
+        properties = self.communicator().getProperties()
+        socket_file = self.parse_args(argv, properties.getPropertyWithDefault(
+            'ClientDaemon.Socket', client_command.SOCKET_FILE)).socket
+        if os.path.exists(socket_file):
+            os.remove(socket_file)
+        # Tokens go through the socket, only the owner may connect from the moment it exists
+        old_umask = os.umask(0o177)
+        try:
+            server = socketserver.ThreadingUnixStreamServer(socket_file, CommandHandler)
+        finally:
+            os.umask(old_umask)
+        server.daemon_threads = True
+        server.daemon = self
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        print('Demonio escuchando en {}'.format(socket_file), flush=True)
+        self.communicator().waitForShutdown()
+        server.shutdown()
+        server.server_close()
+        os.remove(socket_file)
+        for cache in self._caches_.values():
+            cache.unsubscribe()
+        return 0
+
+    @staticmethod
+    def parse_args(argv, socket_file):
+        '''Parse the arguments'''
+        parser = argparse.ArgumentParser()
+        parser.add_argument("--socket", default=socket_file, help="Socket donde recibir comandos")
+        return parser.parse_args(argv[1:])
+
+    def get_proxy(self, proxy_string, proxy_class):
+        '''Returns the checked proxy of proxy_string, reusing it between commands'''
+        key = (proxy_string, proxy_class)
+        with self._lock_:
+            proxy = self._proxies_.get(key)
+        if proxy is None:
+            proxy = proxy_class.checkedCast(self.communicator().stringToProxy(proxy_string))
+            if not proxy:
+                raise RuntimeError('Invalid proxy')
+            with self._lock_:
+                self._proxies_[key] = proxy
+        return proxy
+
+    def forget_proxy(self, proxy_string):
+        '''Drops the checked proxies of proxy_string, they are checked again on next use'''
+        with self._lock_:
+            for key in [key for key in self._proxies_ if key[0] == proxy_string]:
+                del self._proxies_[key]
+
+    def get_cache(self, proxy_string):
+        '''Returns the RoomCache of a RoomManager, subscribing it to the sync events'''
+        room_manager = self.get_proxy(proxy_string, IceGauntlet.RoomManagerPrx)
+        with self._caches_lock_:
+            cache = self._caches_.get(proxy_string)
+            if cache is not None:
+                return cache
+            communicator = self.communicator()
+            cache = room_cache.RoomCache.from_properties(communicator.getProperties(),
+                                                         room_manager)
+            topic_manager = room_cache.topic_manager_from_properties(communicator)
+            if topic_manager is not None:
+                if self._cache_adapter_ is None:
+                    self._cache_adapter_ = communicator.createObjectAdapterWithEndpoints(
+                        'RoomCacheAdapter', communicator.getProperties().getPropertyWithDefault(
+                            'RoomCache.Endpoints', 'tcp'))
+                    self._cache_adapter_.activate()
+                try:
+                    cache.subscribe(topic_manager, self._cache_adapter_)
+                except Ice.Exception as error:
+                    # Without events every read is checked with the servers
+                    print('Cache sin suscripcion: {}'.format(error), flush=True)
+            self._caches_[proxy_string] = cache
+            return cache
+
+    def run_command(self, command, args):
+        '''Returns the (exit code, output) of a command'''
+        # pylint: disable=R0911
+        try:
+            if command == 'token':
+                proxy, user, password_hash = args
+                auth_server = self.get_proxy(proxy, IceGauntlet.AuthenticationPrx)
+                return 0, auth_server.getNewToken(user, password_hash)
+            if command == 'publish':
+                proxy, token, room_data = args
+                self.get_proxy(proxy, IceGauntlet.RoomManagerPrx).publish(token, room_data)
+                return 0, ''
+            if command == 'remove':
+                proxy, token, room_name = args
+                self.get_proxy(proxy, IceGauntlet.RoomManagerPrx).remove(token, room_name)
+                return 0, ''
+            if command == 'get':
+                proxy, room_name, session = args
+                return 0, self.get_cache(proxy).get_room(room_name, session)
+            if command == 'stop':
+                self.communicator().shutdown()
+                return 0, ''
+            return 7, 'Comando desconocido: {}'.format(command)
+        except IceGauntlet.Unauthorized:
+            return 1, "Usuario y/o Contraseña no válida"
+        except IceGauntlet.RoomAlreadyExists:
+            return 2, "Ya existe un mapa con ese nombre y es de otro usuario"
+        except IceGauntlet.RoomNotExists:
+            if command == 'get':
+                return 3, "El mapa solicitado no existe"
+            return 3, "El mapa que estas intentando borrar no existe o es de otra persona"
+        except IceGauntlet.WrongRoomFormat as error:
+            return (client_command.WRONG_ROOM_FORMAT,
+                    "El archivo introducido no es un mapa valido: {}".format(error.reason))
+        except Ice.Exception:
+            self.forget_proxy(args[0])
+            return 4, "Proxy no disponible en este momento\nException: Connection Refused"
+        except RuntimeError:
+            return 7, "Proxy no valido"
+        except (ValueError, TypeError):
+            # Wrong number or kind of arguments
+            return client_command.BAD_REQUEST, "Peticion no valida"
+
+
+if __name__ == '__main__':
+    sys.exit(ClientDaemon().main(sys.argv))
@@ -0,0 +1,592 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+    IceGauntlet game session engine
+
+    A dungeon is a chain of areas, each one built from a stored room. Rooms
+    are parsed once into an immutable AreaTemplate (tile grid, items and
+    entrance) shared by every area built from them; an area only copies the
+    grid or the items when they change.
+
+    Tile conventions of the rooms in rooms.json:
+        255          floor
+        0..18        walls
+        DOOR_TILES   door pieces
+        250          entrance (where players appear)
+        101          exit to the next area
+        other tiles  objects lying on the floor, served as items
+'''
+
+import json
+import uuid
+import random
+import itertools
+import threading
+import collections
+
+import room_codec
+
+FLOOR_TILE = 255
+ENTRANCE_TILE = 250
+EXIT_TILE = 101
+DOOR_TILES = frozenset((19, 20, 22, 23, 26, 28))
+LAST_WALL_TILE = 18
+
+# Areas kept in memory by an engine, the least recently used are dropped
+MAX_AREAS = 10000
+# Parsed rooms kept in memory by an engine
+MAX_TEMPLATES = 512
+# Areas chained in a dungeon, 0 means every available room
+DUNGEON_LENGTH = 0
+# Side in tiles of the buckets of the spatial indexes
+CELL_SIZE = 8
+
+
+class WrongRoom(Exception):
+    '''The room is not a valid tile grid, the message tells why'''
+
+
+def is_object_tile(tile):
+    '''Returns if the tile is an object placed on the floor'''
+    return tile > LAST_WALL_TILE and tile != FLOOR_TILE and tile not in DOOR_TILES
+
+
+class TileGrid:
+    '''Rectangular grid of one byte tiles'''
+    __slots__ = ('width', 'height', 'tiles')
+
+    def __init__(self, width, height, tiles):
+        self.width = width
+        self.height = height
+        self.tiles = tiles
+
+    @classmethod
+    def from_rows(cls, rows):
+        '''Builds a grid from a list of rows of tiles'''
+        width = len(rows[0]) if rows else 0
+        return cls(width, len(rows), bytearray(tile for row in rows for tile in row))
+
+    def copy(self):
+        '''Returns an independent copy of the grid'''
+        return TileGrid(self.width, self.height, bytearray(self.tiles))
+
+    def contains(self, pos_x, pos_y):
+        '''Returns if the position is inside the grid'''
+        return 0 <= pos_x < self.width and 0 <= pos_y < self.height
+
+    def tile(self, pos_x, pos_y):
+        '''Returns the tile at a position'''
+        return self.tiles[pos_y * self.width + pos_x]
+
+    def set_tile(self, pos_x, pos_y, tile):
+        '''Changes the tile at a position'''
+        self.tiles[pos_y * self.width + pos_x] = tile
+
+    def rows(self):
+        '''Returns the grid as a list of rows'''
+        return [
+            list(self.tiles[row * self.width:(row + 1) * self.width])
+            for row in range(self.height)
+        ]
+
+
+class SpatialIndex:
+    '''Uniform grid of CELL_SIZE buckets holding entity ids by position
+
+    Not thread safe: the index of an area is used holding Area.lock.
+    '''
+    __slots__ = ('cell_size', 'cells', 'positions')
+
+    def __init__(self, cell_size=CELL_SIZE):
+        self.cell_size = cell_size
+        # (cell x, cell y) -> set of entity ids
+        self.cells = {}
+        # entity id -> (x, y)
+        self.positions = {}
+
+    def __len__(self):
+        return len(self.positions)
+
+    def copy(self):
+        '''Returns an independent copy of the index'''
+        index = SpatialIndex(self.cell_size)
+        index.cells = {cell: set(entities) for cell, entities in self.cells.items()}
+        index.positions = dict(self.positions)
+        return index
+
+    def _cell_(self, pos_x, pos_y):
+        return (pos_x // self.cell_size, pos_y // self.cell_size)
+
+    def insert(self, entity_id, pos_x, pos_y):
+        '''Adds an entity or moves it to a new position'''
+        previous = self.positions.get(entity_id)
+        if previous is not None:
+            if previous == (pos_x, pos_y):
+                return
+            old_cell = self._cell_(*previous)
+            new_cell = self._cell_(pos_x, pos_y)
+            self.positions[entity_id] = (pos_x, pos_y)
+            if old_cell == new_cell:
+                return
+            self._discard_(old_cell, entity_id)
+        else:
+            new_cell = self._cell_(pos_x, pos_y)
+            self.positions[entity_id] = (pos_x, pos_y)
+        self.cells.setdefault(new_cell, set()).add(entity_id)
+
+    def remove(self, entity_id):
+        '''Removes an entity if present'''
+        previous = self.positions.pop(entity_id, None)
+        if previous is not None:
+            self._discard_(self._cell_(*previous), entity_id)
+
+    def _discard_(self, cell, entity_id):
+        entities = self.cells[cell]
+        entities.discard(entity_id)
+        if not entities:
+            del self.cells[cell]
+
+    def query_range(self, pos_x, pos_y, radius):
+        '''Returns the ids inside the square of the given radius around a position'''
+        min_x, min_y = self._cell_(pos_x - radius, pos_y - radius)
+        max_x, max_y = self._cell_(pos_x + radius, pos_y + radius)
+        found = []
+        for cell_x in range(min_x, max_x + 1):
+            for cell_y in range(min_y, max_y + 1):
+                for entity_id in self.cells.get((cell_x, cell_y), ()):
+                    entity_x, entity_y = self.positions[entity_id]
+                    if abs(entity_x - pos_x) <= radius and abs(entity_y - pos_y) <= radius:
+                        found.append(entity_id)
+        return found
+
+    def nearest(self, pos_x, pos_y, max_radius=None):
+        '''Returns the id closest (euclidean) to a position, None if there is none'''
+        if not self.positions:
+            return None
+        center_x, center_y = self._cell_(pos_x, pos_y)
+        if max_radius is None:
+            max_ring = max(
+                max(abs(cell_x - center_x), abs(cell_y - center_y)) for cell_x, cell_y in self.cells
+            )
+        else:
+            max_ring = max_radius // self.cell_size + 1
+        best_id = None
+        best_distance = None
+        for ring in range(max_ring + 1):
+            # Anything in a further ring is at least (ring - 1) cells away
+            if best_distance is not None and ((ring - 1) * self.cell_size) ** 2 > best_distance:
+                break
+            for cell_x in range(center_x - ring, center_x + ring + 1):
+                for cell_y in range(center_y - ring, center_y + ring + 1):
+                    if max(abs(cell_x - center_x), abs(cell_y - center_y)) != ring:
+                        continue
+                    for entity_id in self.cells.get((cell_x, cell_y), ()):
+                        entity_x, entity_y = self.positions[entity_id]
+                        distance = (entity_x - pos_x) ** 2 + (entity_y - pos_y) ** 2
+                        if best_distance is None or distance < best_distance:
+                            best_id, best_distance = entity_id, distance
+        if max_radius is not None and best_distance is not None \
+           and best_distance > max_radius ** 2:
+            return None
+        return best_id
+
+
+class ActorRecord:
+    '''Actor present in an area'''
+    __slots__ = ('actor_id', 'attributes', 'pos_x', 'pos_y')
+
+    def __init__(self, actor_id, attributes, pos_x=None, pos_y=None):
+        self.actor_id = actor_id
+        self.attributes = attributes
+        self.pos_x = pos_x
+        self.pos_y = pos_y
+
+
+class ItemRecord:
+    '''Item lying in an area'''
+    __slots__ = ('item_id', 'item_type', 'pos_x', 'pos_y')
+
+    def __init__(self, item_id, item_type, pos_x, pos_y):
+        self.item_id = item_id
+        self.item_type = item_type
+        self.pos_x = pos_x
+        self.pos_y = pos_y
+
+
+class AreaTemplate:
+    '''Immutable parsed form of a room shared by the areas built from it'''
+    __slots__ = ('room_name', 'grid', 'items', 'item_index', 'entrance', 'map_data',
+                 'navigation')
+
+    def __init__(self, room_name, grid, items, entrance, navigation=None):
+        self.room_name = room_name
+        self.grid = grid
+        self.items = items
+        self.item_index = SpatialIndex()
+        for item in items.values():
+            self.item_index.insert(item.item_id, item.pos_x, item.pos_y)
+        self.entrance = entrance
+        self.map_data = serialize_map(room_name, grid)
+        # room_navigation.NavigationData of the stored room, if known
+        self.navigation = navigation
+
+    @classmethod
+    def from_binary(cls, blob, navigation=None):
+        '''Builds a template from a room encoded with room_codec'''
+        room_name, height, width, tiles = room_codec.decode_tiles(blob)
+        if tiles is None:
+            room = room_codec.decode_room(blob)
+            grid = TileGrid.from_rows(room.get(room_codec.ROOM_DATA) or [])
+        else:
+            grid = TileGrid(width, height, bytearray(tiles))
+        return cls.from_grid(room_name, grid, navigation)
+
+    @classmethod
+    def from_grid(cls, room_name, grid, navigation=None):
+        '''Moves the objects of the grid to items, leaving floor behind'''
+        items = collections.OrderedDict()
+        entrance = None
+        for index, tile in enumerate(grid.tiles):
+            if not is_object_tile(tile):
+                continue
+            pos_x, pos_y = index % grid.width, index // grid.width
+            grid.tiles[index] = FLOOR_TILE
+            if tile == ENTRANCE_TILE:
+                if entrance is None:
+                    entrance = (pos_x, pos_y)
+                continue
+            item_id = 'item{}'.format(len(items))
+            items[item_id] = ItemRecord(item_id, tile, pos_x, pos_y)
+        return cls(room_name, grid, items, entrance, navigation)
+
+
+def _find_tile_(rows, is_wrong):
+    '''Returns (x, y, tile) of the first tile for which is_wrong(tile) holds'''
+    for pos_y, row in enumerate(rows):
+        for pos_x, tile in enumerate(row):
+            if is_wrong(tile):
+                return pos_x, pos_y, tile
+    return None
+
+
+def validate_room(room):
+    '''Returns the TileGrid of a room dict, raises WrongRoom if it is not playable
+
+    The tiles are packed into the bytearray of the grid in one pass, the
+    slow per-tile scan only runs to describe a room that failed.
+    '''
+    if not isinstance(room, dict):
+        raise WrongRoom('The room is not a JSON object')
+    room_name = room.get(room_codec.ROOM_NAME)
+    if not isinstance(room_name, str) or not room_name:
+        raise WrongRoom('Missing room name')
+    try:
+        room_codec.encode_name(room_name)
+    except room_codec.InvalidRoomName as error:
+        raise WrongRoom(str(error))
+    rows = room.get(room_codec.ROOM_DATA)
+    if not isinstance(rows, list) or not rows:
+        raise WrongRoom('Missing data, it must be a non empty list of rows')
+    if len(rows) > room_codec.MAX_SIDE:
+        raise WrongRoom('Too many rows: {}'.format(len(rows)))
+    if not all(isinstance(row, list) for row in rows):
+        raise WrongRoom('Row {} is not a list'.format(
+            next(index for index, row in enumerate(rows) if not isinstance(row, list))))
+    width = len(rows[0])
+    if not 0 < width <= room_codec.MAX_SIDE:
+        raise WrongRoom('Row 0 has {} tiles'.format(width))
+    for index, row in enumerate(rows):
+        if len(row) != width:
+            raise WrongRoom('Row {} has {} tiles, expected {}'.format(index, len(row), width))
+    tiles = list(itertools.chain.from_iterable(rows))
+    # bool is an int subclass that bytearray would take as 0 or 1
+    if set(map(type, tiles)) != {int}:
+        raise WrongRoom('Tile ({}, {}) is not an integer: {!r}'.format(
+            *_find_tile_(rows, lambda tile: type(tile) is not int)))  # pylint: disable=C0123
+    try:
+        tiles = bytearray(tiles)
+    except ValueError:
+        raise WrongRoom('Tile ({}, {}) is out of range 0..255: {}'.format(
+            *_find_tile_(rows, lambda tile: not 0 <= tile <= 255)))
+    if ENTRANCE_TILE not in tiles:
+        raise WrongRoom('Missing entrance tile ({})'.format(ENTRANCE_TILE))
+    if EXIT_TILE not in tiles:
+        raise WrongRoom('Missing exit tile ({})'.format(EXIT_TILE))
+    return TileGrid(width, len(rows), tiles)
+
+
+def serialize_map(room_name, grid):
+    '''Returns the JSON served by getMap'''
+    return json.dumps({room_codec.ROOM_DATA: grid.rows(), room_codec.ROOM_NAME: room_name})
+
+
+class Area:
+    '''Running instance of a room inside a dungeon
+
+    Event frames change an area while requests read it from other threads,
+    so both hold its lock.
+    '''
+    __slots__ = ('area_id', 'dungeon', 'index', 'template', 'grid', 'items', 'item_index',
+                 'actors', 'actor_index', 'next_area_id', 'receiver', 'navigation',
+                 'lock', '_map_data_')
+
+    def __init__(self, area_id, dungeon, index, template):
+        self.area_id = area_id
+        self.dungeon = dungeon
+        self.index = index
+        self.template = template
+        # Shared with the template until the area changes them
+        self.grid = template.grid
+        self.items = template.items
+        self.item_index = template.item_index
+        self.actors = collections.OrderedDict()
+        self.actor_index = SpatialIndex()
+        self.next_area_id = None
+        # area_events.FrameReceiver, set once the area has an event channel
+        self.receiver = None
+        # room_navigation.NavigationData, built on the first path query
+        self.navigation = None
+        self.lock = threading.RLock()
+        self._map_data_ = template.map_data
+
+    @property
+    def room_name(self):
+        '''Name of the room the area was built from'''
+        return self.template.room_name
+
+    @property
+    def entrance(self):
+        '''Position where players appear'''
+        return self.template.entrance
+
+    def get_map(self):
+        '''Returns the cached JSON of the area map'''
+        with self.lock:
+            if self._map_data_ is None:
+                self._map_data_ = serialize_map(self.room_name, self.grid)
+            return self._map_data_
+
+    def set_tile(self, pos_x, pos_y, tile):
+        '''Changes a tile (for example opening a door)'''
+        with self.lock:
+            if self.grid is self.template.grid:
+                self.grid = self.grid.copy()
+            self.grid.set_tile(pos_x, pos_y, tile)
+            self._map_data_ = None
+            self.navigation = None
+
+    def get_items(self):
+        '''Returns the items of the area'''
+        with self.lock:
+            return list(self.items.values())
+
+    def put_item(self, item):
+        '''Adds or replaces an item'''
+        with self.lock:
+            self._own_items_()
+            self.items[item.item_id] = item
+            self.item_index.insert(item.item_id, item.pos_x, item.pos_y)
+
+    def move_item(self, item_id, pos_x, pos_y):
+        '''Moves an item, returns it or None if it does not exist'''
+        with self.lock:
+            self._own_items_()
+            item = self.items.get(item_id)
+            if item is not None:
+                item.pos_x, item.pos_y = pos_x, pos_y
+                self.item_index.insert(item_id, pos_x, pos_y)
+            return item
+
+    def take_item(self, item_id):
+        '''Removes an item, returns it or None'''
+        with self.lock:
+            self._own_items_()
+            self.item_index.remove(item_id)
+            return self.items.pop(item_id, None)
+
+    def _own_items_(self):
+        if self.items is self.template.items:
+            self.items = collections.OrderedDict(
+                (item_id, ItemRecord(item.item_id, item.item_type, item.pos_x, item.pos_y))
+                for item_id, item in self.items.items()
+            )
+            self.item_index = self.item_index.copy()
+
+    def items_near(self, pos_x, pos_y, radius):
+        '''Returns the items inside the square of the given radius around a position'''
+        with self.lock:
+            return [
+                self.items[item_id]
+                for item_id in self.item_index.query_range(pos_x, pos_y, radius)
+            ]
+
+    def nearest_item(self, pos_x, pos_y, max_radius=None):
+        '''Returns the item closest to a position or None'''
+        with self.lock:
+            item_id = self.item_index.nearest(pos_x, pos_y, max_radius)
+            return None if item_id is None else self.items[item_id]
+
+    def get_actors(self):
+        '''Returns the actors of the area'''
+        with self.lock:
+            return list(self.actors.values())
+
+    def put_actor(self, actor):
+        '''Adds or updates an actor'''
+        with self.lock:
+            self.actors[actor.actor_id] = actor
+            if actor.pos_x is None:
+                self.actor_index.remove(actor.actor_id)
+            else:
+                self.actor_index.insert(actor.actor_id, actor.pos_x, actor.pos_y)
+
+    def move_actor(self, actor_id, pos_x, pos_y):
+        '''Moves an actor, returns it or None if it does not exist'''
+        with self.lock:
+            actor = self.actors.get(actor_id)
+            if actor is not None:
+                actor.pos_x, actor.pos_y = pos_x, pos_y
+                self.actor_index.insert(actor_id, pos_x, pos_y)
+            return actor
+
+    def remove_actor(self, actor_id):
+        '''Removes an actor, returns it or None'''
+        with self.lock:
+            self.actor_index.remove(actor_id)
+            return self.actors.pop(actor_id, None)
+
+    def actors_near(self, pos_x, pos_y, radius):
+        '''Returns the actors inside the square of the given radius around a position'''
+        with self.lock:
+            return [
+                self.actors[actor_id]
+                for actor_id in self.actor_index.query_range(pos_x, pos_y, radius)
+            ]
+
+    def nearest_actor(self, pos_x, pos_y, max_radius=None):
+        '''Returns the actor closest to a position or None'''
+        with self.lock:
+            actor_id = self.actor_index.nearest(pos_x, pos_y, max_radius)
+            return None if actor_id is None else self.actors[actor_id]
+
+
+class DungeonRun:
+    '''Rooms chained in one dungeon'''
+    __slots__ = ('dungeon_id', 'room_names')
+
+    def __init__(self, dungeon_id, room_names):
+        self.dungeon_id = dungeon_id
+        self.room_names = room_names
+
+
+class DungeonEngine:
+    '''Creates dungeons and keeps a bounded set of live areas'''
+    # pylint: disable=R0913
+    def __init__(self, room_names, room_loader, max_areas=MAX_AREAS,
+                 max_templates=MAX_TEMPLATES, dungeon_length=DUNGEON_LENGTH,
+                 navigation_loader=None, grid_loader=None):
+        '''room_names() lists the available rooms, room_loader(name) returns its binary
+
+        navigation_loader(name), if given, returns the precomputed navigation data
+        and grid_loader(name) the already validated TileGrid (None to decode the binary).
+        '''
+        self.room_names = room_names
+        self.room_loader = room_loader
+        self.navigation_loader = navigation_loader
+        self.grid_loader = grid_loader
+        self.max_areas = max_areas
+        self.max_templates = max_templates
+        self.dungeon_length = dungeon_length
+        self._areas_ = collections.OrderedDict()
+        self._templates_ = collections.OrderedDict()
+        self._evict_listeners_ = []
+        self._lock_ = threading.Lock()
+
+    def add_evict_listener(self, callback):
+        '''Registers callback(area) to be told about every area dropped from memory'''
+        self._evict_listeners_.append(callback)
+
+    def new_dungeon(self):
+        '''Returns the entrance area of a new dungeon, None if there are no rooms'''
+        room_names = list(self.room_names())
+        random.shuffle(room_names)
+        if self.dungeon_length > 0:
+            room_names = room_names[:self.dungeon_length]
+        dungeon = DungeonRun(uuid.uuid4().hex, tuple(room_names))
+        return self._build_area_(dungeon, 0)
+
+    def get_area(self, area_id):
+        '''Returns a live area or None if it does not exist or was dropped'''
+        with self._lock_:
+            area = self._areas_.get(area_id)
+            if area is not None:
+                self._areas_.move_to_end(area_id)
+            return area
+
+    def next_area(self, area):
+        '''Returns the area after the given one, None at the end of the dungeon'''
+        if area.next_area_id is not None:
+            next_area = self.get_area(area.next_area_id)
+            if next_area is not None:
+                return next_area
+        next_area = self._build_area_(area.dungeon, area.index + 1)
+        if next_area is not None:
+            area.next_area_id = next_area.area_id
+        return next_area
+
+    def invalidate_room(self, room_name):
+        '''Forgets the parsed form of a replaced or removed room'''
+        with self._lock_:
+            self._templates_.pop(room_name, None)
+
+    def area_count(self):
+        '''Returns the number of live areas'''
+        with self._lock_:
+            return len(self._areas_)
+
+    def _build_area_(self, dungeon, index):
+        '''Builds the area for the first available room from index on'''
+        while index < len(dungeon.room_names):
+            template = self._get_template_(dungeon.room_names[index])
+            if template is not None:
+                area = Area(uuid.uuid4().hex, dungeon, index, template)
+                evicted = []
+                with self._lock_:
+                    self._areas_[area.area_id] = area
+                    while len(self._areas_) > self.max_areas:
+                        evicted.append(self._areas_.popitem(last=False)[1])
+                for old_area in evicted:
+                    for callback in self._evict_listeners_:
+                        callback(old_area)
+                return area
+            # Removed since the dungeon was created
+            index += 1
+        return None
+
+    def _get_template_(self, room_name):
+        '''Returns the shared template of a room, None if it does not exist'''
+        with self._lock_:
+            template = self._templates_.get(room_name)
+            if template is not None:
+                self._templates_.move_to_end(room_name)
+                return template
+        try:
+            navigation = None
+            if self.navigation_loader is not None:
+                navigation = self.navigation_loader(room_name)
+            grid = None
+            if self.grid_loader is not None:
+                grid = self.grid_loader(room_name)
+            if grid is not None:
+                # from_grid takes the objects out of the grid
+                template = AreaTemplate.from_grid(room_name, grid.copy(), navigation)
+            else:
+                template = AreaTemplate.from_binary(self.room_loader(room_name), navigation)
+        except (KeyError, room_codec.InvalidRoomName):
+            return None
+        with self._lock_:
+            self._templates_[room_name] = template
+            while len(self._templates_) > self.max_templates:
+                self._templates_.popitem(last=False)
+        return template
@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+    Latency histograms and counters of the servers
+
+    Metrics.Enabled=1 makes a server wrap the operations of its servants
+    and storage with Metrics.instrument and serve the snapshot through the
+    IceGauntletMetrics admin facet (see metrics_client.py). When disabled
+    DISABLED is used instead: nothing is wrapped and the few explicit
+    timers and counters are empty calls.
+'''
+
+import json
+import time
+import bisect
+import inspect
+import functools
+import threading
+import contextlib
+
+# pylint: disable=E0401
+import IceGauntlet
+
+FACET = 'IceGauntletMetrics'
+# Upper bounds in seconds of the histogram buckets, the last one is unbounded
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+           0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def slice_operations(servant_class):
+    '''Returns the Slice operations of a servant class, without the ice_* ones'''
+    return [name[len('_op_'):] for name in dir(servant_class)
+            if name.startswith('_op_') and not name.startswith('_op_ice_')]
+
+
+class Histogram:
+    '''Latencies of one operation in fixed buckets'''
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds, failed=False):
+        '''Adds one latency'''
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.errors += failed
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, fraction):
+        '''Returns the upper bound of the bucket holding the fraction of the latencies'''
+        wanted = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= wanted and count:
+                return BUCKETS[index] if index < len(BUCKETS) else self.max
+        return 0.0
+
+    def summary(self):
+        '''Returns the histogram as a dict with times in ms'''
+        return {
+            'count': self.count,
+            'errors': self.errors,
+            'total_ms': 1000 * self.total,
+            'mean_ms': 1000 * self.total / self.count if self.count else 0.0,
+            'max_ms': 1000 * self.max,
+            'p50_ms': 1000 * self.percentile(0.50),
+            'p99_ms': 1000 * self.percentile(0.99),
+            'buckets': {
+                ('{:g}'.format(1000 * bound) if index < len(BUCKETS) else 'inf'): count
+                for index, (bound, count) in enumerate(zip(BUCKETS + (None,), self.counts))
+                if count
+            }
+        }
+
+
+class Metrics:
+    '''Histograms, counters and gauges of one server'''
+    enabled = True
+
+    def __init__(self):
+        self._histograms_ = {}
+        self._counters_ = {}
+        # name -> callable returning a JSON serializable value
+        self._gauges_ = {}
+        self._started_ = time.time()
+        self._lock_ = threading.Lock()
+
+    def observe(self, name, seconds, failed=False):
+        '''Records a latency of name'''
+        with self._lock_:
+            histogram = self._histograms_.get(name)
+            if histogram is None:
+                histogram = self._histograms_[name] = Histogram()
+            histogram.record(seconds, failed)
+
+    def add(self, name, amount=1):
+        '''Increases a counter'''
+        with self._lock_:
+            self._counters_[name] = self._counters_.get(name, 0) + amount
+
+    def add_gauge(self, name, read):
+        '''Includes read() in every snapshot'''
+        self._gauges_[name] = read
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        '''Context manager recording the latency of its block'''
+        start = time.perf_counter()
+        failed = True
+        try:
+            yield
+            failed = False
+        finally:
+            self.observe(name, time.perf_counter() - start, failed)
+
+    def instrument(self, target, prefix, names):
+        '''Records the latency of target.<name>() as prefix.name for every name'''
+        target.metrics = self
+        for name in names:
+            method = getattr(target, name)
+            setattr(target, name, self._wrap_(method, '{}.{}'.format(prefix, name)))
+
+    def _wrap_(self, method, name):
+        if inspect.iscoroutinefunction(method):
+            @functools.wraps(method)
+            async def timed_coroutine(*args, **kwargs):
+                start = time.perf_counter()
+                failed = True
+                try:
+                    result = await method(*args, **kwargs)
+                    failed = False
+                    return result
+                finally:
+                    self.observe(name, time.perf_counter() - start, failed)
+            return timed_coroutine
+
+        @functools.wraps(method)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            failed = True
+            try:
+                result = method(*args, **kwargs)
+                failed = False
+                return result
+            finally:
+                self.observe(name, time.perf_counter() - start, failed)
+        return timed
+
+    def snapshot(self):
+        '''Returns every metric as a dict'''
+        with self._lock_:
+            operations = {name: histogram.summary()
+                          for name, histogram in sorted(self._histograms_.items())}
+            counters = dict(sorted(self._counters_.items()))
+        return {
+            'uptime': time.time() - self._started_,
+            'operations': operations,
+            'counters': counters,
+            'gauges': {name: read() for name, read in self._gauges_.items()}
+        }
+
+    def reset(self):
+        '''Drops the histograms and counters'''
+        with self._lock_:
+            self._histograms_ = {}
+            self._counters_ = {}
+            self._started_ = time.time()
+
+
+class DisabledMetrics:
+    '''Metrics that record nothing'''
+    enabled = False
+    _timer_ = contextlib.nullcontext()
+
+    def observe(self, name, seconds, failed=False):
+        '''Does nothing'''
+
+    def add(self, name, amount=1):
+        '''Does nothing'''
+
+    def add_gauge(self, name, read):
+        '''Does nothing'''
+
+    def timer(self, name):
+        '''Returns a context manager that does nothing'''
+        return self._timer_
+
+    def instrument(self, target, prefix, names):
+        '''Leaves target as it is'''
+        target.metrics = self
+
+
+DISABLED = DisabledMetrics()
+
+
+def from_properties(properties):
+    '''Returns Metrics if Metrics.Enabled is set, DISABLED otherwise'''
+    if properties.getPropertyAsIntWithDefault('Metrics.Enabled', 0) > 0:
+        return Metrics()
+    return DISABLED
+
+
+class MetricsAdmin(IceGauntlet.ServerMetrics):
+    '''Admin facet with the snapshot of the metrics'''
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+    def getMetrics(self, current=None):
+        '''Returns the snapshot as JSON'''
+        return json.dumps(self.metrics.snapshot())
+
+    def resetMetrics(self, current=None):
+        '''Starts the metrics from zero'''
+        self.metrics.reset()
+
+
+def serve(broker, metrics):
+    '''Adds the admin facet of metrics if enabled, returns the admin proxy or None'''
+    if not metrics.enabled:
+        return None
+    broker.addAdminFacet(MetricsAdmin(metrics), FACET)
+    admin = broker.getAdmin()
+    return admin.ice_facet(FACET) if admin is not None else None
@@ -7,15 +7,22 @@
     Map Client
 '''
 
+import os
 import sys
+import glob
 import json
 import argparse
 
 import Ice
-Ice.loadSlice('icegauntlet.ice')
+import slice_stubs
+slice_stubs.load_slice()
 # pylint: disable=E0401
 # pylint: disable=C0413
 import IceGauntlet
+import room_cache
+
+# Bytes of room data sent on each publishMany call, below Ice.MessageSizeMax
+BATCH_BYTES = 512 * 1024
 
 class MapManClient(Ice.Application):
     '''Map Client'''
@@ -31,9 +38,28 @@ class MapManClient(Ice.Application):
 
             if args.newMapPath:
                 self.publish_map(map_man_server, args.Token, args.newMapPath)
+                self.show_session(map_man_server)
 
             if args.roomName:
                 self.remove_map(map_man_server, args.Token, args.roomName)
+                self.show_session(map_man_server)
+
+            if args.mapsPattern:
+                result = self.publish_maps(map_man_server, args.Token, args.mapsPattern)
+                self.show_session(map_man_server)
+                return result
+
+            if args.roomNames:
+                result = self.remove_maps(map_man_server, args.Token, args.roomNames)
+                self.show_session(map_man_server)
+                return result
+
+            if args.getRoomName:
+                try:
+                    self.get_map(map_man_server, args.getRoomName, args.Session)
+                except IceGauntlet.RoomNotExists:
+                    print("El mapa solicitado no existe")
+                    return 3
 
             return 0
         except IceGauntlet.Unauthorized:
@@ -45,8 +71,9 @@ class MapManClient(Ice.Application):
         except IceGauntlet.RoomNotExists:
             print("El mapa que estas intentando borrar no existe o es de otra persona")
             return 3
-        except IceGauntlet.WrongRoomFormat:
-            print("El archivo introducido no es un mapa valido")
+        except IceGauntlet.WrongRoomFormat as error:
+            print("El archivo introducido no es un mapa valido: {}".format(error.reason))
+            return 11
         except Ice.Exception:
             print("Proxy no disponible en este momento\nException: Connection Refused")
             return 4
@@ -70,6 +97,62 @@ class MapManClient(Ice.Application):
         '''Invokes remove()'''
         map_man_server.remove(token, room_name)
 
+    def publish_maps(self, map_man_server, token, maps_pattern):
+        '''Sends every map of a directory or glob invoking publishMany()'''
+        if os.path.isdir(maps_pattern):
+            maps_pattern = os.path.join(maps_pattern, '*.json')
+        maps_paths = sorted(glob.glob(maps_pattern))
+        if not maps_paths:
+            raise IncorrectFile
+
+        results = list()
+        batch = list()
+        batch_bytes = 0
+        for new_map_path in maps_paths:
+            new_map = json.dumps(self.read_map_json(new_map_path))
+            if batch and batch_bytes + len(new_map) > BATCH_BYTES:
+                results += map_man_server.publishMany(token, batch)
+                batch = list()
+                batch_bytes = 0
+            batch.append(new_map)
+            batch_bytes += len(new_map)
+        results += map_man_server.publishMany(token, batch)
+        return self.show_results(results)
+
+    @staticmethod
+    def show_session(map_man_server):
+        '''Prints the session token of the replica that handled the last request'''
+        # Same connection, so the same replica, as the previous request
+        replica = map_man_server.ice_fixed(map_man_server.ice_getConnection())
+        print("Token de sesion: {}".format(replica.sessionToken()))
+
+    def get_map(self, map_man_server, room_name, session):
+        '''Prints a room, seeing the changes of session if given
+
+        The rooms read before are kept on disk, the server only sends a room
+        again if it changed since.
+        '''
+        cache = room_cache.RoomCache.from_properties(self.communicator().getProperties(),
+                                                     map_man_server)
+        print(cache.get_room(room_name, session))
+
+    def remove_maps(self, map_man_server, token, room_names):
+        '''Invokes removeMany()'''
+        return self.show_results(map_man_server.removeMany(token, room_names))
+
+    @staticmethod
+    def show_results(results):
+        '''Prints the result of every room, returns 9 if any of them failed'''
+        failed = 0
+        for result in results:
+            if result.error:
+                failed += 1
+                print("{}: {}".format(result.roomName or "?", result.error))
+            else:
+                print("{}: OK".format(result.roomName))
+        print("{} de {} mapas procesados correctamente".format(len(results) - failed, len(results)))
+        return 9 if failed else 0
+
     @staticmethod
     def parse_args(argv):
         '''Parse the arguments'''
@@ -79,6 +162,13 @@ class MapManClient(Ice.Application):
         group = parser.add_mutually_exclusive_group()
         group.add_argument("-p", "--Publish", dest="newMapPath", help="Opcion para publicar mapa")
         group.add_argument("-r", "--Remove", dest="roomName", help="Opcion para borrar mapa")
+        group.add_argument("-b", "--PublishMany", dest="mapsPattern",
+                           help="Opcion para publicar todos los mapas de un directorio o patron")
+        group.add_argument("-R", "--RemoveMany", dest="roomNames", nargs="+",
+                           help="Opcion para borrar varios mapas")
+        group.add_argument("-g", "--GetRoom", dest="getRoomName", help="Opcion para leer un mapa")
+        parser.add_argument("-s", "--Session", dest="Session", default="",
+                            help="Token de sesion para leer los cambios ya publicados")
 
         args = parser.parse_args()
 
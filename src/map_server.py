@@ -7,9 +7,22 @@
     Map Server
 '''
 
+import os
 import sys
 import json
+import time
+import hashlib
+import logging
 import argparse
+import threading
+import contextlib
+import collections
+
+try:
+    import fcntl
+except ImportError:
+    # Without advisory locks only the threads of one process are serialized
+    fcntl = None
 
 import Ice
 import IceStorm
@@ -17,19 +30,106 @@ Ice.loadSlice('icegauntlet.ice')
 # pylint: disable=E0401
 # pylint: disable=C0413
 import IceGauntlet
+import room_codec
+import dungeon_engine
+import area_events
+import room_navigation
+import signed_tokens
+import instrumentation
 
 ROOMS_FILE = 'rooms.json'
 MANAGERS_FILE = 'managers.json'
 
+JOURNAL_FILE = 'rooms.journal'
+
+# Seconds the write-behind flusher waits to batch records into the journal
+FLUSH_INTERVAL = 0.5
+# Journal records after which rooms.json is rewritten and the journal emptied
+COMPACT_RECORDS = 1000
+# Local changes kept to answer getChangesSince, older versions need a full resync
+CHANGE_LOG_SIZE = 10000
+# MapStorage methods timed when Metrics.Enabled is set
+STORAGE_OPERATIONS = ('parse_room', 'commit_room', 'commit_rooms', 'uncommit_room',
+                      'commit_rooms_event', 'uncommit_room_event', 'open_rooms_db',
+                      'write_rooms_db', 'append_journal', 'replay_journal')
+
+# Rooms asked for in each getRooms call and calls in flight while syncing
+FETCH_BATCH_SIZE = 50
+FETCH_PARALLELISM = 4
+
+# Content of a room shared by every name it is stored under: content hash,
+# JSON text and binary encoding without the room name
+# grid is the validated dungeon_engine.TileGrid, None for rooms that were not validated
+RoomBody = collections.namedtuple('RoomBody', ['digest', 'json', 'binary', 'grid', 'navigation'])
+
+
+class StoredRoom(collections.namedtuple('StoredRoom', ['name', 'owner', 'body'])):
+    '''Resident form of a room: its name and owner plus the shared body'''
+    __slots__ = ()
+
+    @property
+    def data(self):
+        '''JSON text of the room'''
+        if self.body.json == '{}':
+            return '{{"room": {}}}'.format(json.dumps(self.name))
+        return '{{"room": {}, {}'.format(json.dumps(self.name), self.body.json[1:])
+
+    @property
+    def binary(self):
+        '''room_codec encoding of the room'''
+        return room_codec.with_name(self.body.binary, self.name)
+
+
+def room_body_json(room):
+    '''Returns the canonical JSON text of a room dict without its name'''
+    return json.dumps({key: value for key, value in room.items()
+                       if key != room_codec.ROOM_NAME}, sort_keys=True)
+
+
+def content_hash(body_json):
+    '''Returns the content hash of the JSON text of a room body'''
+    return hashlib.blake2b(body_json.encode('utf-8'), digest_size=16).hexdigest()
+
+# Largest page returned by availableRoomsPage
+MAX_PAGE_SIZE = 500
+# 'always' fsyncs every flush, 'never' leaves it to the OS
+FSYNC_POLICIES = ('always', 'never')
+FSYNC_POLICY = 'always'
+
+REVOCATION_TOPIC = 'TokenRevocationChannel'
+
+# Token -> owner entries cached by every RoomManager
+TOKEN_CACHE_SIZE = 1024
+TOKEN_CACHE_TTL = 60.0
+
+# Identity categories of the areas and their event subscribers, and prefix
+# of their event channels
+AREA_CATEGORY = 'area'
+AREA_SYNC_CATEGORY = 'areasync'
+AREA_TOPIC_PREFIX = 'DungeonArea.'
+
+# Request context key of the session token of read-your-writes reads
+SESSION_CONTEXT = 'session'
+
+# Proxy served to clients (the replica group under IceGrid), proxy of this
+# replica and its identifier in the RoomManagerSync events
 ROOM_MANAGER_PROXY = 'room_manager_proxy'
+REPLICA_PROXY = 'replica_proxy'
+MANAGER_ID = 'manager_id'
 DUNGEON_PROXY = 'dungeon_proxy'
 
 class RoomManager(IceGauntlet.RoomManager):
     '''Room Manager Servant'''
-    def __init__(self, broker, publisher, args):
+    metrics = instrumentation.DISABLED
+
+    # pylint: disable=R0913
+    def __init__(self, broker, publisher, map_storage, token_cache, args, sync=None):
         '''Conecting with the Authentication Server'''
-        self.map_storage = MapStorage()
+        self.map_storage = map_storage
         self.publisher = publisher
+        self.token_cache = token_cache
+        # RoomManagerSync servant used to catch up with other replicas
+        self.sync = sync
         try:
             self.communicator = broker
             self.auth_proxy = self.communicator.stringToProxy("default_1")
@@ -39,238 +139,1270 @@ class RoomManager(IceGauntlet.RoomManager):
         except Ice.Exception:
             print("Proxy no disponible en este momento\nException: Connection Refused")
 
-    def publish(self, token, room_data, current=None):
+    async def publish(self, token, room_data, current=None):
         '''Publish a room'''
-        user_name = self.auth_server.getOwner(token)
+        user_name = await self.get_owner(token)
         if not user_name:
             raise IceGauntlet.Unauthorized()
         room_name = self.map_storage.commit_room(user_name, room_data)
-        self.publisher.newRoom(room_name, '{}'.format(ROOM_MANAGER_PROXY))
+        with self.metrics.timer('IceStorm.newRoom'):
+            await self.publisher.newRoomAsync(room_name, MANAGER_ID)
 
-    def remove(self, token, room_name, current=None):
+    async def remove(self, token, room_name, current=None):
         '''Remove a room'''
-        user_name = self.auth_server.getOwner(token)
+        user_name = await self.get_owner(token)
         if not user_name:
             raise IceGauntlet.Unauthorized()
         self.map_storage.uncommit_room(user_name, room_name)
-        self.publisher.removedRoom(room_name)
+        with self.metrics.timer('IceStorm.removedRoom'):
+            await self.publisher.removedRoomAsync(room_name)
 
-    def availableRooms(self, current=None):
+    async def publishMany(self, token, rooms_data, current=None):
+        '''Publish many rooms with a single token check'''
+        user_name = await self.get_owner(token)
+        if not user_name:
+            raise IceGauntlet.Unauthorized()
+        results = self.map_storage.commit_rooms(user_name, rooms_data)
+        published = [room_name for room_name, error in results if not error]
+        if published:
+            # Peers fetch every change since their last version, one event is enough
+            with self.metrics.timer('IceStorm.newRoom'):
+                await self.publisher.newRoomAsync(published[-1], MANAGER_ID)
+        return [IceGauntlet.RoomResult(room_name, error) for room_name, error in results]
+
+    async def removeMany(self, token, room_names, current=None):
+        '''Remove many rooms with a single token check'''
+        user_name = await self.get_owner(token)
+        if not user_name:
+            raise IceGauntlet.Unauthorized()
+        results = self.map_storage.uncommit_rooms(user_name, room_names)
+        for room_name, error in results:
+            if not error:
+                with self.metrics.timer('IceStorm.removedRoom'):
+                    await self.publisher.removedRoomAsync(room_name)
+        return [IceGauntlet.RoomResult(room_name, error) for room_name, error in results]
+
+    async def availableRooms(self, current=None):
         '''Returns a list of all the rooms in this RoomManager'''
+        await self.wait_for_session(current)
         return self.map_storage.get_rooms_with_users()
 
-    def getRoom(self, room_name, current=None):
+    async def availableRoomsPage(self, offset, limit, owner, current=None):
+        '''Returns a page of the rooms sorted by name, optionally only those of owner'''
+        await self.wait_for_session(current)
+        return self.map_storage.get_rooms_with_users_page(offset, limit, owner)
+
+    async def getRoom(self, room_name, current=None):
         '''Returns the room information'''
-        if room_name not in self.map_storage.get_rooms():
+        await self.wait_for_session(current)
+        try:
+            return self.map_storage.get_room_data(room_name)
+        except KeyError:
             raise IceGauntlet.RoomNotExists()
-        return self.map_storage.get_room_data(room_name)
+
+    async def getRoomBinary(self, room_name, current=None):
+        '''Returns the room encoded with room_codec'''
+        await self.wait_for_session(current)
+        try:
+            return self.map_storage.get_room_binary(room_name)
+        except KeyError:
+            raise IceGauntlet.RoomNotExists()
+        except room_codec.InvalidRoomName as error:
+            # Only rooms kept unvalidated from disk or other managers get here
+            raise IceGauntlet.WrongRoomFormat(str(error))
+
+    async def getRoomIfChanged(self, room_name, known_hash, current=None):
+        '''Returns the room and its content hash, unset if known_hash is still its hash'''
+        await self.wait_for_session(current)
+        try:
+            hashed_room = self.map_storage.get_hashed_room(room_name, known_hash)
+        except KeyError:
+            raise IceGauntlet.RoomNotExists()
+        if hashed_room is None:
+            return Ice.Unset
+        return IceGauntlet.HashedRoom(*hashed_room)
+
+    async def getRooms(self, room_names, current=None):
+        '''Returns the information of the given rooms, skipping the missing ones'''
+        await self.wait_for_session(current)
+        return self.map_storage.get_rooms_data(room_names)
+
+    def sessionToken(self, current=None):
+        '''Returns the token of every change applied by this replica so far'''
+        return '{}:{}'.format(self.map_storage.current_version(), MANAGER_ID)
+
+    async def wait_for_session(self, current):
+        '''Catches up with the replica that issued the session token of the request'''
+        session_token = current.ctx.get(SESSION_CONTEXT) if current else None
+        if not session_token or self.sync is None:
+            return
+        version, _, manager_id = session_token.partition(':')
+        if manager_id == MANAGER_ID or not version.isdigit():
+            return
+        # Only the replicas met through hello/announce, never a proxy chosen by the reader
+        if manager_id not in self.map_storage.get_managers():
+            logging.warning('Ignoring session token of unknown manager %s', manager_id)
+            return
+        try:
+            await self.sync.catch_up(manager_id, int(version))
+        except (Ice.Exception, RuntimeError) as error:
+            # Serve what this replica has rather than failing the read
+            logging.warning('Cannot catch up with %s: %s', manager_id, error)
+
+    def currentVersion(self, current=None):
+        '''Returns the version of the last local change'''
+        return self.map_storage.current_version()
+
+    def getChangesSince(self, version, current=None):
+        '''Returns the local changes newer than version'''
+        return [
+            IceGauntlet.RoomChange(change_version, room_name, user_name, removed, digest)
+            for change_version, room_name, user_name, removed, digest
+            in self.map_storage.get_changes_since(version)
+        ]
+
+    async def get_owner(self, token):
+        '''Returns the token owner, asking the Authentication server on cache misses'''
+        user_name = self.token_cache.get(token)
+        if user_name is None:
+            with self.metrics.timer('Authentication.getOwner'):
+                user_name = await self.auth_server.getOwnerAsync(token)
+            if user_name:
+                self.token_cache.put(token, user_name)
+        return user_name
+
+class TokenCache:
+    '''Bounded LRU cache of token -> owner with expiration
+
+    With a signed_tokens.TokenVerifier, signed tokens are checked locally
+    and never stored; the owners confirmed by the Authentication server
+    are passed to the verifier instead.
+    '''
+    def __init__(self, size=TOKEN_CACHE_SIZE, ttl=TOKEN_CACHE_TTL, verifier=None):
+        self.size = size
+        self.ttl = ttl
+        self.verifier = verifier
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.revocations = 0
+        # token -> (user_name, expiration time)
+        self._entries_ = collections.OrderedDict()
+        self._lock_ = threading.Lock()
+
+    @classmethod
+    def from_properties(cls, properties):
+        '''Builds a TokenCache using the TokenCache.* Ice properties'''
+        verifier = None
+        key = signed_tokens.load_key(properties.getProperty('SignedTokens.Key'))
+        if key is not None:
+            verifier = signed_tokens.TokenVerifier(key, properties.getPropertyAsIntWithDefault(
+                'SignedTokens.MaxAge', signed_tokens.MAX_AGE))
+        return cls(
+            size=properties.getPropertyAsIntWithDefault('TokenCache.Size', TOKEN_CACHE_SIZE),
+            ttl=float(properties.getPropertyWithDefault('TokenCache.TTL', str(TOKEN_CACHE_TTL))),
+            verifier=verifier
+        )
+
+    def get(self, token):
+        '''Returns the cached owner of token or None'''
+        if self.verifier is not None and signed_tokens.is_signed(token):
+            user_name = self.verifier.owner(token)
+            if user_name is not None:
+                return user_name
+            # Rejected here, the Authentication server has the last word
+        with self._lock_:
+            entry = self._entries_.get(token)
+            if entry is None or entry[1] < time.monotonic():
+                if entry is not None:
+                    del self._entries_[token]
+                self.misses += 1
+                return None
+            self._entries_.move_to_end(token)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, token, user_name):
+        '''Caches the owner of token, evicting the least recently used entry'''
+        if self.verifier is not None and signed_tokens.is_signed(token):
+            self.verifier.confirm(token)
+            return
+        if self.size <= 0:
+            return
+        with self._lock_:
+            self._entries_[token] = (user_name, time.monotonic() + self.ttl)
+            self._entries_.move_to_end(token)
+            while len(self._entries_) > self.size:
+                self._entries_.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, token):
+        '''Drops a revoked token'''
+        if self.verifier is not None:
+            self.verifier.revoke(token)
+        with self._lock_:
+            if self._entries_.pop(token, None) is not None:
+                self.revocations += 1
+
+    def stats(self):
+        '''Returns the cache counters'''
+        with self._lock_:
+            stats = {
+                'size': len(self._entries_),
+                'capacity': self.size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'revocations': self.revocations
+            }
+        if self.verifier is not None:
+            stats['verified'] = self.verifier.verified
+            stats['rejected'] = self.verifier.rejected
+            stats['unknown'] = self.verifier.unknown
+        return stats
+
+class TokenRevocation(IceGauntlet.TokenRevocation):
+    '''Event channel for tokens revoked by the Authentication server'''
+    def __init__(self, token_cache):
+        self.token_cache = token_cache
+
+    def revoked(self, token, current=None):
+        '''Drops the token from the cache'''
+        self.token_cache.invalidate(token)
 
 class RoomManagerSync(IceGauntlet.RoomManagerSync):
     '''Event channel for Room Manager synchronization'''
-    def __init__(self, publisher, broker):
+    metrics = instrumentation.DISABLED
+
+    def __init__(self, publisher, broker, map_storage):
         '''Sets the local object references'''
-        self.managers_storage = MapStorage()
+        self.managers_storage = map_storage
         self.publisher = publisher
         self.communicator = broker
+        properties = broker.getProperties()
+        self.fetch_batch_size = properties.getPropertyAsIntWithDefault(
+            'RoomManagerSync.FetchBatchSize', FETCH_BATCH_SIZE)
+        self.fetch_parallelism = properties.getPropertyAsIntWithDefault(
+            'RoomManagerSync.FetchParallelism', FETCH_PARALLELISM)
+        # manager_id -> last version applied from that manager
+        self._versions_ = {}
+        # manager_id -> Ice.Future set when the last pull queued for it ends
+        self._pulls_ = {}
+        self._pulls_lock_ = threading.Lock()
 
     def hello(self, manager, manager_id, current=None):
         '''Sends a hello message'''
-        if manager_id != '{}'.format(ROOM_MANAGER_PROXY):
+        if manager_id != MANAGER_ID:
             if manager_id not in self.managers_storage.get_managers():
                 self.managers_storage.commit_manager(manager_id)
         self.make_announce()
 
     def announce(self, manager, manager_id, current=None):
         '''Sends an announce message'''
-        if manager_id != '{}'.format(ROOM_MANAGER_PROXY):
+        if manager_id != MANAGER_ID:
             if manager_id not in self.managers_storage.get_managers():
                 self.managers_storage.commit_manager(manager_id)
 
-    def newRoom(self, room_name, manager_id, current=None):
+    async def newRoom(self, room_name, manager_id, current=None):
         '''Sends a new room message'''
-        remote_manager = self.get_remote_manager(manager_id)
-        new_rooms = self.get_new_rooms(remote_manager)
-        self.save_new_rooms(new_rooms, remote_manager)
+        if manager_id == MANAGER_ID:
+            return
+        await self.pull_changes(manager_id)
+
+    async def catch_up(self, manager_id, version):
+        '''Pulls the changes of a manager unless version was already applied'''
+        if self._versions_.get(manager_id, -1) < version:
+            await self.pull_changes(manager_id)
+            # The pull saw the manager as it is now, which covers version
+            self.update_version(manager_id, version)
+
+    async def pull_changes(self, manager_id):
+        '''Applies the changes of a manager since the last version known
+
+        Pulls of the same manager run one after another: an older delta
+        applied after a newer one would bring back removed rooms.
+        '''
+        done = Ice.Future()
+        with self._pulls_lock_:
+            previous = self._pulls_.get(manager_id)
+            self._pulls_[manager_id] = done
+        try:
+            if previous is not None:
+                await previous
+            await self._pull_changes_(manager_id)
+        finally:
+            with self._pulls_lock_:
+                if self._pulls_.get(manager_id) is done:
+                    del self._pulls_[manager_id]
+            done.set_result(None)
+
+    async def _pull_changes_(self, manager_id):
+        remote_manager = await self.get_remote_manager(manager_id)
+        known_version = self._versions_.get(manager_id)
+        if known_version is not None:
+            try:
+                changes = await remote_manager.getChangesSinceAsync(known_version)
+            except IceGauntlet.VersionGap:
+                logging.info('Version gap with %s, resynchronizing', manager_id)
+                self.metrics.add('sync.version_gaps')
+            else:
+                self.metrics.add('sync.deltas')
+                self.metrics.add('sync.changes', len(changes))
+                # catch_up may have covered part of the delta meanwhile
+                applied = self._versions_.get(manager_id, known_version)
+                changes = [change for change in changes if change.version > applied]
+                if not changes:
+                    return
+                await self.apply_changes(changes, remote_manager)
+                self.update_version(manager_id, changes[-1].version)
+                return
+        await self.full_resync(manager_id, remote_manager)
 
     def removedRoom(self, room_name, current=None):
         '''Sends a removed room message'''
-        if room_name in self.managers_storage.get_rooms():
-            self.managers_storage.uncommit_room_event(room_name)
+        self.managers_storage.uncommit_room_event(room_name)
 
     def make_announce(self):
         '''Executes the announce method'''
-        local_manager = IceGauntlet.RoomManagerPrx.uncheckedCast(ROOM_MANAGER_PROXY)
-        local_manager_id = '{}'.format(ROOM_MANAGER_PROXY)
-        self.publisher.announce(local_manager, local_manager_id)
+        self.publisher.announce(REPLICA_PROXY, MANAGER_ID)
 
-    def get_remote_manager(self, manager_id):
+    async def get_remote_manager(self, manager_id):
         '''Returns the remote RoomManager object'''
         remote_manager_proxy = self.communicator.stringToProxy(manager_id)
-        return IceGauntlet.RoomManagerPrx.checkedCast(remote_manager_proxy)
-
-    def get_new_rooms(self, remote_manager):
-        '''Returns a list with all the new rooms'''
-        remote_available_rooms = remote_manager.availableRooms()
-        local_available_rooms = self.managers_storage.get_rooms_with_users()
-
+        # Same check as checkedCast without blocking the dispatch thread
+        if not await remote_manager_proxy.ice_isAAsync(IceGauntlet.RoomManager.ice_staticId()):
+            raise RuntimeError('Invalid proxy')
+        return IceGauntlet.RoomManagerPrx.uncheckedCast(remote_manager_proxy)
+
+    def update_version(self, manager_id, version):
+        '''Remembers the last version applied from a manager'''
+        if version > self._versions_.get(manager_id, version - 1):
+            self._versions_[manager_id] = version
+
+    async def full_resync(self, manager_id, remote_manager):
+        '''Fetches every room missing locally and restarts the delta tracking'''
+        self.metrics.add('sync.full_resyncs')
+        # Read the version first: changes made during the resync are sent again
+        version = await remote_manager.currentVersionAsync()
+        new_rooms = await self.get_new_rooms(remote_manager)
+        await self.save_new_rooms(new_rooms, remote_manager)
+        self._versions_[manager_id] = version
+
+    async def apply_changes(self, changes, remote_manager):
+        '''Applies the last change of every room in a delta'''
+        last_changes = dict()
+        for change in changes:
+            last_changes[change.roomName] = change
         new_rooms = list()
-        if remote_available_rooms != local_available_rooms:
-            for room in remote_available_rooms:
-                if room not in local_available_rooms:
-                    new_rooms.append(room)
-        return new_rooms
+        for change in last_changes.values():
+            if change.removed:
+                self.managers_storage.uncommit_room_event(change.roomName)
+            else:
+                new_rooms.append((change.roomName, change.owner, change.contentHash))
+        # Rooms with a content already stored here are not fetched
+        missing = self.managers_storage.commit_rooms_by_hash(new_rooms)
+        self.metrics.add('sync.rooms_by_hash', len(new_rooms) - len(missing))
+        await self.fetch_rooms(missing, remote_manager)
+
+    async def get_new_rooms(self, remote_manager):
+        '''Returns a list with all the new rooms'''
+        remote_available_rooms = await remote_manager.availableRoomsAsync()
+        local_available_rooms = set(self.managers_storage.get_rooms_with_users())
+        return [room for room in remote_available_rooms if room not in local_available_rooms]
 
-    def save_new_rooms(self, new_rooms, remote_manager):
+    async def save_new_rooms(self, new_rooms, remote_manager):
         '''Gets the data all the new rooms and saves it in the db'''
+        rooms_and_users = list()
         for room in new_rooms:
             aux_dict = json.loads(room)
             new_room_name = list(aux_dict.keys())[0]
-            new_user_name = aux_dict[new_room_name]
-            new_room_data = remote_manager.getRoom(new_room_name)
-            self.managers_storage.commit_room_event(new_user_name, new_room_data)
+            rooms_and_users.append((new_room_name, aux_dict[new_room_name]))
+        await self.fetch_rooms(rooms_and_users, remote_manager)
+
+    async def fetch_rooms(self, rooms_and_users, remote_manager):
+        '''Gets the data of the given (room, user) pairs and saves it in the db at once'''
+        owners = dict(rooms_and_users)
+        room_names = list(owners.keys())
+        in_flight = collections.deque()
+        fetched = list()
+        for first in range(0, len(room_names), self.fetch_batch_size):
+            if len(in_flight) >= self.fetch_parallelism:
+                fetched.append(await in_flight.popleft())
+            batch = room_names[first:first + self.fetch_batch_size]
+            in_flight.append(remote_manager.getRoomsAsync(batch))
+            self.metrics.add('sync.fetch_batches')
+        while in_flight:
+            fetched.append(await in_flight.popleft())
+        self.metrics.add('sync.rooms_fetched', sum(len(rooms_data) for rooms_data in fetched))
+        # Rooms removed before we could fetch them are not in the replies
+        self.managers_storage.commit_rooms_event([
+            (owners[room_name], room_data)
+            for rooms_data in fetched for room_name, room_data in rooms_data.items()
+        ])
 
 class Dungeon(IceGauntlet.Dungeon):
     '''Dungeon Servant'''
+    def __init__(self, engine):
+        self.engine = engine
+
     def getEntrance(self, current=None):
         '''Returns a DungeonArea'''
+        area = self.engine.new_dungeon()
+        if area is None:
+            raise IceGauntlet.RoomNotExists()
+        return area_proxy(current.adapter, area)
 
 class DungeonArea(IceGauntlet.DungeonArea):
-    '''DungeonArea Servant'''
+    '''DungeonArea default servant, the identity name selects the area'''
+    def __init__(self, engine, channels):
+        self.engine = engine
+        self.channels = channels
+
+    def get_area(self, current):
+        '''Returns the area addressed by the request'''
+        area = self.engine.get_area(current.id.name)
+        if area is None:
+            raise Ice.ObjectNotExistException()
+        return area
+
     def getEventChannel(self, current=None):
         '''Returns the event channel'''
+        return self.channels.get_channel(self.get_area(current))
 
     def getMap(self, current=None):
         '''Returns the map'''
+        return self.get_area(current).get_map()
 
     def getActors(self, current=None):
-        '''Returns the cast ?'''
+        '''Returns the actors in the area'''
+        return [
+            IceGauntlet.Actor(actor.actor_id, actor.attributes)
+            for actor in self.get_area(current).get_actors()
+        ]
 
     def getItems(self, current=None):
-        '''Returns the items ?'''
+        '''Returns the items in the area'''
+        area = self.get_area(current)
+        # Events move the records, read each position whole
+        with area.lock:
+            return [
+                IceGauntlet.Item(item.item_id, item.item_type, item.pos_x, item.pos_y)
+                for item in area.get_items()
+            ]
+
+    def getItemsNear(self, position_x, position_y, radius, current=None):
+        '''Returns the items inside the square of the given radius around a position'''
+        area = self.get_area(current)
+        with area.lock:
+            return [
+                IceGauntlet.Item(item.item_id, item.item_type, item.pos_x, item.pos_y)
+                for item in area.items_near(position_x, position_y, radius)
+            ]
+
+    def getActorsNear(self, position_x, position_y, radius, current=None):
+        '''Returns the actors inside the square of the given radius around a position'''
+        return [
+            IceGauntlet.Actor(actor.actor_id, actor.attributes)
+            for actor in self.get_area(current).actors_near(position_x, position_y, radius)
+        ]
+
+    def findPath(self, from_x, from_y, to_x, to_y, current=None):
+        '''Returns the walkable positions between two positions, empty if unreachable'''
+        navigation = room_navigation.area_navigation(self.get_area(current))
+        return [
+            IceGauntlet.Position(pos_x, pos_y)
+            for pos_x, pos_y in navigation.find_path((from_x, from_y), (to_x, to_y))
+        ]
+
+    def findPathToExit(self, from_x, from_y, current=None):
+        '''Returns the walkable positions to the nearest exit, empty if unreachable'''
+        navigation = room_navigation.area_navigation(self.get_area(current))
+        return [
+            IceGauntlet.Position(pos_x, pos_y)
+            for pos_x, pos_y in navigation.path_to_exit((from_x, from_y))
+        ]
 
     def getNextArea(self, current=None):
-        '''Returns the next DungeonArea'''
+        '''Returns the next DungeonArea, or None at the end of the dungeon'''
+        next_area = self.engine.next_area(self.get_area(current))
+        if next_area is None:
+            return None
+        return area_proxy(current.adapter, next_area)
+
+def replica_proxy(adapter, identity):
+    '''Returns the proxy that reaches this replica and no other'''
+    properties = adapter.getCommunicator().getProperties()
+    if properties.getProperty('{}.AdapterId'.format(adapter.getName())):
+        # Stable across restarts, resolved by the locator
+        return adapter.createIndirectProxy(identity)
+    # createProxy would name the replica group, which may pick another replica
+    return adapter.createDirectProxy(identity)
+
+def add_to_replica(adapter, servant):
+    '''Adds a servant with a UUID identity and returns the proxy of this replica'''
+    return replica_proxy(adapter, adapter.addWithUUID(servant).ice_getIdentity())
+
+def area_proxy(adapter, area):
+    '''Returns the proxy of an area served by the DungeonArea default servant'''
+    # Areas live in the memory of one replica
+    proxy = replica_proxy(adapter, Ice.Identity(area.area_id, AREA_CATEGORY))
+    return IceGauntlet.DungeonAreaPrx.uncheckedCast(proxy)
+
+class DungeonAreaSync(IceGauntlet.DungeonAreaSync):
+    '''DungeonAreaSync default servant, the identity name selects the area'''
+    def __init__(self, engine):
+        self.engine = engine
 
-class DungeonAreaSync():
-    '''Event channel for DungeonArea synchronization'''
     def fireEvent(self, event, sender_id, current=None):
-        '''Sends Fire Event'''
+        '''Applies a frame of area_events to the area'''
+        area = self.engine.get_area(current.id.name)
+        if area is None or area.receiver is None:
+            return
+        try:
+            area.receiver.receive(event, sender_id)
+        except area_events.InvalidFrame as error:
+            logging.warning('Invalid event frame from %s: %s', sender_id, error)
+
+class AreaChannels:
+    '''Creates the IceStorm topic of each area and subscribes the server to it'''
+    def __init__(self, topic_mgr, adapter):
+        self.topic_mgr = topic_mgr
+        self.adapter = adapter
+        # area_id -> (topic, subscriber proxy)
+        self._topics_ = {}
+        self._lock_ = threading.Lock()
+
+    def get_channel(self, area):
+        '''Returns the topic name of an area, subscribing to it the first time'''
+        topic_name = '{}{}'.format(AREA_TOPIC_PREFIX, area.area_id)
+        with self._lock_:
+            if area.area_id in self._topics_:
+                return topic_name
+            try:
+                topic = self.topic_mgr.retrieve(topic_name)
+            # pylint: disable=E1101
+            except IceStorm.NoSuchTopic:
+                topic = self.topic_mgr.create(topic_name)
+            subscriber = replica_proxy(
+                self.adapter, Ice.Identity(area.area_id, AREA_SYNC_CATEGORY))
+            area.receiver = area_events.FrameReceiver(
+                lambda events, timestamp: area_events.apply_events(area, events),
+                on_gap=lambda sender_id, expected, got: logging.info(
+                    'Lost event frames %s..%s from %s in %s', expected, got - 1, sender_id,
+                    area.area_id))
+            # Frames must be applied in the order they were sent
+            topic.subscribeAndGetPublisher({'reliability': 'ordered'}, subscriber)
+            self._topics_[area.area_id] = (topic, subscriber)
+        return topic_name
+
+    def release(self, area):
+        '''Destroys the topic of an area dropped from memory'''
+        with self._lock_:
+            topic_and_subscriber = self._topics_.pop(area.area_id, None)
+        if topic_and_subscriber is None:
+            return
+        try:
+            topic_and_subscriber[0].destroy()
+        except Ice.Exception as error:
+            logging.warning('Cannot destroy the topic of %s: %s', area.area_id, error)
+
+    def release_all(self):
+        '''Destroys the topics of every area'''
+        with self._lock_:
+            topics = list(self._topics_.values())
+            self._topics_.clear()
+        for topic, _ in topics:
+            try:
+                topic.destroy()
+            except Ice.Exception:
+                pass
+
+class FileLock:
+    '''Advisory lock on <file>.lock, shared with other processes using the file'''
+    def __init__(self, file_name):
+        self.path = '{}.lock'.format(file_name)
+        self._lock_ = threading.Lock()
+
+    def exclusive(self):
+        '''Context manager holding the lock for writing'''
+        return self._hold_(fcntl.LOCK_EX if fcntl else None)
+
+    def shared(self):
+        '''Context manager holding the lock for reading'''
+        return self._hold_(fcntl.LOCK_SH if fcntl else None)
+
+    @contextlib.contextmanager
+    def _hold_(self, mode):
+        # flock does not order the threads of one process, the thread lock does
+        with self._lock_:
+            with open(self.path, 'a') as lockfile:
+                if mode is not None:
+                    fcntl.flock(lockfile.fileno(), mode)
+                # Closing the file releases the flock
+                yield
 
 class MapStorage:
-    '''Class that manages everything related to the JSON files'''
-    @staticmethod
-    def open_rooms_db():
-        '''Reads the JSON file Rooms.json'''
-        with open(ROOMS_FILE, 'r') as roomsfile:
-            rooms = json.load(roomsfile)
-        return rooms
-
-    @staticmethod
-    def write_rooms_db(rooms):
-        '''Overwrites the JSON file Rooms.json'''
-        with open(ROOMS_FILE, 'w') as roomsfile:
-            json.dump(rooms, roomsfile, indent=4)
+    '''Resident room store backed by a snapshot plus an append-only journal
+
+    One instance is shared by every servant of a process. Several processes
+    may share the files: journal appends, compactions and managers.json
+    updates hold an advisory FileLock, and a compaction that finds records
+    of another process rebuilds the snapshot from the files instead of
+    from memory.
+    '''
+    # pylint: disable=R0913
+    def __init__(self, rooms_file=ROOMS_FILE, managers_file=MANAGERS_FILE,
+                 journal_file=JOURNAL_FILE, flush_interval=FLUSH_INTERVAL,
+                 fsync_policy=FSYNC_POLICY, compact_records=COMPACT_RECORDS,
+                 compress_rooms=True):
+        if fsync_policy not in FSYNC_POLICIES:
+            raise ValueError('Unknown fsync policy: {}'.format(fsync_policy))
+        self.rooms_file = rooms_file
+        self.managers_file = managers_file
+        self.journal_file = journal_file
+        self.flush_interval = flush_interval
+        self.fsync_policy = fsync_policy
+        self.compact_records = compact_records
+        self.compress_rooms = compress_rooms
+        # room_name -> StoredRoom
+        self._rooms_ = {}
+        # Body key -> RoomBody shared by the stored rooms with that content,
+        # and how many of them there are
+        self._bodies_ = {}
+        self._body_refs_ = collections.Counter()
+        # user_name -> set of room names
+        self._owners_ = {}
+        # Sorted '{Room:User}' listings, rebuilt after a mutation
+        self._listing_ = None
+        self._owner_listings_ = {}
+        # Called with the name of every room stored, replaced or removed
+        self._room_listeners_ = []
+        self._lock_ = threading.Lock()
+        self._pending_ = threading.Condition(self._lock_)
+        self._flush_lock_ = threading.Lock()
+        self._records_ = []
+        self._journal_size_ = 0
+        self._closed_ = False
+        self._flusher_ = None
+        self.metrics = instrumentation.DISABLED
+        self.rooms_lock = FileLock(rooms_file)
+        self.managers_lock = FileLock(managers_file)
+        # (snapshot stat, journal size) after the last write of this process
+        self._disk_state_ = None
+        # Set once another process wrote the files: memory lacks its records until the
+        # next load, so every compaction rebuilds the snapshot from the files
+        self._written_by_others_ = False
+        # (version, room_name, user_name, removed, digest) of the latest local changes
+        self._changes_ = collections.deque(maxlen=CHANGE_LOG_SIZE)
+        self._changes_floor_ = 0
+        self._version_ = 0
+
+    @classmethod
+    def from_properties(cls, properties):
+        '''Builds a MapStorage using the MapStorage.* Ice properties'''
+        return cls(
+            rooms_file=properties.getPropertyWithDefault('MapStorage.RoomsFile', ROOMS_FILE),
+            managers_file=properties.getPropertyWithDefault(
+                'MapStorage.ManagersFile', MANAGERS_FILE),
+            journal_file=properties.getPropertyWithDefault(
+                'MapStorage.JournalFile', JOURNAL_FILE),
+            flush_interval=float(properties.getPropertyWithDefault(
+                'MapStorage.FlushInterval', str(FLUSH_INTERVAL))),
+            fsync_policy=properties.getPropertyWithDefault('MapStorage.Fsync', FSYNC_POLICY),
+            compact_records=properties.getPropertyAsIntWithDefault(
+                'MapStorage.CompactRecords', COMPACT_RECORDS),
+            compress_rooms=properties.getPropertyAsIntWithDefault(
+                'MapStorage.CompressRooms', 1) > 0
+        )
+
+    def load(self):
+        '''Loads the snapshot, replays the journal and starts the flusher'''
+        with self.rooms_lock.shared():
+            rooms, replayed = self.read_disk_rooms()
+            self._disk_state_ = self._read_disk_state_()
+            self._written_by_others_ = False
+        bodies = {}
+        rooms = {
+            room_name: self._store_room_(user_name, room, bodies=bodies)
+            for room_name, (user_name, room) in rooms.items()
+        }
+        with self._lock_:
+            self._rooms_ = {}
+            self._bodies_ = {}
+            self._body_refs_ = collections.Counter()
+            self._owners_ = {}
+            self._listing_ = None
+            self._owner_listings_ = {}
+            for room_name, stored_room in rooms.items():
+                self._put_room_(room_name, stored_room)
+            self._records_ = []
+            self._journal_size_ = 0
+            self._closed_ = False
+            # Versions keep growing across restarts, so peers detect the lost change log
+            self._version_ = max(self._version_, int(time.time() * 1000))
+            self._changes_.clear()
+            self._changes_floor_ = self._version_
+        if replayed:
+            # Fold the replayed tail (and any torn record) into a new snapshot
+            self.compact()
+        self._flusher_ = threading.Thread(target=self._flush_loop_, daemon=True)
+        self._flusher_.start()
+
+    def close(self):
+        '''Stops the flusher and writes any pending record to disk'''
+        with self._lock_:
+            self._closed_ = True
+            self._pending_.notify()
+        if self._flusher_ is not None:
+            self._flusher_.join()
+            self._flusher_ = None
+        self.flush()
+
+    def flush(self):
+        '''Appends the pending records to the journal, compacting if it grew too much'''
+        self._write_out_(False)
+
+    def compact(self):
+        '''Writes a full snapshot and empties the journal'''
+        self._write_out_(True)
+
+    def _write_out_(self, compact):
+        '''Appends the pending records and, if compact or due, rewrites the snapshot'''
+        with self._flush_lock_:
+            with self._lock_:
+                records = self._records_
+                self._records_ = []
+                self._journal_size_ += len(records)
+                compact = compact or self._journal_size_ >= self.compact_records
+                snapshot = dict(self._rooms_) if compact else None
+            if not records and not compact:
+                return
+            appended = not records
+            try:
+                with self.rooms_lock.exclusive():
+                    if self._read_disk_state_() != self._disk_state_:
+                        self._written_by_others_ = True
+                    if records:
+                        self.append_journal(records)
+                        appended = True
+                    if compact:
+                        if self._written_by_others_:
+                            # Memory lacks the records of the other processes
+                            snapshot = {
+                                room_name: StoredRoom(
+                                    room.get(room_codec.ROOM_NAME, ''), user_name,
+                                    RoomBody(None, room_body_json(room), None, None, None))
+                                for room_name, (user_name, room)
+                                in self.read_disk_rooms()[0].items()
+                            }
+                        self.write_rooms_db(snapshot)
+                        self.truncate_journal()
+                    self._disk_state_ = self._read_disk_state_()
+            except OSError as error:
+                if not appended:
+                    self._keep_records_(records)
+                    logging.error('Cannot append %s records to %s, kept for the next flush: %s',
+                                  len(records), self.journal_file, error)
+                raise
+            if compact:
+                with self._lock_:
+                    self._journal_size_ = 0
+
+    def _keep_records_(self, records):
+        '''Queues again, before the newer ones, records that could not be appended'''
+        # A torn write may have left part of a record without its line end
+        records = ['\n' + records[0]] + records[1:]
+        with self._lock_:
+            self._records_[:0] = records
+            self._journal_size_ -= len(records)
+            self._pending_.notify()
+
+    def _read_disk_state_(self):
+        '''Returns what tells if another process changed the snapshot or the journal'''
+        try:
+            snapshot = os.stat(self.rooms_file)
+            snapshot_state = (snapshot.st_ino, snapshot.st_mtime_ns, snapshot.st_size)
+        except FileNotFoundError:
+            snapshot_state = None
+        try:
+            journal_size = os.stat(self.journal_file).st_size
+        except FileNotFoundError:
+            journal_size = 0
+        return snapshot_state, journal_size
+
+    def read_disk_rooms(self):
+        '''Returns ({room: (user, room dict)} of the snapshot plus journal, records replayed)'''
+        rooms = {}
+        for room_name, owner_and_room in self.open_rooms_db().items():
+            user_name = list(owner_and_room.keys())[0]
+            rooms[room_name] = (user_name, owner_and_room[user_name])
+        return rooms, self.replay_journal(rooms)
+
+    def _flush_loop_(self):
+        '''Batches every record logged during a flush interval into one append'''
+        while True:
+            with self._lock_:
+                while not self._records_ and not self._closed_:
+                    self._pending_.wait()
+                deadline = time.monotonic() + self.flush_interval
+                while not self._closed_:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._pending_.wait(remaining)
+                if self._closed_:
+                    return
+            try:
+                self.flush()
+            except OSError as error:
+                logging.error('Cannot flush %s: %s', self.journal_file, error)
+
+    def _store_room_(self, user_name, room, grid=None, bodies=None):
+        '''Returns the StoredRoom of a room dict, validating it if grid is not given
+
+        If a stored room (or one in bodies, which is updated) has the same
+        content its body is reused instead of encoded and validated again.
+        '''
+        room_name = room.get(room_codec.ROOM_NAME, '')
+        body_json = room_body_json(room)
+        key = self._body_key_(room_name, content_hash(body_json))
+        body = bodies.get(key) if bodies is not None else None
+        if body is None:
+            with self._lock_:
+                body = self._bodies_.get(key)
+        if body is None:
+            body = self._make_body_(room, key[0], body_json, grid)
+            if bodies is not None:
+                bodies[key] = body
+        else:
+            self.metrics.add('storage.bodies_reused')
+        return StoredRoom(room_name, user_name, body)
+
+    def _make_body_(self, room, digest, body_json, grid):
+        '''Returns the RoomBody of a room dict, validating it if grid is not given'''
+        if grid is None:
+            # Rooms loaded from disk or from other managers are kept even if invalid
+            try:
+                grid = dungeon_engine.validate_room(room)
+            except dungeon_engine.WrongRoom:
+                return RoomBody(digest, body_json,
+                                room_codec.encode_body(room, self.compress_rooms),
+                                None, room_navigation.NavigationData.from_room(room))
+        if set(room) == {room_codec.ROOM_NAME, room_codec.ROOM_DATA}:
+            binary = room_codec.encode_tiles(
+                '', grid.height, grid.width, grid.tiles, self.compress_rooms)
+        else:
+            binary = room_codec.encode_body(room, self.compress_rooms)
+        return RoomBody(digest, body_json, binary, grid,
+                        room_navigation.NavigationData(room[room_codec.ROOM_NAME], grid))
 
     @staticmethod
-    def open_managers_db():
+    def _body_key_(room_name, digest):
+        '''Returns the key of a body in the shared bodies
+
+        Rooms without a valid name fail validation whatever their content, so
+        their bodies are not shared with those of valid rooms.
+        '''
+        return digest, isinstance(room_name, str) and bool(room_name)
+
+    def add_room_listener(self, callback):
+        '''Registers callback(room_name) to be told about every room change'''
+        self._room_listeners_.append(callback)
+
+    def _put_room_(self, room_name, stored_room):
+        '''Stores a room keeping the indexes, must be called holding the lock'''
+        self._pop_room_(room_name)
+        # A body built outside the lock may have been stored meanwhile
+        key = self._body_key_(stored_room.name, stored_room.body.digest)
+        body = self._bodies_.setdefault(key, stored_room.body)
+        if body is not stored_room.body:
+            stored_room = stored_room._replace(body=body)
+        self._body_refs_[key] += 1
+        self._rooms_[room_name] = stored_room
+        self._owners_.setdefault(stored_room.owner, set()).add(room_name)
+        self._owner_listings_.pop(stored_room.owner, None)
+        self._listing_ = None
+        for callback in self._room_listeners_:
+            callback(room_name)
+
+    def _pop_room_(self, room_name):
+        '''Removes a room keeping the indexes, must be called holding the lock'''
+        stored_room = self._rooms_.pop(room_name, None)
+        if stored_room is None:
+            return None
+        key = self._body_key_(stored_room.name, stored_room.body.digest)
+        self._body_refs_[key] -= 1
+        if not self._body_refs_[key]:
+            del self._body_refs_[key]
+            del self._bodies_[key]
+        owner_rooms = self._owners_[stored_room.owner]
+        owner_rooms.discard(room_name)
+        if not owner_rooms:
+            del self._owners_[stored_room.owner]
+        self._owner_listings_.pop(stored_room.owner, None)
+        self._listing_ = None
+        for callback in self._room_listeners_:
+            callback(room_name)
+        return stored_room
+
+    def _log_publish_(self, room_name, user_name, room_data):
+        '''Queues a publish record, must be called holding the lock'''
+        self._records_.append('{{"op": "publish", "room": {}, "user": {}, "data": {}}}\n'.format(
+            json.dumps(room_name), json.dumps(user_name), room_data))
+        self._wake_flusher_()
+
+    def _log_remove_(self, room_name):
+        '''Queues a remove record, must be called holding the lock'''
+        self._records_.append('{{"op": "remove", "room": {}}}\n'.format(json.dumps(room_name)))
+        self._wake_flusher_()
+
+    def _wake_flusher_(self):
+        '''Starts the flush interval when the first record is queued'''
+        # Later records must not cut the interval short
+        if len(self._records_) == 1:
+            self._pending_.notify()
+
+    def append_journal(self, records):
+        '''Appends a batch of records to the journal'''
+        contents = ''.join(records)
+        self.metrics.add('storage.journal_bytes_written', len(contents))
+        with open(self.journal_file, 'a') as journalfile:
+            journalfile.write(contents)
+            journalfile.flush()
+            if self.fsync_policy == 'always':
+                os.fsync(journalfile.fileno())
+
+    def truncate_journal(self):
+        '''Empties the journal once its records are part of the snapshot'''
+        with open(self.journal_file, 'w') as journalfile:
+            if self.fsync_policy == 'always':
+                os.fsync(journalfile.fileno())
+
+    def replay_journal(self, rooms):
+        '''Applies the journal records over rooms, returns how many were read'''
+        if not os.path.exists(self.journal_file):
+            return 0
+        replayed = 0
+        with open(self.journal_file, 'r') as journalfile:
+            for line in journalfile:
+                self.metrics.add('storage.journal_bytes_read', len(line))
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # A crashed writer may leave a torn record before those of other processes
+                    logging.warning('Ignoring torn record in %s', self.journal_file)
+                    replayed += 1
+                    continue
+                if record['op'] == 'publish':
+                    rooms[record['room']] = (record['user'], record['data'])
+                else:
+                    rooms.pop(record['room'], None)
+                replayed += 1
+        return replayed
+
+    def _log_change_(self, room_name, user_name, removed, digest=''):
+        '''Adds a local change to the change log, must be called holding the lock'''
+        self._version_ += 1
+        if len(self._changes_) == self._changes_.maxlen:
+            self._changes_floor_ = self._changes_[0][0]
+        self._changes_.append((self._version_, room_name, user_name, removed, digest))
+
+    def current_version(self):
+        '''Returns the version of the last local change'''
+        with self._lock_:
+            return self._version_
+
+    def get_changes_since(self, version):
+        '''Returns the local changes newer than version, oldest first'''
+        with self._lock_:
+            if version < self._changes_floor_ or version > self._version_:
+                raise IceGauntlet.VersionGap()
+            changes = list()
+            for change in reversed(self._changes_):
+                if change[0] <= version:
+                    break
+                changes.append(change)
+        changes.reverse()
+        return changes
+
+    def open_rooms_db(self):
         '''Reads the JSON file Rooms.json'''
-        with open(MANAGERS_FILE, 'r') as managersfile:
+        if not os.path.exists(self.rooms_file):
+            return {}
+        with open(self.rooms_file, 'r') as roomsfile:
+            contents = roomsfile.read()
+        self.metrics.add('storage.snapshot_bytes_read', len(contents))
+        return json.loads(contents)
+
+    def write_rooms_db(self, rooms):
+        '''Atomically replaces rooms.json with the given rooms'''
+        contents = '{{{}}}'.format(', '.join(
+            '{}: {{{}: {}}}'.format(json.dumps(room_name), json.dumps(room.owner), room.data)
+            for room_name, room in rooms.items()
+        ))
+        self.metrics.add('storage.snapshot_bytes_written', len(contents))
+        self._atomic_write_(self.rooms_file, contents)
+
+    def _atomic_write_(self, file_name, contents):
+        '''Writes to a temporary file and renames it over file_name'''
+        directory = os.path.dirname(os.path.abspath(file_name))
+        temp_name = '{}.tmp'.format(file_name)
+        with open(temp_name, 'w') as tempfile:
+            tempfile.write(contents)
+            tempfile.flush()
+            if self.fsync_policy == 'always':
+                os.fsync(tempfile.fileno())
+        os.replace(temp_name, file_name)
+        if self.fsync_policy == 'always':
+            directory_fd = os.open(directory, os.O_RDONLY)
+            try:
+                os.fsync(directory_fd)
+            finally:
+                os.close(directory_fd)
+
+    def open_managers_db(self):
+        '''Reads the JSON file Managers.json'''
+        if not os.path.exists(self.managers_file):
+            return {}
+        with open(self.managers_file, 'r') as managersfile:
             managers = json.load(managersfile)
         return managers
 
-    @staticmethod
-    def write_managers_db(managers):
-        '''Overwrites the JSON file Rooms.json'''
-        with open(MANAGERS_FILE, 'w') as managersfile:
-            json.dump(managers, managersfile, indent=4)
-
-    def commit_room(self, user_name, room_data):
-        '''Saves the map in the rooms.json file'''
-        rooms = self.open_rooms_db()
-        new_room = json.loads(room_data)
+    def write_managers_db(self, managers):
+        '''Atomically replaces the JSON file Managers.json'''
+        self._atomic_write_(self.managers_file, json.dumps(managers, indent=4))
 
+    @staticmethod
+    def parse_room(room_data):
+        '''Returns the name, dict and validated TileGrid of a room sent by a client'''
         try:
-            __rooms__ = rooms.keys()
-
-            if len(__rooms__) != 0:
-                if new_room["room"] in __rooms__:
-                    new_room_name = new_room[list(new_room.keys())[1]]
-                    if user_name != list(rooms[new_room_name].keys())[0]:
-                        raise IceGauntlet.RoomAlreadyExists()
-        except KeyError:
-            raise IceGauntlet.WrongRoomFormat()
-
-        rooms[new_room["room"]] = {}
-        rooms[new_room["room"]][user_name] = {}
-        rooms[new_room["room"]][user_name] = new_room
+            new_room = json.loads(room_data)
+        except (ValueError, TypeError) as error:
+            raise IceGauntlet.WrongRoomFormat('Invalid JSON: {}'.format(error))
+        try:
+            grid = dungeon_engine.validate_room(new_room)
+        except dungeon_engine.WrongRoom as error:
+            raise IceGauntlet.WrongRoomFormat(str(error))
+        return new_room["room"], new_room, grid
 
-        self.write_rooms_db(rooms)
+    @staticmethod
+    def guess_room_name(room_data, position):
+        '''Returns the name of a room that is not valid, or its position in the batch'''
+        try:
+            room_name = json.loads(room_data).get('room')
+        except (ValueError, TypeError, AttributeError):
+            room_name = None
+        if isinstance(room_name, str) and room_name:
+            return room_name
+        return '#{}'.format(position)
 
-        return new_room["room"]
+    def commit_room(self, user_name, room_data):
+        '''Saves the map in the room store'''
+        new_room_name, new_room, grid = self.parse_room(room_data)
+        stored_room = self._store_room_(user_name, new_room, grid)
+        with self._lock_:
+            if new_room_name in self._rooms_:
+                if user_name != self._rooms_[new_room_name].owner:
+                    raise IceGauntlet.RoomAlreadyExists()
+            self._put_room_(new_room_name, stored_room)
+            self._log_publish_(new_room_name, user_name, stored_room.data)
+            self._log_change_(new_room_name, user_name, False, stored_room.body.digest)
+
+        return new_room_name
 
     def uncommit_room(self, user_name, room_name):
-        '''Removes the map from the rooms.json file'''
-        rooms = self.open_rooms_db()
-
-        if room_name not in rooms:
-            raise IceGauntlet.RoomNotExists()
-        if user_name != list(rooms[room_name].keys())[0]:
-            raise IceGauntlet.RoomNotExists()
-        rooms.pop(room_name)
-
-        self.write_rooms_db(rooms)
+        '''Removes the map from the room store'''
+        with self._lock_:
+            if room_name not in self._rooms_:
+                raise IceGauntlet.RoomNotExists()
+            if user_name != self._rooms_[room_name].owner:
+                raise IceGauntlet.RoomNotExists()
+            self._pop_room_(room_name)
+            self._log_remove_(room_name)
+            self._log_change_(room_name, user_name, True)
+
+    def commit_rooms(self, user_name, rooms_data):
+        '''Saves many maps of user at once, returns a (room name, error) list'''
+        results = list()
+        new_rooms = list()
+        bodies = {}
+        for position, room_data in enumerate(rooms_data, 1):
+            try:
+                new_room_name, new_room, grid = self.parse_room(room_data)
+            except IceGauntlet.WrongRoomFormat as error:
+                results.append((self.guess_room_name(room_data, position),
+                                'WrongRoomFormat: {}'.format(error.reason)))
+                continue
+            new_rooms.append((len(results), new_room_name,
+                              self._store_room_(user_name, new_room, grid, bodies)))
+            results.append((new_room_name, ''))
+        with self._lock_:
+            for index, new_room_name, stored_room in new_rooms:
+                if new_room_name in self._rooms_:
+                    if user_name != self._rooms_[new_room_name].owner:
+                        results[index] = (new_room_name, 'RoomAlreadyExists')
+                        continue
+                self._put_room_(new_room_name, stored_room)
+                self._log_publish_(new_room_name, user_name, stored_room.data)
+                self._log_change_(new_room_name, user_name, False, stored_room.body.digest)
+        return results
+
+    def uncommit_rooms(self, user_name, room_names):
+        '''Removes many maps of user at once, returns a (room name, error) list'''
+        results = list()
+        with self._lock_:
+            for room_name in room_names:
+                if room_name not in self._rooms_ or user_name != self._rooms_[room_name].owner:
+                    results.append((room_name, 'RoomNotExists'))
+                    continue
+                self._pop_room_(room_name)
+                self._log_remove_(room_name)
+                self._log_change_(room_name, user_name, True)
+                results.append((room_name, ''))
+        return results
 
     def commit_room_event(self, user_name, room_data):
-        '''Saves the map in the rooms.json file'''
-        rooms = self.open_rooms_db()
-        new_room = json.loads(room_data)
-
-        rooms[new_room["room"]] = {}
-        rooms[new_room["room"]][user_name] = {}
-        rooms[new_room["room"]][user_name] = new_room
+        '''Saves a map received from another RoomManager'''
+        self.commit_rooms_event([(user_name, room_data)])
 
-        self.write_rooms_db(rooms)
+    def commit_rooms_event(self, users_and_rooms):
+        '''Saves a batch of (user, room data) received from another RoomManager'''
+        new_rooms = list()
+        bodies = {}
+        for user_name, room_data in users_and_rooms:
+            new_room = json.loads(room_data)
+            new_rooms.append((new_room["room"], self._store_room_(user_name, new_room,
+                                                                  bodies=bodies)))
+        with self._lock_:
+            for new_room_name, stored_room in new_rooms:
+                self._put_room_event_(new_room_name, stored_room)
+
+    def commit_rooms_by_hash(self, rooms):
+        '''Saves the (room, user, content hash) of another RoomManager already stored here
+
+        Returns the (room, user) pairs whose content is not stored and must be fetched.
+        '''
+        missing = list()
+        with self._lock_:
+            for room_name, user_name, digest in rooms:
+                body = self._bodies_.get(self._body_key_(room_name, digest))
+                if body is None:
+                    missing.append((room_name, user_name))
+                else:
+                    self._put_room_event_(room_name, StoredRoom(room_name, user_name, body))
+        return missing
+
+    def _put_room_event_(self, room_name, stored_room):
+        '''Stores a room of another RoomManager if it changed, must be called holding the lock'''
+        current = self._rooms_.get(room_name)
+        if current is not None and current.owner == stored_room.owner \
+           and current.body.digest == stored_room.body.digest:
+            return
+        self._put_room_(room_name, stored_room)
+        self._log_publish_(room_name, stored_room.owner, stored_room.data)
 
     def uncommit_room_event(self, room_name):
-        '''Removes the map from the rooms.json file'''
-        rooms = self.open_rooms_db()
-        rooms.pop(room_name)
-        self.write_rooms_db(rooms)
+        '''Removes a map deleted in another RoomManager'''
+        with self._lock_:
+            if self._pop_room_(room_name) is not None:
+                self._log_remove_(room_name)
 
     def get_rooms(self):
         '''Returns a list with all the room names'''
-        rooms = self.open_rooms_db()
-        return list(rooms.keys())
+        with self._lock_:
+            return list(self._rooms_.keys())
 
     def get_rooms_with_users(self):
         '''Returns a list with the format:[{Room:User}, ...]'''
-        rooms = self.open_rooms_db()
-
-        rooms_and_users_list = list()
-
-        for room in list(rooms.keys()):
-            dictionary = {}
-            dictionary[room] = {}
-            dictionary[room] = list(rooms[room].keys())[0]
-            rooms_and_users_list.append(json.dumps(dictionary))
-
-        return rooms_and_users_list
+        with self._lock_:
+            return list(self._get_listing_())
+
+    def get_rooms_with_users_page(self, offset, limit, owner=''):
+        '''Returns a slice of the [{Room:User}, ...] listing, only of owner if given'''
+        offset = max(offset, 0)
+        if limit <= 0 or limit > MAX_PAGE_SIZE:
+            limit = MAX_PAGE_SIZE
+        with self._lock_:
+            listing = self._get_owner_listing_(owner) if owner else self._get_listing_()
+            return listing[offset:offset + limit]
+
+    def _get_listing_(self):
+        '''Returns the cached listing of every room, must be called holding the lock'''
+        if self._listing_ is None:
+            self._listing_ = [
+                json.dumps({room_name: self._rooms_[room_name].owner})
+                for room_name in sorted(self._rooms_)
+            ]
+        return self._listing_
+
+    def _get_owner_listing_(self, owner):
+        '''Returns the cached listing of the rooms of owner, must be called holding the lock'''
+        listing = self._owner_listings_.get(owner)
+        if listing is None:
+            listing = [
+                json.dumps({room_name: owner})
+                for room_name in sorted(self._owners_.get(owner, ()))
+            ]
+            if owner in self._owners_:
+                self._owner_listings_[owner] = listing
+        return listing
+
+    def get_rooms_data(self, room_names):
+        '''Returns a dict with the information of the existing rooms given their names'''
+        with self._lock_:
+            return {
+                room_name: self._rooms_[room_name].data
+                for room_name in room_names if room_name in self._rooms_
+            }
 
     def get_room_data(self, room_name):
         '''Returns the information of an specific room given the name'''
-        rooms = self.open_rooms_db()
-        user_name = list(rooms[room_name].keys())[0]
-        return json.dumps(rooms[room_name][user_name])
+        with self._lock_:
+            return self._rooms_[room_name].data
+
+    def get_hashed_room(self, room_name, known_hash=''):
+        '''Returns (information, content hash) of a room, None if known_hash is its hash'''
+        with self._lock_:
+            stored_room = self._rooms_[room_name]
+            if stored_room.body.digest == known_hash:
+                return None
+            return stored_room.data, stored_room.body.digest
+
+    def get_room_binary(self, room_name):
+        '''Returns the binary encoding of an specific room given the name'''
+        with self._lock_:
+            return self._rooms_[room_name].binary
+
+    def get_room_grid(self, room_name):
+        '''Returns the validated TileGrid of a room, None if it was not validated'''
+        with self._lock_:
+            return self._rooms_[room_name].body.grid
+
+    def get_navigation(self, room_name):
+        '''Returns the navigation data of a room, None if it is not a tile grid'''
+        with self._lock_:
+            return self._rooms_[room_name].body.navigation
+
+    def stats(self):
+        '''Returns how many rooms and distinct room bodies are stored'''
+        with self._lock_:
+            return {'rooms': len(self._rooms_), 'bodies': len(self._bodies_)}
 
     def commit_manager(self, manager_id):
         '''Saves the identifier of a RoomManager'''
-        managers = self.open_managers_db()
-        managers[manager_id] = {}
-        self.write_managers_db(managers)
+        with self.managers_lock.exclusive():
+            managers = self.open_managers_db()
+            if manager_id in managers:
+                return
+            managers[manager_id] = {}
+            self.write_managers_db(managers)
 
     def get_managers(self):
         '''Returns a list with all the RoomManager IDs'''
-        managers = self.open_managers_db()
+        with self.managers_lock.shared():
+            managers = self.open_managers_db()
         return list(managers.keys())
 
 class MapManServer(Ice.Application):
@@ -279,6 +1411,13 @@ class MapManServer(Ice.Application):
         #args = self.parse_args(argv)
         args = ''
         broker = self.communicator()
+        metrics = instrumentation.from_properties(broker.getProperties())
+        map_storage = MapStorage.from_properties(broker.getProperties())
+        metrics.instrument(map_storage, 'MapStorage', STORAGE_OPERATIONS)
+        map_storage.load()
+        token_cache = TokenCache.from_properties(broker.getProperties())
+        metrics.add_gauge('token_cache', token_cache.stats)
+        metrics.add_gauge('map_storage', map_storage.stats)
         topic_mgr = self.get_topic_manager(broker)
         room_adapter = broker.createObjectAdapter("RoomManagerAdapter")
         event_adapter = broker.createObjectAdapter("EventAdapter")
@@ -287,9 +1426,22 @@ class MapManServer(Ice.Application):
 
         topic = self.prepare_topic(topic_mgr)
         publisher = self.prepare_publisher(topic)
-        subscriber = self.prepare_subscriber(event_adapter, topic, broker, publisher)
-
-        self.prepare_proxies(room_adapter, broker, publisher, args)
+        subscriber, sync = self.prepare_subscriber(
+            event_adapter, topic, broker, publisher, map_storage)
+        metrics.instrument(sync, 'RoomManagerSync',
+                           instrumentation.slice_operations(IceGauntlet.RoomManagerSync))
+        revocation_topic = self.prepare_topic(topic_mgr, REVOCATION_TOPIC)
+        revocation_subscriber = self.prepare_revocation_subscriber(
+            event_adapter, revocation_topic, token_cache)
+
+        engine = self.prepare_engine(broker.getProperties(), map_storage)
+        channels = self.prepare_area_channels(event_adapter, topic_mgr, engine)
+
+        self.prepare_proxies(room_adapter, broker, publisher, map_storage, token_cache,
+                             engine, channels, sync, metrics, args)
+        admin_proxy = instrumentation.serve(broker, metrics)
+        if admin_proxy is not None:
+            logging.info('Metrics: %s', admin_proxy)
 
         self.say_hello(publisher)
 
@@ -298,6 +1450,10 @@ class MapManServer(Ice.Application):
         self.shutdownOnInterrupt()
         broker.waitForShutdown()
         topic.unsubscribe(subscriber)
+        revocation_topic.unsubscribe(revocation_subscriber)
+        channels.release_all()
+        map_storage.close()
+        logging.info('Token cache: %s', token_cache.stats())
         return 0
 
     @staticmethod
@@ -312,9 +1468,8 @@ class MapManServer(Ice.Application):
         return IceStorm.TopicManagerPrx.checkedCast(proxy)
 
     @staticmethod
-    def prepare_topic(topic_mgr):
+    def prepare_topic(topic_mgr, topic_name="RoomManagerSyncChannel"):
         '''Returns a Topic object'''
-        topic_name = "RoomManagerSyncChannel"
         try:
             topic = topic_mgr.retrieve(topic_name)
         # pylint: disable=E1101
@@ -330,32 +1485,74 @@ class MapManServer(Ice.Application):
         return publisher
 
     @staticmethod
-    def prepare_subscriber(adapter, topic, broker, publisher):
-        '''Returns a Subscriber Object'''
-        room_manager_sync_servant = RoomManagerSync(publisher, broker)
-        subscriber = adapter.addWithUUID(room_manager_sync_servant)
+    def prepare_subscriber(adapter, topic, broker, publisher, map_storage):
+        '''Returns a Subscriber Object and its RoomManagerSync servant'''
+        room_manager_sync_servant = RoomManagerSync(publisher, broker, map_storage)
+        subscriber = add_to_replica(adapter, room_manager_sync_servant)
+        topic.subscribeAndGetPublisher({}, subscriber)
+        return subscriber, room_manager_sync_servant
+
+    @staticmethod
+    def prepare_revocation_subscriber(adapter, topic, token_cache):
+        '''Subscribes the token cache to the revocations of the Authentication server'''
+        revocation_servant = TokenRevocation(token_cache)
+        subscriber = add_to_replica(adapter, revocation_servant)
         topic.subscribeAndGetPublisher({}, subscriber)
         return subscriber
 
+    # pylint: disable=R0913
     @staticmethod
-    def prepare_proxies(adapter, broker, publisher, args):
+    def prepare_proxies(adapter, broker, publisher, map_storage, token_cache,
+                        engine, channels, sync, metrics, args):
         '''Gets the Remote Object references'''
         global ROOM_MANAGER_PROXY
+        global REPLICA_PROXY
+        global MANAGER_ID
         global DUNGEON_PROXY
 
-        room_manager_servant = RoomManager(broker, publisher, args)
-        identifier = broker.getProperties().getProperty('Identity')
-        ROOM_MANAGER_PROXY = adapter.add(room_manager_servant, broker.stringToIdentity(identifier))
+        room_manager_servant = RoomManager(
+            broker, publisher, map_storage, token_cache, args, sync)
+        metrics.instrument(room_manager_servant, 'RoomManager',
+                           instrumentation.slice_operations(IceGauntlet.RoomManager))
+        identity = broker.stringToIdentity(broker.getProperties().getProperty('Identity'))
+        # Under IceGrid this is the replica group proxy
+        ROOM_MANAGER_PROXY = adapter.add(room_manager_servant, identity)
+        REPLICA_PROXY = IceGauntlet.RoomManagerPrx.uncheckedCast(replica_proxy(adapter, identity))
+        MANAGER_ID = broker.proxyToString(REPLICA_PROXY)
+
+        adapter.addDefaultServant(DungeonArea(engine, channels), AREA_CATEGORY)
+        dungeon_servant = Dungeon(engine)
+        DUNGEON_PROXY = add_to_replica(adapter, dungeon_servant)
 
-        dungeon_servant = Dungeon()
-        DUNGEON_PROXY = adapter.addWithUUID(dungeon_servant)
+    @staticmethod
+    def prepare_engine(properties, map_storage):
+        '''Returns the DungeonEngine that serves the stored rooms'''
+        engine = dungeon_engine.DungeonEngine(
+            map_storage.get_rooms, map_storage.get_room_binary,
+            max_areas=properties.getPropertyAsIntWithDefault(
+                'Dungeon.MaxAreas', dungeon_engine.MAX_AREAS),
+            max_templates=properties.getPropertyAsIntWithDefault(
+                'Dungeon.MaxTemplates', dungeon_engine.MAX_TEMPLATES),
+            dungeon_length=properties.getPropertyAsIntWithDefault(
+                'Dungeon.Length', dungeon_engine.DUNGEON_LENGTH),
+            navigation_loader=map_storage.get_navigation,
+            grid_loader=map_storage.get_room_grid
+        )
+        map_storage.add_room_listener(engine.invalidate_room)
+        return engine
+
+    @staticmethod
+    def prepare_area_channels(adapter, topic_mgr, engine):
+        '''Serves the event channels of the areas'''
+        adapter.addDefaultServant(DungeonAreaSync(engine), AREA_SYNC_CATEGORY)
+        channels = AreaChannels(topic_mgr, adapter)
+        engine.add_evict_listener(channels.release)
+        return channels
 
     @staticmethod
     def say_hello(publisher):
         '''Throws the Hello Event'''
-        manager = IceGauntlet.RoomManagerPrx.uncheckedCast(ROOM_MANAGER_PROXY)
-        manager_id = '{}'.format(ROOM_MANAGER_PROXY)
-        publisher.hello(manager, manager_id)
+        publisher.hello(REPLICA_PROXY, MANAGER_ID)
 
     def show_proxies(self):
         '''Prints the Room Manager proxy and saves the Dungeon Proxy'''
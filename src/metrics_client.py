@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# pylint: disable=W0613
+
+'''
+    Metrics Client
+
+    Reads the IceGauntletMetrics admin facet of a server started with
+    Metrics.Enabled=1. Under IceGrid the admin proxy of a server is given
+    by "icegridadmin -e 'server describe <id>'"; otherwise set
+    Ice.Admin.Endpoints and Ice.Admin.InstanceName, the proxy then is
+    "<InstanceName>/admin:<endpoints>".
+'''
+
+import sys
+import json
+import argparse
+
+import Ice
+import slice_stubs
+slice_stubs.load_slice()
+# pylint: disable=E0401
+# pylint: disable=C0413
+import IceGauntlet
+import instrumentation
+
+
+class MetricsClient(Ice.Application):
+    '''Metrics client'''
+    def run(self, argv):
+        try:
+            args = self.parse_args(argv)
+            proxy = self.communicator().stringToProxy(args.Proxy)
+            # None also when the server runs without Metrics.Enabled=1
+            metrics = IceGauntlet.ServerMetricsPrx.checkedCast(proxy, instrumentation.FACET)
+            if not metrics:
+                raise RuntimeError('Invalid proxy')
+
+            snapshot = json.loads(metrics.getMetrics())
+            if args.Json:
+                print(json.dumps(snapshot, indent=4))
+            else:
+                self.show_snapshot(snapshot)
+            if args.Reset:
+                metrics.resetMetrics()
+            return 0
+        except Ice.Exception:
+            print("Proxy no disponible en este momento\nException: Connection Refused")
+            return 2
+        except RuntimeError:
+            print("El servidor no tiene las metricas activadas (Metrics.Enabled=1)")
+            return 3
+
+    @staticmethod
+    def show_snapshot(snapshot):
+        '''Prints the operations sorted by total time, the counters and the gauges'''
+        print("Metricas de los ultimos {:.0f} s".format(snapshot['uptime']))
+        print("{:40} {:>8} {:>6} {:>9} {:>9} {:>9} {:>11}".format(
+            "operacion", "llamadas", "error", "media ms", "p50 ms", "p99 ms", "total ms"))
+        operations = sorted(snapshot['operations'].items(),
+                            key=lambda item: item[1]['total_ms'], reverse=True)
+        for name, operation in operations:
+            print("{:40} {:8d} {:6d} {:9.2f} {:9.2f} {:9.2f} {:11.1f}".format(
+                name, operation['count'], operation['errors'], operation['mean_ms'],
+                operation['p50_ms'], operation['p99_ms'], operation['total_ms']))
+        for name, value in snapshot['counters'].items():
+            print("{:40} {:>8}".format(name, value))
+        for name, value in snapshot['gauges'].items():
+            print("{:40} {}".format(name, json.dumps(value)))
+
+    @staticmethod
+    def parse_args(argv):
+        '''Parse the arguments'''
+        parser = argparse.ArgumentParser()
+        parser.add_argument("Proxy", help="Proxy de administracion del servidor")
+        parser.add_argument("-j", "--Json", action="store_true", help="Mostrar en JSON")
+        parser.add_argument("-r", "--Reset", action="store_true",
+                            help="Poner las metricas a cero despues de leerlas")
+        return parser.parse_args(argv[1:])
+
+
+sys.exit(MetricsClient().main(sys.argv))
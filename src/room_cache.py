@@ -0,0 +1,357 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+    Client-side cache of rooms
+
+    RoomCache keeps the rooms read through a RoomManager, with their content
+    hash, in memory (LRU bounded by RoomCache.MemoryBytes) and on disk (LRU
+    bounded by RoomCache.DiskBytes in RoomCache.Directory). While subscribed
+    to RoomManagerSyncChannel a room in memory is served without asking the
+    servers until an event says it may have changed. Stale rooms, rooms read
+    from disk and rooms older than RoomCache.MaxAge are checked with
+    getRoomIfChanged, which only sends the room back if its hash changed.
+'''
+
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+import collections
+
+import Ice
+import IceStorm
+# pylint: disable=E0401
+import IceGauntlet
+
+SYNC_TOPIC = 'RoomManagerSyncChannel'
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'icegauntlet', 'rooms')
+MEMORY_BYTES = 16 * 1024 * 1024
+DISK_BYTES = 256 * 1024 * 1024
+# Seconds a room is served without checking it, in case an event was lost
+MAX_AGE = 300.0
+# Request context key of the session token for read-your-writes reads
+SESSION_CONTEXT = 'session'
+# Awaited hash of a room whose removal was announced
+REMOVED = 'removed'
+
+
+class CachedRoom:
+    '''JSON text and content hash of a room
+
+    checked is the time.monotonic() it was last known current, None once an
+    event said it may have changed. The replica read may not have the change
+    yet, so the room stays stale until it serves the awaited hash (REMOVED
+    for a removal, None for any), asking with the session token of the change.
+    '''
+    __slots__ = ('data', 'digest', 'checked', 'awaited', 'session')
+
+    # pylint: disable=R0913
+    def __init__(self, data, digest, checked=None, awaited=None, session=''):
+        self.data = data
+        self.digest = digest
+        self.checked = checked
+        self.awaited = awaited
+        self.session = session
+
+
+class RoomSyncListener(IceGauntlet.RoomManagerSync):
+    '''Subscriber of RoomManagerSyncChannel that tells the cache what changed'''
+    def __init__(self, cache):
+        self.cache = cache
+
+    def hello(self, manager, manager_id, current=None):
+        '''Nothing to invalidate'''
+
+    def announce(self, manager, manager_id, current=None):
+        '''Nothing to invalidate'''
+
+    def newRoom(self, room_name, manager_id, current=None):
+        '''publishMany sends one event for many rooms, so ask the manager what changed'''
+        self.cache.manager_changed(manager_id)
+
+    def removedRoom(self, room_name, current=None):
+        '''Waits for the removal of the room'''
+        self.cache.invalidate(room_name, removed=True)
+
+
+class RoomCache:
+    '''Rooms of a RoomManager cached in memory and on disk'''
+    # pylint: disable=R0902,R0913
+    def __init__(self, room_manager, directory=CACHE_DIR, memory_bytes=MEMORY_BYTES,
+                 disk_bytes=DISK_BYTES, max_age=MAX_AGE):
+        self.room_manager = room_manager
+        self.directory = directory
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self.max_age = max_age
+        # hits, checks (unchanged), misses and events
+        self.stats = collections.Counter()
+        # room_name -> CachedRoom, least recently used first
+        self._rooms_ = collections.OrderedDict()
+        self._memory_size_ = 0
+        # file name -> size, least recently used first
+        self._files_ = collections.OrderedDict()
+        self._disk_size_ = 0
+        # Increased by every invalidation, reads that overlap one store a stale room
+        self._generation_ = 0
+        self._lock_ = threading.Lock()
+        # manager_id -> last version whose changes were applied
+        self._versions_ = {}
+        self._events_lock_ = threading.Lock()
+        self._topic_ = None
+        self._subscriber_ = None
+        if directory:
+            self._scan_directory_()
+
+    @classmethod
+    def from_properties(cls, properties, room_manager):
+        '''Builds a RoomCache using the RoomCache.* Ice properties'''
+        return cls(
+            room_manager,
+            directory=properties.getPropertyWithDefault('RoomCache.Directory', CACHE_DIR),
+            memory_bytes=properties.getPropertyAsIntWithDefault(
+                'RoomCache.MemoryBytes', MEMORY_BYTES),
+            disk_bytes=properties.getPropertyAsIntWithDefault('RoomCache.DiskBytes', DISK_BYTES),
+            max_age=float(properties.getPropertyWithDefault('RoomCache.MaxAge', str(MAX_AGE)))
+        )
+
+    @property
+    def subscribed(self):
+        '''Returns if the events of RoomManagerSyncChannel reach the cache'''
+        return self._subscriber_ is not None
+
+    def subscribe(self, topic_manager, adapter):
+        '''Subscribes to RoomManagerSyncChannel, until then every read is checked'''
+        try:
+            topic = topic_manager.retrieve(SYNC_TOPIC)
+        # pylint: disable=E1101
+        except IceStorm.NoSuchTopic:
+            topic = topic_manager.create(SYNC_TOPIC)
+        subscriber = adapter.addWithUUID(RoomSyncListener(self))
+        topic.subscribeAndGetPublisher({}, subscriber)
+        self._topic_ = topic
+        # Changes made before the subscription were not seen
+        self.invalidate_all()
+        self._subscriber_ = subscriber
+
+    def unsubscribe(self):
+        '''Stops receiving the events'''
+        if self._subscriber_ is None:
+            return
+        subscriber = self._subscriber_
+        self._subscriber_ = None
+        try:
+            self._topic_.unsubscribe(subscriber)
+        except Ice.Exception as error:
+            logging.warning('Cannot unsubscribe from %s: %s', SYNC_TOPIC, error)
+
+    def get_room(self, room_name, session=''):
+        '''Returns the JSON text of a room, asking the servers only if it may have changed
+
+        With a session token the room is always checked, on a replica that has
+        the changes of the token. Raises IceGauntlet.RoomNotExists as getRoom.
+        '''
+        with self._lock_:
+            cached = self._rooms_.get(room_name)
+            if cached is not None:
+                self._rooms_.move_to_end(room_name)
+                if not session and self._is_current_(cached):
+                    self.stats['hits'] += 1
+                    return cached.data
+                session = session or cached.session
+            generation = self._generation_
+        if cached is None:
+            cached = self._read_file_(room_name)
+        room_manager = self.room_manager
+        if session:
+            room_manager = room_manager.ice_context({SESSION_CONTEXT: session})
+        try:
+            hashed_room = room_manager.getRoomIfChanged(room_name, cached.digest if cached else '')
+        except IceGauntlet.RoomNotExists:
+            self._forget_(room_name)
+            raise
+        if hashed_room is Ice.Unset:
+            self.stats['checks'] += 1
+            data, digest = cached.data, cached.digest
+        else:
+            self.stats['misses'] += 1
+            data, digest = hashed_room.roomData, hashed_room.contentHash
+            self._write_file_(room_name, data, digest)
+        with self._lock_:
+            # Invalidations made while reading still apply to what was read
+            old = self._rooms_.get(room_name)
+            awaited, session = (old.awaited, old.session) if old is not None else (None, '')
+            if generation == self._generation_ and awaited in (None, digest):
+                self._put_(room_name, CachedRoom(data, digest, time.monotonic()))
+            else:
+                self._put_(room_name, CachedRoom(data, digest, None, awaited, session))
+        return data
+
+    def _is_current_(self, cached):
+        '''Returns if a room may be served without checking it'''
+        return self.subscribed and cached.checked is not None and \
+            time.monotonic() - cached.checked < self.max_age
+
+    def _put_(self, room_name, cached):
+        '''Stores a room in memory evicting the least recently used, hold the lock'''
+        old = self._rooms_.pop(room_name, None)
+        if old is not None:
+            self._memory_size_ -= len(old.data)
+        self._rooms_[room_name] = cached
+        self._memory_size_ += len(cached.data)
+        while self._memory_size_ > self.memory_bytes and len(self._rooms_) > 1:
+            _, evicted = self._rooms_.popitem(last=False)
+            self._memory_size_ -= len(evicted.data)
+
+    def invalidate(self, room_name, digest='', removed=False, session=''):
+        '''Marks a room to be checked on next read, unless digest is still its hash
+
+        The room stays stale until a read returns digest (if given) or finds
+        it removed, session is the token of a replica that has the change.
+        '''
+        with self._lock_:
+            self._generation_ += 1
+            cached = self._rooms_.get(room_name)
+            if cached is not None and (removed or cached.digest != digest):
+                cached.checked = None
+                cached.awaited = REMOVED if removed else digest or None
+                cached.session = session
+        if removed:
+            self._remove_file_(self._file_name_(room_name))
+
+    def _forget_(self, room_name):
+        '''Drops a room that does not exist'''
+        with self._lock_:
+            cached = self._rooms_.pop(room_name, None)
+            if cached is not None:
+                self._memory_size_ -= len(cached.data)
+        self._remove_file_(self._file_name_(room_name))
+
+    def invalidate_all(self):
+        '''Marks every room to be checked on next read'''
+        with self._lock_:
+            self._generation_ += 1
+            for cached in self._rooms_.values():
+                cached.checked = None
+
+    def manager_changed(self, manager_id):
+        '''Invalidates the rooms a RoomManager changed since its last event'''
+        self.stats['events'] += 1
+        manager = IceGauntlet.RoomManagerPrx.uncheckedCast(
+            self.room_manager.ice_getCommunicator().stringToProxy(manager_id))
+        with self._events_lock_:
+            version = self._versions_.get(manager_id)
+            try:
+                if version is None:
+                    raise IceGauntlet.VersionGap()
+                changes = manager.getChangesSince(version)
+            except Ice.Exception:
+                # VersionGap, first event of the manager or unreachable: start over
+                self._versions_.pop(manager_id, None)
+                try:
+                    version = manager.currentVersion()
+                except Ice.Exception as error:
+                    logging.warning('Cannot read the version of %s: %s', manager_id, error)
+                    version = None
+                self.invalidate_all()
+                if version is not None:
+                    self._versions_[manager_id] = version
+                return
+            for change in changes:
+                self.invalidate(change.roomName, change.contentHash, change.removed,
+                                '{}:{}'.format(change.version, manager_id))
+            if changes:
+                self._versions_[manager_id] = changes[-1].version
+
+    @staticmethod
+    def _file_name_(room_name):
+        '''Returns the file name of a room in the cache directory'''
+        return hashlib.sha1(room_name.encode('utf-8')).hexdigest() + '.json'
+
+    def _scan_directory_(self):
+        '''Indexes the files of the cache directory by last use'''
+        try:
+            entries = list(os.scandir(self.directory))
+        except FileNotFoundError:
+            return
+        stats = [(entry.stat(), entry.name) for entry in entries if entry.name.endswith('.json')]
+        with self._lock_:
+            for stat, file_name in sorted(stats, key=lambda item: item[0].st_mtime):
+                self._files_[file_name] = stat.st_size
+                self._disk_size_ += stat.st_size
+
+    def _read_file_(self, room_name):
+        '''Returns the CachedRoom on disk of room_name, None if there is none'''
+        if not self.directory:
+            return None
+        file_name = self._file_name_(room_name)
+        path = os.path.join(self.directory, file_name)
+        try:
+            with open(path, 'r') as roomfile:
+                cached = json.load(roomfile)
+            if cached['room'] != room_name:
+                return None
+            if not isinstance(cached['data'], str) or not isinstance(cached['hash'], str):
+                raise TypeError('Wrong data or hash')
+            os.utime(path)
+        except OSError:
+            return None
+        except (ValueError, KeyError, TypeError) as error:
+            # Written by something else or damaged, read from the server again
+            logging.warning('Removing unreadable cache file %s: %s', path, error)
+            self._remove_file_(file_name)
+            return None
+        with self._lock_:
+            if file_name in self._files_:
+                self._files_.move_to_end(file_name)
+        return CachedRoom(cached['data'], cached['hash'])
+
+    def _write_file_(self, room_name, data, digest):
+        '''Stores a room on disk evicting the least recently used files'''
+        if not self.directory:
+            return
+        file_name = self._file_name_(room_name)
+        contents = json.dumps({'room': room_name, 'hash': digest, 'data': data})
+        path = os.path.join(self.directory, file_name)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            temp_name = '{}.{}.tmp'.format(path, threading.get_ident())
+            with open(temp_name, 'w') as roomfile:
+                roomfile.write(contents)
+            os.replace(temp_name, path)
+        except OSError as error:
+            logging.warning('Cannot write %s: %s', path, error)
+            return
+        evicted = []
+        with self._lock_:
+            self._disk_size_ += len(contents) - self._files_.pop(file_name, 0)
+            self._files_[file_name] = len(contents)
+            while self._disk_size_ > self.disk_bytes and len(self._files_) > 1:
+                old_name, size = self._files_.popitem(last=False)
+                self._disk_size_ -= size
+                evicted.append(old_name)
+        for old_name in evicted:
+            self._remove_file_(old_name)
+
+    def _remove_file_(self, file_name):
+        '''Deletes a file of the cache directory'''
+        if not self.directory:
+            return
+        with self._lock_:
+            self._disk_size_ -= self._files_.pop(file_name, 0)
+        try:
+            os.remove(os.path.join(self.directory, file_name))
+        except FileNotFoundError:
+            pass
+
+
+def topic_manager_from_properties(communicator):
+    '''Returns the IceStorm.TopicManager.Proxy TopicManager, None if it is not set'''
+    proxy = communicator.propertyToProxy('IceStorm.TopicManager.Proxy')
+    if proxy is None:
+        return None
+    # pylint: disable=E1101
+    return IceStorm.TopicManagerPrx.uncheckedCast(proxy)
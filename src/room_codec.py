@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+    Compact binary encoding of IceGauntlet rooms
+
+    Layout (big endian):
+        magic (4s) | format version (B) | flags (B) | height (H) | width (H)
+        | room name length (H) | room name (utf-8) | payload
+
+    The payload holds the tiles row by row, one byte each. Rooms that are not
+    a rectangular grid of tiles in 0..255 (or carry extra keys) are stored as
+    their JSON text with FLAG_JSON set. FLAG_ZLIB means the payload is zlib
+    compressed.
+
+    encode_body leaves the name out of the blob (and of its JSON payload) so
+    rooms with the same content share it; with_name then fills the header.
+'''
+
+import json
+import zlib
+import struct
+
+MAGIC = b'IGRM'
+FORMAT_VERSION = 1
+FLAG_ZLIB = 0x01
+FLAG_JSON = 0x02
+
+HEADER = struct.Struct('>4sBBHHH')
+MAX_TILE = 255
+MAX_SIDE = 0xFFFF
+MAX_NAME_SIZE = 0xFFFF
+
+ROOM_NAME = 'room'
+ROOM_DATA = 'data'
+
+
+class InvalidRoomBinary(Exception):
+    '''The bytes are not an encoded room'''
+
+
+class InvalidRoomName(Exception):
+    '''The room name does not fit in the header'''
+
+
+def encode_name(room_name):
+    '''Returns the utf-8 room name of the header, raises InvalidRoomName if too long'''
+    name = str(room_name).encode('utf-8')
+    if len(name) > MAX_NAME_SIZE:
+        raise InvalidRoomName('Room name too long: {} bytes, at most {}'.format(
+            len(name), MAX_NAME_SIZE))
+    return name
+
+
+def is_tile_grid(room):
+    '''Returns if the room can be stored as a packed tile grid'''
+    if set(room.keys()) != {ROOM_NAME, ROOM_DATA} or not isinstance(room[ROOM_NAME], str):
+        return False
+    rows = room[ROOM_DATA]
+    if not isinstance(rows, list) or not rows or len(rows) > MAX_SIDE:
+        return False
+    width = len(rows[0]) if isinstance(rows[0], list) else -1
+    if width <= 0 or width > MAX_SIDE:
+        return False
+    for row in rows:
+        if not isinstance(row, list) or len(row) != width:
+            return False
+        for tile in row:
+            if type(tile) is not int or not 0 <= tile <= MAX_TILE:  # pylint: disable=C0123
+                return False
+    return True
+
+
+def encode_room(room, compress=True):
+    '''Returns the binary form of a room dict'''
+    if is_tile_grid(room):
+        height = len(room[ROOM_DATA])
+        width = len(room[ROOM_DATA][0])
+        return encode_tiles(room[ROOM_NAME], height, width,
+                            b''.join(bytes(row) for row in room[ROOM_DATA]), compress)
+    name = encode_name(room.get(ROOM_NAME, ''))
+    return _pack_(FLAG_JSON, name, 0, 0, json.dumps(room).encode('utf-8'), compress)
+
+
+def encode_tiles(room_name, height, width, tiles, compress=True):
+    '''Returns the binary form of a room already packed as row major tile bytes'''
+    return _pack_(0, encode_name(room_name), height, width, bytes(tiles), compress)
+
+
+def encode_body(room, compress=True):
+    '''Returns the binary form of a room without its name, see with_name'''
+    body = {key: value for key, value in room.items() if key != ROOM_NAME}
+    if is_tile_grid(dict(body, **{ROOM_NAME: ''})):
+        rows = body[ROOM_DATA]
+        return encode_tiles('', len(rows), len(rows[0]),
+                            b''.join(bytes(row) for row in rows), compress)
+    return _pack_(FLAG_JSON, b'', 0, 0, json.dumps(body).encode('utf-8'), compress)
+
+
+def with_name(blob, room_name):
+    '''Returns blob with room_name in its header'''
+    name_size = HEADER.unpack_from(blob)[-1]
+    name = encode_name(room_name)
+    return blob[:HEADER.size - 2] + struct.pack('>H', len(name)) + name + \
+        blob[HEADER.size + name_size:]
+
+
+def _pack_(flags, name, height, width, payload, compress):
+    '''Returns the header, name and (maybe compressed) payload of a room'''
+    if compress:
+        compressed = zlib.compress(payload)
+        if len(compressed) < len(payload):
+            flags |= FLAG_ZLIB
+            payload = compressed
+    return HEADER.pack(MAGIC, FORMAT_VERSION, flags, height, width, len(name)) + name + payload
+
+
+def _unpack_(blob):
+    '''Returns (flags, room name, height, width, uncompressed payload)'''
+    blob = bytes(blob)
+    if len(blob) < HEADER.size:
+        raise InvalidRoomBinary('Truncated header')
+    magic, version, flags, height, width, name_size = HEADER.unpack_from(blob)
+    if magic != MAGIC or version != FORMAT_VERSION:
+        raise InvalidRoomBinary('Unknown format')
+    name_end = HEADER.size + name_size
+    name = blob[HEADER.size:name_end].decode('utf-8')
+    payload = blob[name_end:]
+    if flags & FLAG_ZLIB:
+        try:
+            payload = zlib.decompress(payload)
+        except zlib.error as error:
+            raise InvalidRoomBinary(str(error))
+    if not flags & FLAG_JSON and len(payload) != height * width:
+        raise InvalidRoomBinary('Payload does not match the grid size')
+    return flags, name, height, width, payload
+
+
+def decode_tiles(blob):
+    '''Returns (room name, height, width, tiles) without building nested lists
+
+    tiles are the row major tile bytes, None if the room is not a tile grid.
+    '''
+    flags, name, height, width, payload = _unpack_(blob)
+    if flags & FLAG_JSON:
+        return name, 0, 0, None
+    return name, height, width, payload
+
+
+def decode_room(blob):
+    '''Returns the room dict stored in blob'''
+    flags, name, height, width, payload = _unpack_(blob)
+    if flags & FLAG_JSON:
+        room = json.loads(payload.decode('utf-8'))
+        if name:
+            # Payloads of encode_body leave the name to the header
+            room.setdefault(ROOM_NAME, name)
+        return room
+    return {
+        ROOM_DATA: [list(payload[row * width:(row + 1) * width]) for row in range(height)],
+        ROOM_NAME: name
+    }
@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+    Navigation data derived from the tile grid of a room
+
+    Every row of the walkability mask is a Python int with bit x set when
+    the tile (x, y) can be walked on, so flood fills and breadth first
+    waves advance a whole row per big integer operation instead of one
+    tile at a time. Movement is 4-connected.
+
+    A NavigationData is built once per stored room and shared by every
+    area of the room; it is replaced, together with its cached distance
+    fields, when the room is.
+'''
+
+import heapq
+import array
+import threading
+import collections
+
+import room_codec
+import dungeon_engine
+
+# Distance fields kept per room besides the one to the exits
+DISTANCE_FIELDS = 16
+# Path queries to the same target before its distance field is cached
+FIELD_THRESHOLD = 2
+# Targets counted per cached field before the counters are reset
+FIELD_QUERIES = 64
+
+UNREACHABLE = -1
+NO_COMPONENT = -1
+
+NEIGHBOURS = ((1, 0), (-1, 0), (0, 1), (0, -1))
+
+
+def is_walkable_tile(tile):
+    '''Returns if the tile can be walked on (floor, objects, doors, entrance or exit)'''
+    return tile > dungeon_engine.LAST_WALL_TILE
+
+
+def _iter_bits_(bits):
+    '''Yields the positions of the bits set in an int'''
+    while bits:
+        lowest = bits & -bits
+        yield lowest.bit_length() - 1
+        bits ^= lowest
+
+
+class NavigationData:
+    '''Walkability mask, connected components, doors and path service of a grid'''
+    # pylint: disable=R0902
+    def __init__(self, room_name, grid):
+        self.room_name = room_name
+        self.width = grid.width
+        self.height = grid.height
+        self.rows = [0] * grid.height
+        self.doors = []
+        self.exits = []
+        self.entrance = None
+        for index, tile in enumerate(grid.tiles):
+            pos_x, pos_y = index % grid.width, index // grid.width
+            if is_walkable_tile(tile):
+                self.rows[pos_y] |= 1 << pos_x
+            if tile in dungeon_engine.DOOR_TILES:
+                self.doors.append((pos_x, pos_y))
+            elif tile == dungeon_engine.EXIT_TILE:
+                self.exits.append((pos_x, pos_y))
+            elif tile == dungeon_engine.ENTRANCE_TILE and self.entrance is None:
+                self.entrance = (pos_x, pos_y)
+        self.components, self.component_count = self._label_components_()
+        self.exit_field = self.distance_field(self.exits)
+        # target -> distance field, least recently used first
+        self._fields_ = collections.OrderedDict()
+        # target -> path queries while its field is not cached
+        self._queries_ = collections.Counter()
+        self._lock_ = threading.Lock()
+
+    @classmethod
+    def from_room(cls, room):
+        '''Returns the navigation data of a room dict, None if it is not a tile grid'''
+        if not room_codec.is_tile_grid(room):
+            return None
+        return cls(room[room_codec.ROOM_NAME],
+                   dungeon_engine.TileGrid.from_rows(room[room_codec.ROOM_DATA]))
+
+    def is_walkable(self, pos_x, pos_y):
+        '''Returns if the position is inside the grid and can be walked on'''
+        return 0 <= pos_y < self.height and 0 <= pos_x < self.width and \
+            (self.rows[pos_y] >> pos_x) & 1 == 1
+
+    def component(self, pos_x, pos_y):
+        '''Returns the connected component of a position, NO_COMPONENT for walls'''
+        if not self.is_walkable(pos_x, pos_y):
+            return NO_COMPONENT
+        return self.components[pos_y * self.width + pos_x]
+
+    def connected(self, start, goal):
+        '''Returns if there is a path between two positions'''
+        component = self.component(*start)
+        return component != NO_COMPONENT and component == self.component(*goal)
+
+    def _wave_(self, frontier, visited, low, high):
+        '''Returns the rows reached from the frontier rows low..high in one step'''
+        reached = {}
+        for pos_y in range(max(low - 1, 0), min(high + 2, self.height)):
+            bits = frontier.get(pos_y, 0)
+            spread = bits | (bits << 1) | (bits >> 1) | frontier.get(pos_y - 1, 0) | \
+                frontier.get(pos_y + 1, 0)
+            spread &= self.rows[pos_y] & ~visited[pos_y]
+            if spread:
+                reached[pos_y] = spread
+        return reached
+
+    def _flood_(self, sources, visit):
+        '''Breadth first waves from sources, visit(distance, y, bits) for every wave'''
+        visited = [0] * self.height
+        frontier = {}
+        for pos_x, pos_y in sources:
+            if self.is_walkable(pos_x, pos_y):
+                frontier[pos_y] = frontier.get(pos_y, 0) | (1 << pos_x)
+        distance = 0
+        while frontier:
+            for pos_y, bits in frontier.items():
+                visited[pos_y] |= bits
+                visit(distance, pos_y, bits)
+            frontier = self._wave_(frontier, visited, min(frontier), max(frontier))
+            distance += 1
+
+    def _label_components_(self):
+        '''Returns the component of every tile and the number of components'''
+        components = array.array('i', [NO_COMPONENT]) * (self.width * self.height)
+        labelled = [0] * self.height
+        count = 0
+
+        def label(_, pos_y, bits):
+            labelled[pos_y] |= bits
+            offset = pos_y * self.width
+            for pos_x in _iter_bits_(bits):
+                components[offset + pos_x] = count
+
+        for pos_y in range(self.height):
+            while self.rows[pos_y] & ~labelled[pos_y]:
+                unlabelled = self.rows[pos_y] & ~labelled[pos_y]
+                seed = (unlabelled & -unlabelled).bit_length() - 1
+                self._flood_([(seed, pos_y)], label)
+                count += 1
+        return components, count
+
+    def distance_field(self, targets):
+        '''Returns the steps from every tile to the nearest target, UNREACHABLE if none'''
+        field = array.array('i', [UNREACHABLE]) * (self.width * self.height)
+
+        def measure(distance, pos_y, bits):
+            offset = pos_y * self.width
+            for pos_x in _iter_bits_(bits):
+                field[offset + pos_x] = distance
+
+        self._flood_(targets, measure)
+        return field
+
+    def _cached_field_(self, goal):
+        '''Returns the distance field to goal if it is (or just became) common enough'''
+        with self._lock_:
+            field = self._fields_.get(goal)
+            if field is not None:
+                self._fields_.move_to_end(goal)
+                return field
+            if len(self._queries_) > DISTANCE_FIELDS * FIELD_QUERIES:
+                self._queries_.clear()
+            self._queries_[goal] += 1
+            if self._queries_[goal] < FIELD_THRESHOLD:
+                return None
+            del self._queries_[goal]
+        field = self.distance_field([goal])
+        with self._lock_:
+            self._fields_[goal] = field
+            while len(self._fields_) > DISTANCE_FIELDS:
+                self._fields_.popitem(last=False)
+        return field
+
+    def follow_field(self, field, start):
+        '''Returns the path from start going downhill in a distance field'''
+        pos_x, pos_y = start
+        distance = field[pos_y * self.width + pos_x]
+        if distance == UNREACHABLE:
+            return []
+        path = [start]
+        while distance > 0:
+            for step_x, step_y in NEIGHBOURS:
+                next_x, next_y = pos_x + step_x, pos_y + step_y
+                if self.is_walkable(next_x, next_y) and \
+                   field[next_y * self.width + next_x] == distance - 1:
+                    pos_x, pos_y = next_x, next_y
+                    break
+            distance -= 1
+            path.append((pos_x, pos_y))
+        return path
+
+    def a_star(self, start, goal):
+        '''Returns the shortest path between two positions using A*'''
+        goal_x, goal_y = goal
+        came_from = {start: None}
+        costs = {start: 0}
+        pending = [(abs(start[0] - goal_x) + abs(start[1] - goal_y), 0, start)]
+        while pending:
+            _, cost, position = heapq.heappop(pending)
+            if position == goal:
+                path = []
+                while position is not None:
+                    path.append(position)
+                    position = came_from[position]
+                path.reverse()
+                return path
+            if cost > costs[position]:
+                continue
+            pos_x, pos_y = position
+            for step_x, step_y in NEIGHBOURS:
+                next_x, next_y = pos_x + step_x, pos_y + step_y
+                if not self.is_walkable(next_x, next_y):
+                    continue
+                neighbour = (next_x, next_y)
+                if cost + 1 < costs.get(neighbour, cost + 2):
+                    costs[neighbour] = cost + 1
+                    came_from[neighbour] = position
+                    estimate = cost + 1 + abs(next_x - goal_x) + abs(next_y - goal_y)
+                    heapq.heappush(pending, (estimate, cost + 1, neighbour))
+        return []
+
+    def find_path(self, start, goal):
+        '''Returns the positions from start to goal, both included, [] if unreachable'''
+        if not self.connected(start, goal):
+            return []
+        field = self._cached_field_(goal)
+        if field is not None:
+            return self.follow_field(field, start)
+        return self.a_star(start, goal)
+
+    def path_to_exit(self, start):
+        '''Returns the positions from start to the nearest exit, [] if unreachable'''
+        if not self.is_walkable(*start):
+            return []
+        return self.follow_field(self.exit_field, start)
+
+
+def area_navigation(area):
+    '''Returns the navigation data of a dungeon_engine.Area
+
+    Areas share the data of their room until they change their own grid.
+    '''
+    with area.lock:
+        if area.navigation is None:
+            if area.grid is area.template.grid and area.template.navigation is not None:
+                area.navigation = area.template.navigation
+            else:
+                # The area grid has floor under the items, put them back to find the exits
+                grid = area.grid.copy()
+                for item in area.get_items():
+                    if grid.contains(item.pos_x, item.pos_y):
+                        grid.set_tile(item.pos_x, item.pos_y, item.item_type)
+                if area.entrance is not None:
+                    grid.set_tile(area.entrance[0], area.entrance[1],
+                                  dungeon_engine.ENTRANCE_TILE)
+                area.navigation = NavigationData(area.room_name, grid)
+        return area.navigation
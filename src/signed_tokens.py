@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+    Tokens that carry their owner signed with a key shared by the servers
+
+    Layout: s1.<user>.<issue time>.<generation>.<signature>
+
+    user and signature are base64url without padding, the signature is
+    the truncated HMAC-SHA256 of everything before it. The generation of
+    a user grows with every token issued, so a token is revoked as soon
+    as one with a higher generation, or its own revocation, is seen. A
+    verifier knows nothing of the revocations made before it started, so
+    the first token of each user is left to the Authentication server and
+    its generation passed to confirm.
+'''
+
+import hmac
+import time
+import base64
+import hashlib
+import threading
+
+PREFIX = 's1'
+SEPARATOR = '.'
+SIGNATURE_SIZE = 16
+# Seconds a token is valid, 0 means until it is revoked
+MAX_AGE = 0
+
+
+def _encode_(data):
+    return base64.urlsafe_b64encode(data).decode('ascii').rstrip('=')
+
+
+def _decode_(text):
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+
+def _sign_(key, payload):
+    digest = hmac.new(key, payload.encode('ascii'), hashlib.sha256).digest()
+    return _encode_(digest[:SIGNATURE_SIZE])
+
+
+def load_key(text):
+    '''Returns the signing key of a property value, None if it is empty'''
+    return text.encode('utf-8') if text else None
+
+
+def is_signed(token):
+    '''Returns if the token has the signed format'''
+    return token.startswith(PREFIX + SEPARATOR)
+
+
+def build_token(key, user, generation, issued=None):
+    '''Returns a signed token of user'''
+    payload = SEPARATOR.join((
+        PREFIX, _encode_(user.encode('utf-8')),
+        str(int(time.time() if issued is None else issued)), str(generation)))
+    return '{}{}{}'.format(payload, SEPARATOR, _sign_(key, payload))
+
+
+def is_expired(issued, max_age):
+    '''Returns if a token issued at that time is older than max_age seconds'''
+    return max_age > 0 and issued + max_age < time.time()
+
+
+def parse_token(token):
+    '''Returns (user, issue time, generation) without checking the signature, or None'''
+    fields = token.split(SEPARATOR)
+    if len(fields) != 5 or fields[0] != PREFIX:
+        return None
+    try:
+        return _decode_(fields[1]).decode('utf-8'), int(fields[2]), int(fields[3])
+    except (ValueError, UnicodeDecodeError):
+        return None
+
+
+class TokenVerifier:
+    '''Checks signed tokens locally, remembering the revoked generations'''
+    def __init__(self, key, max_age=MAX_AGE):
+        self.key = key
+        self.max_age = max_age
+        self.verified = 0
+        self.rejected = 0
+        # Tokens of users without a confirmed generation
+        self.unknown = 0
+        # user -> lowest generation still valid
+        self._generations_ = {}
+        self._lock_ = threading.Lock()
+
+    def owner(self, token):
+        '''Returns the user of a valid signed token, None if invalid or of an unknown user'''
+        fields = parse_token(token)
+        if fields is None or not self._signed_by_key_(token):
+            self.rejected += 1
+            return None
+        user, issued, generation = fields
+        if is_expired(issued, self.max_age):
+            self.rejected += 1
+            return None
+        with self._lock_:
+            valid_generation = self._generations_.get(user)
+            if valid_generation is None:
+                # It may have been revoked before this verifier started
+                self.unknown += 1
+                return None
+            if generation < valid_generation:
+                self.rejected += 1
+                return None
+            # Issuing this token revoked every older one
+            self._generations_[user] = generation
+        self.verified += 1
+        return user
+
+    def confirm(self, token):
+        '''Accepts from now on the generation of a token the Authentication server accepted'''
+        fields = parse_token(token)
+        if fields is None or not self._signed_by_key_(token):
+            return
+        user, _, generation = fields
+        with self._lock_:
+            self._generations_[user] = max(self._generations_.get(user, 0), generation)
+
+    def revoke(self, token):
+        '''Rejects from now on the token and every older one of its user'''
+        fields = parse_token(token)
+        if fields is None or not self._signed_by_key_(token):
+            return
+        user, _, generation = fields
+        with self._lock_:
+            self._generations_[user] = max(self._generations_.get(user, 0), generation + 1)
+
+    def _signed_by_key_(self, token):
+        payload, _, signature = token.rpartition(SEPARATOR)
+        return hmac.compare_digest(signature, _sign_(self.key, payload))
@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+    Loading of the IceGauntlet Slice definitions
+
+    ./compile_slice generates the Python stubs in src/generated. They are
+    imported when they are newer than icegauntlet.ice; otherwise the Slice
+    file is compiled at startup as before.
+'''
+
+import os
+import sys
+
+import Ice
+
+SLICE_FILE = 'icegauntlet.ice'
+STUBS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'generated')
+STUBS_MODULE = 'icegauntlet_ice.py'
+
+
+def stubs_current(slice_file=SLICE_FILE, stubs_dir=STUBS_DIR):
+    '''Returns if stubs_dir has stubs at least as recent as slice_file'''
+    stubs_file = os.path.join(stubs_dir, STUBS_MODULE)
+    if not os.path.exists(stubs_file):
+        return False
+    if not os.path.exists(slice_file):
+        return True
+    return os.path.getmtime(stubs_file) >= os.path.getmtime(slice_file)
+
+
+def load_slice(slice_file=SLICE_FILE, stubs_dir=STUBS_DIR):
+    '''Makes IceGauntlet importable, returns if the generated stubs are used'''
+    if stubs_current(slice_file, stubs_dir):
+        if stubs_dir not in sys.path:
+            sys.path.insert(0, stubs_dir)
+        return True
+    Ice.loadSlice(slice_file)
+    return False
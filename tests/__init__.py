@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+
+'''
+    Unit tests, run from the repository root with python3 -m unittest
+'''
+
+import os
+import sys
+import json
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT_DIR, 'src'))
+# map_server loads icegauntlet.ice from the working directory
+os.chdir(ROOT_DIR)
+
+# pylint: disable=C0413
+import slice_stubs
+# The client modules expect IceGauntlet to be importable already
+slice_stubs.load_slice()
+
+
+def load_templates():
+    '''Returns the rooms of rooms.json'''
+    with open(os.path.join(ROOT_DIR, 'rooms.json')) as roomsfile:
+        return [list(owner.values())[0] for owner in json.load(roomsfile).values()]
+
+
+def build_storage(workdir, **options):
+    '''Returns a loaded map_server.MapStorage on the files of workdir'''
+    # pylint: disable=C0415
+    import map_server
+    options.setdefault('flush_interval', 0.01)
+    options.setdefault('fsync_policy', 'never')
+    storage = map_server.MapStorage(
+        rooms_file=os.path.join(workdir, 'rooms.json'),
+        managers_file=os.path.join(workdir, 'managers.json'),
+        journal_file=os.path.join(workdir, 'rooms.journal'),
+        **options
+    )
+    storage.load()
+    return storage
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+
+'''
+    Spatial index of the areas and concurrent event frames
+'''
+
+import sys
+import random
+import threading
+import unittest
+
+from tests import load_templates
+# pylint: disable=C0413
+import room_codec
+import area_events
+import dungeon_engine
+
+
+def build_engine():
+    '''Returns a DungeonEngine over the rooms of rooms.json'''
+    rooms = {}
+    for index, template in enumerate(load_templates()):
+        room = dict(template, room='room{}'.format(index))
+        rooms[room['room']] = room_codec.encode_room(room)
+    return dungeon_engine.DungeonEngine(lambda: list(rooms.keys()), rooms.__getitem__)
+
+
+class TestSpatialIndex(unittest.TestCase):
+    '''Queries match a scan of every position'''
+    def setUp(self):
+        self.random = random.Random(1)
+        self.index = dungeon_engine.SpatialIndex(cell_size=4)
+        self.positions = {}
+        for entity in range(300):
+            self.move('e{}'.format(entity))
+
+    def move(self, entity_id):
+        '''Puts an entity in a random position'''
+        position = (self.random.randrange(-20, 60), self.random.randrange(-20, 60))
+        self.positions[entity_id] = position
+        self.index.insert(entity_id, *position)
+
+    def test_query_range(self):
+        '''query_range returns the ids inside the square'''
+        for _ in range(50):
+            self.move('e{}'.format(self.random.randrange(300)))
+            pos_x, pos_y = self.random.randrange(0, 40), self.random.randrange(0, 40)
+            radius = self.random.randrange(0, 12)
+            expected = {
+                entity_id for entity_id, (entity_x, entity_y) in self.positions.items()
+                if abs(entity_x - pos_x) <= radius and abs(entity_y - pos_y) <= radius
+            }
+            self.assertEqual(set(self.index.query_range(pos_x, pos_y, radius)), expected)
+
+    def test_nearest(self):
+        '''nearest returns an id at the smallest distance'''
+        for _ in range(50):
+            pos_x, pos_y = self.random.randrange(-30, 70), self.random.randrange(-30, 70)
+            distances = {
+                entity_id: (entity_x - pos_x) ** 2 + (entity_y - pos_y) ** 2
+                for entity_id, (entity_x, entity_y) in self.positions.items()
+            }
+            nearest = self.index.nearest(pos_x, pos_y)
+            self.assertEqual(distances[nearest], min(distances.values()))
+
+    def test_remove(self):
+        '''Removed ids are not found any more'''
+        self.index.remove('e0')
+        self.assertNotIn('e0', self.index.query_range(*self.positions['e0'], 0))
+        self.assertEqual(len(self.index), 299)
+
+
+class TestConcurrentEvents(unittest.TestCase):
+    '''Event frames applied while requests read the area'''
+    def setUp(self):
+        self.switch_interval = sys.getswitchinterval()
+        # Switch threads often so that a missing lock shows up
+        sys.setswitchinterval(1e-6)
+
+    def tearDown(self):
+        sys.setswitchinterval(self.switch_interval)
+
+    def test_queries_during_events(self):
+        '''Range and nearest queries never see an index being changed'''
+        area = build_engine().new_dungeon()
+        done = threading.Event()
+        errors = []
+
+        def apply_frames():
+            generator = random.Random(2)
+            try:
+                for frame in range(300):
+                    events = [
+                        area_events.spawn_actor('a{}'.format(actor), generator.randrange(40),
+                                                generator.randrange(40))
+                        for actor in range(frame % 7, 200, 7)
+                    ]
+                    events.append(area_events.remove_actor('a{}'.format(frame % 200)))
+                    area_events.apply_events(area, events)
+            finally:
+                done.set()
+
+        def query():
+            generator = random.Random(3)
+            try:
+                while not done.is_set():
+                    area.actors_near(generator.randrange(40), generator.randrange(40), 10)
+                    area.nearest_actor(generator.randrange(40), generator.randrange(40))
+            except Exception as error:  # pylint: disable=broad-except
+                errors.append(error)
+
+        readers = [threading.Thread(target=query) for _ in range(3)]
+        for reader in readers:
+            reader.start()
+        apply_frames()
+        for reader in readers:
+            reader.join()
+        self.assertEqual(errors, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
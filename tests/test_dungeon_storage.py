@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+
+'''
+    DungeonEngine over the rooms of a MapStorage
+'''
+
+import json
+import shutil
+import tempfile
+import unittest
+
+import Ice
+
+from tests import build_storage, load_templates
+# pylint: disable=C0413
+import map_server
+
+
+class TestEngineOverStorage(unittest.TestCase):
+    '''prepare_engine() on a loaded MapStorage'''
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.storage = build_storage(self.workdir)
+        for index, template in enumerate(load_templates()):
+            room = dict(template, room='room{}'.format(index))
+            self.storage.commit_room('owner', json.dumps(room))
+        self.engine = map_server.MapManServer.prepare_engine(Ice.createProperties(), self.storage)
+
+    def tearDown(self):
+        self.storage.close()
+        shutil.rmtree(self.workdir)
+
+    def test_new_dungeon(self):
+        '''Every area of a dungeon is built from the stored grid and navigation'''
+        area = self.engine.new_dungeon()
+        self.assertIsNotNone(area)
+        while area is not None:
+            stored = json.loads(self.storage.get_room_data(area.room_name))
+            rows = json.loads(area.get_map())['data']
+            # Objects become items of the area, the shape is the stored one
+            self.assertEqual([len(row) for row in rows], [len(row) for row in stored['data']])
+            self.assertIsNotNone(area.template.navigation)
+            area = self.engine.next_area(area)
+
+    def test_reloaded_rooms(self):
+        '''Rooms read back from the files serve areas too'''
+        self.storage.close()
+        self.storage.load()
+        self.engine = map_server.MapManServer.prepare_engine(Ice.createProperties(), self.storage)
+        self.assertIsNotNone(self.engine.new_dungeon())
+
+
+if __name__ == '__main__':
+    unittest.main()
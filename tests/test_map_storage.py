@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+
+'''
+    MapStorage journal, snapshots and write-behind flushing
+'''
+
+import json
+import time
+import shutil
+import tempfile
+import unittest
+
+from tests import build_storage, load_templates
+
+
+def room_data(room_name, template=None):
+    '''Returns the JSON text of a valid room called room_name'''
+    return json.dumps(dict(template or load_templates()[0], room=room_name))
+
+
+class TestJournal(unittest.TestCase):
+    '''Records reach the files and are read back'''
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.storage = build_storage(self.workdir)
+
+    def tearDown(self):
+        self.storage.close()
+        shutil.rmtree(self.workdir)
+
+    def reload(self, **options):
+        '''Closes the storage and loads its files again'''
+        self.storage.close()
+        self.storage = build_storage(self.workdir, **options)
+
+    def test_flush_interval(self):
+        '''Records logged during one interval go out in one append'''
+        self.reload(flush_interval=0.5)
+        appends = []
+        append_journal = self.storage.append_journal
+        self.storage.append_journal = lambda records: (
+            appends.append(len(records)), append_journal(records))
+        for index in range(20):
+            self.storage.commit_room('owner', room_data('room{}'.format(index)))
+            time.sleep(0.01)
+        time.sleep(0.7)
+        self.assertEqual(appends, [20])
+
+    def test_failed_append(self):
+        '''Records of a failed append go out, in order, with the next flush'''
+        self.reload(flush_interval=60)
+        append_journal = self.storage.append_journal
+        def torn_append(records):
+            with open(self.storage.journal_file, 'a') as journalfile:
+                journalfile.write(records[0][:10])
+            raise OSError('No space left on device')
+        self.storage.append_journal = torn_append
+        self.storage.commit_room('owner', room_data('kept'))
+        self.storage.commit_room('owner', room_data('removed'))
+        with self.assertRaises(OSError):
+            self.storage.flush()
+        self.storage.append_journal = append_journal
+        self.storage.uncommit_room('owner', 'removed')
+        self.storage.flush()
+        self.reload()
+        self.assertEqual(self.storage.get_rooms(), ['kept'])
+
+
+if __name__ == '__main__':
+    unittest.main()
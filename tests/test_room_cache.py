@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+
+'''
+    Disk files of the client room cache
+'''
+
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+import room_cache
+import IceGauntlet  # pylint: disable=E0401
+
+ROOM = '{"room": "cached", "data": [[1]]}'
+
+
+class RoomManager:
+    '''RoomManager that always sends the room back'''
+    def __init__(self):
+        self.known_hashes = []
+
+    def getRoomIfChanged(self, room_name, known_hash):  # pylint: disable=C0103
+        '''Returns the room whatever the hash known'''
+        self.known_hashes.append(known_hash)
+        return IceGauntlet.HashedRoom(ROOM, 'current')
+
+
+class TestCacheFiles(unittest.TestCase):
+    '''Files left in the cache directory'''
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.room_manager = RoomManager()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def path(self):
+        '''Returns the cache file of the room'''
+        # pylint: disable=W0212
+        return os.path.join(self.directory, room_cache.RoomCache._file_name_('cached'))
+
+    def test_reused_file(self):
+        '''A file of a previous run is checked with its hash'''
+        with open(self.path(), 'w') as roomfile:
+            json.dump({'room': 'cached', 'hash': 'old', 'data': ROOM}, roomfile)
+        cache = room_cache.RoomCache(self.room_manager, directory=self.directory)
+        self.assertEqual(cache.get_room('cached'), ROOM)
+        self.assertEqual(self.room_manager.known_hashes, ['old'])
+
+    def test_unreadable_files(self):
+        '''Damaged files are misses and are replaced'''
+        for contents in ('{"room": "cached"', '{"room": "cached"}', '["cached"]',
+                         '{"room": "cached", "hash": 1, "data": 2}'):
+            with open(self.path(), 'w') as roomfile:
+                roomfile.write(contents)
+            cache = room_cache.RoomCache(self.room_manager, directory=self.directory)
+            self.assertEqual(cache.get_room('cached'), ROOM)
+            self.assertEqual(self.room_manager.known_hashes.pop(), '')
+            with open(self.path()) as roomfile:
+                self.assertEqual(json.load(roomfile)['hash'], 'current')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+
+'''
+    Binary encoding of rooms with room_codec
+'''
+
+import json
+import unittest
+
+from tests import load_templates
+# pylint: disable=C0413
+import room_codec
+import map_server
+import IceGauntlet  # pylint: disable=E0401
+
+LONG_NAME = 'x' * (room_codec.MAX_NAME_SIZE + 1)
+
+
+class TestRoundTrip(unittest.TestCase):
+    '''decode_room(encode_room(room)) == room'''
+    def setUp(self):
+        self.room = load_templates()[0]
+
+    def test_tile_grid(self):
+        '''Tile grids, compressed or not, come back as they were'''
+        for compress in (True, False):
+            blob = room_codec.encode_room(self.room, compress)
+            self.assertEqual(room_codec.decode_room(blob), self.room)
+            name, height, width, tiles = room_codec.decode_tiles(blob)
+            self.assertEqual((name, height, width), (
+                self.room[room_codec.ROOM_NAME], len(self.room[room_codec.ROOM_DATA]),
+                len(self.room[room_codec.ROOM_DATA][0])))
+            self.assertEqual(tiles, b''.join(bytes(row) for row in self.room[room_codec.ROOM_DATA]))
+
+    def test_json_room(self):
+        '''Rooms that are not a tile grid are kept as JSON'''
+        room = dict(self.room, extra=[1, 2], data=[[256, 'x']])
+        blob = room_codec.encode_room(room)
+        self.assertEqual(room_codec.decode_room(blob), room)
+        self.assertIsNone(room_codec.decode_tiles(blob)[3])
+
+    def test_body_with_name(self):
+        '''Bodies of different rooms with the same content only differ in the name'''
+        for room in (self.room, dict(self.room, extra=True)):
+            blob = room_codec.with_name(room_codec.encode_body(room), 'renamed')
+            self.assertEqual(room_codec.decode_room(blob), dict(room, room='renamed'))
+
+    def test_invalid_binary(self):
+        '''Truncated or foreign bytes raise InvalidRoomBinary'''
+        blob = room_codec.encode_room(self.room, compress=False)
+        for invalid in (blob[:room_codec.HEADER.size - 1], b'XXXX' + blob[4:], blob[:-1]):
+            with self.assertRaises(room_codec.InvalidRoomBinary):
+                room_codec.decode_room(invalid)
+
+
+class TestRoomName(unittest.TestCase):
+    '''Room names in the header, at most MAX_NAME_SIZE utf-8 bytes'''
+    def setUp(self):
+        self.room = load_templates()[0]
+
+    def test_longest_name(self):
+        '''A name of MAX_NAME_SIZE bytes survives with_name'''
+        name = 'ñ' * (room_codec.MAX_NAME_SIZE // 2) + 'x'
+        blob = room_codec.with_name(room_codec.encode_body(self.room), name)
+        self.assertEqual(room_codec.decode_room(blob)[room_codec.ROOM_NAME], name)
+
+    def test_long_name(self):
+        '''Longer names raise InvalidRoomName instead of a struct error'''
+        blob = room_codec.encode_body(self.room)
+        with self.assertRaises(room_codec.InvalidRoomName):
+            room_codec.with_name(blob, LONG_NAME)
+        with self.assertRaises(room_codec.InvalidRoomName):
+            room_codec.encode_room(dict(self.room, room=LONG_NAME))
+
+    def test_long_name_committed(self):
+        '''Clients get WrongRoomFormat for rooms with such a name'''
+        with self.assertRaises(IceGauntlet.WrongRoomFormat):
+            map_server.MapStorage.parse_room(json.dumps(dict(self.room, room=LONG_NAME)))
+
+
+if __name__ == '__main__':
+    unittest.main()
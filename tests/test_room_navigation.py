@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+
+'''
+    Paths over the NavigationData of a grid
+'''
+
+import unittest
+
+from tests import ROOT_DIR  # pylint: disable=W0611
+# pylint: disable=C0413
+import dungeon_engine
+import room_navigation
+
+W = 10  # Wall
+F = dungeon_engine.FLOOR_TILE
+ENTRANCE = (1, 1)
+EXIT = (1, 3)
+# Floor cut from the rest by walls
+POCKET = (1, 5)
+ROWS = [
+    [W, W, W, W, W, W],
+    [W, dungeon_engine.ENTRANCE_TILE, F, F, F, W],
+    [W, W, W, W, F, W],
+    [W, dungeon_engine.EXIT_TILE, F, F, F, W],
+    [W, W, W, W, W, W],
+    [W, F, W, W, W, W],
+    [W, W, W, W, W, W],
+]
+# Steps of the shortest path between the entrance and the exit
+DISTANCE = 8
+
+
+class TestPaths(unittest.TestCase):
+    '''find_path and path_to_exit'''
+    def setUp(self):
+        self.navigation = room_navigation.NavigationData(
+            'maze', dungeon_engine.TileGrid.from_rows(ROWS))
+
+    def assert_path(self, path, start, goal):
+        '''Checks that path walks one tile at a time from start to goal'''
+        self.assertEqual(path[0], start)
+        self.assertEqual(path[-1], goal)
+        self.assertEqual(len(path), DISTANCE + 1)
+        for (pos_x, pos_y), (next_x, next_y) in zip(path, path[1:]):
+            self.assertEqual(abs(next_x - pos_x) + abs(next_y - pos_y), 1)
+            self.assertTrue(self.navigation.is_walkable(next_x, next_y))
+
+    def test_find_path(self):
+        '''Shortest paths with A* and, once the goal is common, its distance field'''
+        for _ in range(room_navigation.FIELD_THRESHOLD + 1):
+            self.assert_path(self.navigation.find_path(ENTRANCE, EXIT), ENTRANCE, EXIT)
+
+    def test_path_to_exit(self):
+        '''The exits are found from the entrance'''
+        self.assertEqual(self.navigation.exits, [EXIT])
+        self.assertEqual(self.navigation.entrance, ENTRANCE)
+        self.assert_path(self.navigation.path_to_exit(ENTRANCE), ENTRANCE, EXIT)
+
+    def test_unreachable(self):
+        '''No path to or from the pocket or a wall'''
+        self.assertEqual(self.navigation.component_count, 2)
+        self.assertFalse(self.navigation.connected(ENTRANCE, POCKET))
+        self.assertEqual(self.navigation.find_path(ENTRANCE, POCKET), [])
+        self.assertEqual(self.navigation.find_path(ENTRANCE, (0, 0)), [])
+        self.assertEqual(self.navigation.path_to_exit(POCKET), [])
+        self.assertEqual(self.navigation.path_to_exit((0, 0)), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
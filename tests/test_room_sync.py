@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+
+'''
+    Ordering of the deltas pulled by RoomManagerSync
+'''
+
+import json
+import shutil
+import tempfile
+import unittest
+
+import Ice
+
+from tests import build_storage, load_templates
+# pylint: disable=C0413
+import map_server
+import IceGauntlet  # pylint: disable=E0401
+
+REMOTE_ID = 'remote -t -e 1.1:tcp -h 127.0.0.1 -p 1'
+
+
+def run(coroutine):
+    '''Drives an AMD coroutine the way Ice does, resuming it when its futures end'''
+    def step(_future=None):
+        try:
+            future = coroutine.send(None)
+        except StopIteration:
+            return
+        future.add_done_callback(step)
+    step()
+
+
+class RemoteManager:
+    '''RoomManager whose getChangesSince replies are released by the test'''
+    def __init__(self):
+        self.changes = []
+        # (version asked, changes when asked, future)
+        self.pending = []
+
+    def change(self, room_name, removed, digest=''):
+        '''Logs a change of the remote manager'''
+        version = len(self.changes) + 1
+        self.changes.append(IceGauntlet.RoomChange(version, room_name, 'owner', removed, digest))
+
+    def getChangesSinceAsync(self, version):  # pylint: disable=C0103
+        '''Returns a future replied by reply_newest_first'''
+        future = Ice.Future()
+        self.pending.append((version, list(self.changes), future))
+        return future
+
+    @staticmethod
+    def getRoomsAsync(room_names):  # pylint: disable=C0103
+        '''The remote rooms were removed since'''
+        future = Ice.Future()
+        future.set_result({})
+        return future
+
+    def reply_newest_first(self):
+        '''Answers every pending request, the newest first, with the changes when it was sent'''
+        while self.pending:
+            version, changes, future = self.pending.pop()
+            future.set_result([change for change in changes if change.version > version])
+
+
+class TestDeltaOrder(unittest.TestCase):
+    '''Overlapping pulls of the same manager'''
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.storage = build_storage(self.workdir)
+        self.communicator = Ice.initialize()
+        self.sync = map_server.RoomManagerSync(None, self.communicator, self.storage)
+        self.remote = RemoteManager()
+
+        async def get_remote_manager(manager_id):
+            return self.remote
+        self.sync.get_remote_manager = get_remote_manager
+        self.sync.update_version(REMOTE_ID, 0)
+
+    def tearDown(self):
+        self.communicator.destroy()
+        self.storage.close()
+        shutil.rmtree(self.workdir)
+
+    def test_removal_not_undone(self):
+        '''A delta answered late does not bring back a room removed by a newer one'''
+        # The remote room has the content of a local one, so it is applied by hash
+        self.storage.commit_room('owner', json.dumps(dict(load_templates()[0], room='local')))
+        _, digest = self.storage.get_hashed_room('local')
+        self.remote.change('remote', False, digest)
+        run(self.sync.newRoom('remote', REMOTE_ID))
+        self.remote.change('remote', True)
+        run(self.sync.newRoom('other', REMOTE_ID))
+        self.remote.reply_newest_first()
+        self.assertNotIn('remote', self.storage.get_rooms())
+        self.assertEqual(self.sync._versions_[REMOTE_ID], 2)  # pylint: disable=W0212
+
+
+if __name__ == '__main__':
+    unittest.main()
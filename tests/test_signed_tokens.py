@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+
+'''
+    Expiry of signed tokens in the servers and the Authentication server
+'''
+
+import os
+import json
+import time
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import auth_server
+import signed_tokens
+import IceGauntlet  # pylint: disable=E0401
+
+KEY = b'test-key'
+MAX_AGE = 60
+
+
+class TestMaxAge(unittest.TestCase):
+    '''Tokens older than SignedTokens.MaxAge'''
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        users_file = os.path.join(self.directory, 'users.json')
+        with open(users_file, 'w') as contents:
+            json.dump({'user': {auth_server.PASSWORD_HASH: 'hash'}}, contents)
+        self.authentication = auth_server.AuthenticationI(
+            users_file=users_file, signing_key=KEY, max_age=MAX_AGE)
+        self.token = self.authentication.getNewToken('user', 'hash')
+        self.verifier = signed_tokens.TokenVerifier(KEY, MAX_AGE)
+        self.verifier.confirm(self.token)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_fresh_token(self):
+        '''Both sides accept the token before max_age'''
+        self.assertEqual(self.authentication.getOwner(self.token), 'user')
+        self.assertEqual(self.verifier.owner(self.token), 'user')
+
+    def test_expired_token(self):
+        '''Both sides reject the token after max_age'''
+        with mock.patch('time.time', return_value=time.time() + MAX_AGE + 1):
+            with self.assertRaises(IceGauntlet.Unauthorized):
+                self.authentication.getOwner(self.token)
+            self.assertIsNone(self.verifier.owner(self.token))
+
+
+if __name__ == '__main__':
+    unittest.main()